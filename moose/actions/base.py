@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 import abc
 import sys
-# TODO: Defines actions work in multithreading
-# import threading
+import threading
+from contextlib import contextmanager
 
 from moose.core.management.color import color_style
 from moose.core.management.base import OutputWrapper
 from moose.core.exceptions import ImproperlyConfigured
 from moose.utils.module_loading import import_string
+from moose.conf import settings
 
 class IllegalAction(Exception):
 	"""Action was halted somehow"""
@@ -58,10 +59,18 @@ class BaseAction(AbstractAction):
 
 	4. Teardown
 		Handles the rest works after executing all context.
+
+	Contexts are executed by `executor_class` one by one by default, set it
+	to 'moose.actions.executors.ThreadPoolExecutor' or '...ProcessPoolExecutor'
+	if contexts are independent to each other.
 	"""
 
 	stats_dump = True
 	stats_class = 'moose.actions.stats.StatsCollector'
+	# Uses `settings.ACTION_EXECUTOR` if not set
+	executor_class = None
+	# Uses `settings.ACTION_MAX_WORKERS` if not set
+	nworkers = None
 
 	def __init__(self, app_config, stdout=None, stderr=None, style=None):
 		super(BaseAction, self).__init__()
@@ -75,11 +84,45 @@ class BaseAction(AbstractAction):
 		self.style  = style or color_style()
 
 		# Imports stats class
+		self._local = threading.local()
 		self.stats = import_string(self.stats_class)(self)
 
 		# String to record and display after all works done
 		self.output = []
 
+	@property
+	def stats(self):
+		# contexts executed in threads collect stats on their own, see
+		# `local_stats()`
+		return getattr(self._local, 'stats', self._stats)
+
+	@stats.setter
+	def stats(self, stats):
+		self._stats = stats
+
+	@contextmanager
+	def local_stats(self):
+		"""
+		Collects stats made in the current thread by a new collector until
+		exited, which is merged into `self.stats` by executors later, since
+		collectors are not thread-safe.
+		"""
+		self._local.stats = import_string(self.stats_class)(self)
+		try:
+			yield self._local.stats
+		finally:
+			del self._local.stats
+
+	def __getstate__(self):
+		# thread locals can't be pickled for processes spawned
+		state = self.__dict__.copy()
+		del state['_local']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._local = threading.local()
+
 	def parse(self, kwargs):
 		raise NotImplementedError('subclasses of BaseAction must provide a `parse()`')
 
@@ -92,10 +135,14 @@ class BaseAction(AbstractAction):
 	def teardown(self, env):
 		pass
 
+	def get_executor(self):
+		executor_cls = import_string(self.executor_class or settings.ACTION_EXECUTOR)
+		return executor_cls(self, self.nworkers)
+
 	def run(self, **kwargs):
 		environment = self.parse(kwargs)
-		for context in self.schedule(environment):
-			stats_id = self.execute(context)
+		executor = self.get_executor()
+		for stats_id in executor.run(self.schedule(environment)):
 			self.stats.close_action(self, stats_id)
 		self.teardown(environment)
 		return '\n'.join(self.output)
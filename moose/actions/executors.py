@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# `executors` 模块决定了 action 以何种方式执行 `schedule()` 生成的各个
+# context。默认的 `SerialExecutor` 与原来的行为一致，逐个执行；当每个
+# context 的 `execute()` 相互独立（比如导出多个 task_id）时，可以在 action
+# 中设置 `executor_class` 为 `ThreadPoolExecutor` 或 `ProcessPoolExecutor`
+# 以并行执行。
+import numbers
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from moose.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BaseExecutor(object):
+    """
+    Runs `action.execute()` for every context and yields the identity of
+    stats returned, the caller is responsible to close the stats with it.
+
+    `action`
+        An instance of `BaseAction` to execute contexts.
+
+    `nworkers`
+        The number of workers to run in parallel, ignored by the serial one.
+    """
+
+    def __init__(self, action, nworkers=None):
+        self.action   = action
+        self.nworkers = nworkers or settings.ACTION_MAX_WORKERS
+
+    def run(self, contexts):
+        raise NotImplementedError('subclasses of BaseExecutor must provide a `run()`')
+
+
+class SerialExecutor(BaseExecutor):
+    """
+    Executes contexts one after another in the calling thread.
+    """
+
+    def run(self, contexts):
+        for context in contexts:
+            yield self.action.execute(context)
+
+
+def merge_stats(stats, values):
+    """
+    Merges stats collected separately into the collector `stats`, numbers
+    are added up and the others are replaced.
+    """
+    for key, value in values.items():
+        if isinstance(value, numbers.Number) and not isinstance(value, bool):
+            stats.inc_value(key, value)
+        else:
+            stats.set_value(key, value)
+
+
+class ThreadPoolExecutor(BaseExecutor):
+    """
+    Executes contexts in a pool of threads, which fits actions spending
+    most of time on I/O, such as querying database and downloading files.
+    Note that lines in `action.output` are appended in the order of
+    contexts finished. Each context collects stats on its own, which are
+    merged into `action.stats` in the calling thread.
+    """
+    pool_class = ThreadPool
+
+    def create_pool(self):
+        return self.pool_class(self.nworkers)
+
+    def get_task(self):
+        return self.execute
+
+    def execute(self, context):
+        with self.action.local_stats() as stats:
+            stats_id = self.action.execute(context)
+        return stats_id, [], stats.get_stats()
+
+    def handle_result(self, result):
+        stats_id, output, stats = result
+        self.action.output.extend(output)
+        merge_stats(self.action.stats, stats)
+        return stats_id
+
+    def run(self, contexts):
+        # Runs in one loop if setting DEBUG mode, which makes it
+        # easier to trace errors
+        if settings.DEBUG or self.nworkers <= 1:
+            for stats_id in SerialExecutor(self.action).run(contexts):
+                yield stats_id
+            return
+
+        pool = self.create_pool()
+        try:
+            for result in pool.imap_unordered(self.get_task(), contexts):
+                yield self.handle_result(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+# The action to be executed in the processes, which is passed by the
+# initializer of the pool, so that it is inherited by forked processes
+# and pickled only once for spawned ones.
+_process_action = None
+
+def _init_process(action):
+    global _process_action
+    _process_action = action
+
+def _execute_in_process(context):
+    action = _process_action
+    action.stats.clear_stats()
+    noutput = len(action.output)
+    stats_id = action.execute(context)
+    return stats_id, action.output[noutput:], action.stats.get_stats()
+
+
+class ProcessPoolExecutor(ThreadPoolExecutor):
+    """
+    Executes contexts in a pool of processes, which fits actions spending
+    most of time on CPU, such as drawing images. Contexts must be
+    picklable, outputs and stats made in the children are sent back and
+    merged into the action.
+    """
+    # `multiprocessing.Pool` is a function in Python 2
+    pool_class = staticmethod(multiprocessing.Pool)
+
+    def create_pool(self):
+        return self.pool_class(self.nworkers, _init_process, (self.action, ))
+
+    def get_task(self):
+        return _execute_in_process
@@ -3,12 +3,12 @@ import os
 import math
 import time
 import copy
-import pickle
-import hashlib
 
 from moose.toolbox.image import draw
 from moose.models import ModelDownloader
 from moose.connection import query, fetch
+from moose.core.cache import DataCache
+from moose.core.manifest import ExportManifest
 from moose.utils._os import makedirs, makeparents, npath
 from moose.utils.module_loading import import_string
 from moose.conf import settings
@@ -39,6 +39,13 @@ class BaseExport(SimpleAction):
     use_cache       = True
     cache_dirname   = settings.DATACACHE_DIRNAME
     cache_lifetime  = settings.DATACACHE_LIFETIME
+    # The budget (in byte) of all querysets cached
+    cache_max_size  = settings.DATACACHE_MAX_SIZE
+    # Exports records edited since the last export only, which are queried
+    # with `LastEditTime` later than the watermark kept in the manifest
+    incremental     = False
+    manifest_dirname  = settings.MANIFEST_DIRNAME
+    watermark_overlap = settings.WATERMARK_OVERLAP
 
     def parse(self, kwargs):
         # Gets config from the kwargs
@@ -47,6 +54,9 @@ class BaseExport(SimpleAction):
         # Initialize the fetcher
         if self.fetcher_class:
             self.fetcher = self.fetcher_class(self.query_class, self.query_context)
+            if self.incremental:
+                self.edited_fetcher = self.fetcher_class(
+                    query.edited_query(self.query_class), self.query_context)
 
         # If data_model was defined as a string with dot,
         # for example 'appname.models.AppnameModel'
@@ -92,48 +102,93 @@ class BaseExport(SimpleAction):
             'project_id': context['task_id'],
             }
 
+    def get_projection(self):
+        """
+        Called by `fetch()` to get properties of documents to be fetched,
+        which are declared by the `data_model`.
+        """
+        if self.data_model:
+            return self.data_model_cls.get_projection()
+        return None
+
+    def get_cache(self):
+        """
+        Returns the cache to keep querysets fetched.
+        """
+        return DataCache(
+            os.path.join(self.app.data_dirname, self.cache_dirname),
+            self.cache_lifetime, self.cache_max_size, self.stats)
+
+    def get_manifest(self, context):
+        """
+        Returns the manifest of incremental exports for the task.
+        """
+        filepath = os.path.join(self.app.data_dirname, self.manifest_dirname,
+                                '{}.json'.format(context['task_id']))
+        return ExportManifest.load(filepath, self.app.data_dirname)
+
+    def track(self, data_model, filepath):
+        """
+        Records a file written for the data model in the manifest, if
+        exporting incrementally.
+        """
+        manifest = data_model.context.get('manifest')
+        if manifest is not None:
+            manifest.add(data_model.guid, filepath)
+
+    def untrack(self, data_model):
+        """
+        Marks files written for the data model previously to be removed.
+        """
+        manifest = data_model.context.get('manifest')
+        if manifest is not None:
+            manifest.discard(data_model.guid)
+
     def fetch(self, context):
         """
         Gets queryset with query arguments provided by `get_queryargs()`,
-        Dumps the result fetched to a pickle file if `use_cache` was set,
-        and loads only if it was not out of the date.
+        Records are generated lazily by the fetcher, and are written to the
+        cache meanwhile if `use_cache` was set. The cached queryset is loaded
+        as a stream only if it was not out of the date. Records edited after
+        the watermark are fetched only if exporting incrementally.
         """
         queryargs = self.get_queryargs(context)
-        if self.use_cache:
-            # gets the unique identifier by `queryargs`
-            cache_id = hashlib.md5(repr(queryargs)).hexdigest()
-            cache_pickle = os.path.join(self.app.data_dirname, self.cache_dirname, cache_id)
-            if os.path.exists(cache_pickle) and \
-                    not self.is_expired(cache_pickle):
-                logger.warning("Using cached queryset '%s'." % cache_id)
-                with open(cache_pickle) as f:
-                    queryset = pickle.load(f)
-            else:
-                queryset = self.fetcher.fetch(**queryargs)
-                makeparents(cache_pickle)
-                with open(cache_pickle, 'w') as f:
-                    pickle.dump(queryset, f)
+        projection = self.get_projection()
+        manifest = context.get('manifest')
+        if manifest is not None and manifest.watermark is not None:
+            since = manifest.since(self.watermark_overlap)
+            logger.info("Exports records of task '{}' edited since {}.".format(
+                context['task_id'], since))
+            queryargs.update(edited_less_or_more='>', edited_datetime=since)
+            # it makes no sense to cache the queryset of a moment
+            return self.edited_fetcher.iter_fetch(projection, **queryargs)
+
+        # the cache is skipped by incremental exports, otherwise records
+        # edited after it was created would be missed by the watermark
+        if self.use_cache and manifest is None:
+            # gets the unique identifier by `queryargs` and `projection`
+            cache_key = repr((sorted(queryargs.items()), projection))
+            cache = self.get_cache()
+            queryset = cache.get(cache_key)
+            if queryset is None:
+                queryset = cache.iter_set(
+                    cache_key, self.fetcher.iter_fetch(projection, **queryargs))
         else:
-            queryset = self.fetcher.fetch(**queryargs)
+            queryset = self.fetcher.iter_fetch(projection, **queryargs)
         return queryset
 
-    def is_expired(self, filepath):
-        """
-        Makes sure the file was not created before the warranty period.
-        """
-        delta = time.time() - os.stat(filepath).st_ctime
-        return delta > self.cache_lifetime * 3600
-
-
     def execute(self, context):
         """
         Defines how a job was finished in sequence.
         """
+        if self.incremental:
+            context['manifest'] = self.get_manifest(context)
         queryset = self.fetch(context)
-        self.stats.set_value("query/all", len(queryset))
         for data_model in self.enumerate_model(queryset, context):
             self.handle_model(data_model)
         self.terminate(context)
+        if self.incremental:
+            context['manifest'].save()
         return self.get_stats_id(context)
 
     def enumerate_model(self, queryset, context):
@@ -141,6 +196,7 @@ class BaseExport(SimpleAction):
         Generates the model of data to be handled later.
         """
         for item in queryset:
+            self.stats.inc_value("query/all")
             data_model = self.data_model_cls(item, self.app, self.stats, **context)
             if data_model.is_effective():
                 self.stats.inc_value("query/effective")
@@ -148,6 +204,7 @@ class BaseExport(SimpleAction):
                 self.stats.inc_value("query/ineffective")
                 if self.effective_only:
                     # skips it if export the effective only
+                    self.untrack(data_model)
                     continue
             yield data_model
 
@@ -168,9 +225,19 @@ class SimpleExport(BaseExport):
     query_context   = settings.QUERY_CONTEXT
 
     download_source = True
+    # Keeps sources downloaded in memory instead of writing them to files,
+    # which are passed to `handle_model(data_model, data)`, `data` is None
+    # if the source existed. Sources are saved by `save()` once handled.
+    keep_data = False
 
     def handle_model_by_callback(self, queryset, callback, context):
-        downloader = ModelDownloader(callback, self.stats)
+        def _callback(data_model, *args):
+            # sources kept in memory are tracked once saved
+            if not args or args[0] is None:
+                self.track(data_model, data_model.dest_filepath)
+            callback(data_model, *args)
+
+        downloader = ModelDownloader(_callback, self.stats, keep_data=self.keep_data)
         downloader.start()
 
         for data_model in self.enumerate_model(queryset, context):
@@ -183,6 +250,8 @@ class SimpleExport(BaseExport):
         """
         Defines how a job was finished in sequence.
         """
+        if self.incremental:
+            context['manifest'] = self.get_manifest(context)
         queryset = self.fetch(context)
         if self.download_source:
             self.handle_model_by_callback(queryset, self.handle_model, context)
@@ -190,10 +259,20 @@ class SimpleExport(BaseExport):
             for data_model in self.enumerate_model(queryset, context):
                 self.handle_model(data_model)
         self.terminate(context)
+        if self.incremental:
+            context['manifest'].save()
         return self.get_stats_id(context)
 
-    def handle_model(self, data_model):
+    def handle_model(self, data_model, data=None):
         self.dump(data_model)
+        if data is not None:
+            self.save(data_model, data)
+
+    def save(self, data_model, data):
+        makeparents(data_model.dest_filepath)
+        with open(data_model.dest_filepath, 'wb') as f:
+            f.write(data)
+        self.track(data_model, data_model.dest_filepath)
 
     def dump(self, data_model):
         # creates the upper directory to save json files
@@ -201,6 +280,7 @@ class SimpleExport(BaseExport):
         filename, _ = os.path.splitext(data_model.dest_filepath)
         with open(filename+data_model.output_suffix, 'w') as f:
             f.write(data_model.to_string())
+        self.track(data_model, filename+data_model.output_suffix)
 
 class TaskExport(SimpleExport):
     """
@@ -218,6 +298,9 @@ class TaskExport(SimpleExport):
         # Initialize the fetcher
         if self.fetcher_class:
             self.fetcher = self.fetcher_class(self.query_class, self.query_context)
+            if self.incremental:
+                self.edited_fetcher = self.fetcher_class(
+                    query.edited_query(self.query_class), self.query_context)
 
         # If data_model was defined as a string with dot,
         # for example 'appname.models.AppnameModel'
@@ -268,20 +351,38 @@ class ImagesExport(TaskExport):
     blend_label = '_blend'
     image_suffix  = '.png'
 
-    def handle_model(self, data_model):
+    # Set `keep_data` to decode images from the memory to draw, which are
+    # saved only if `save_source` was set
+    keep_data   = False
+    save_source = True
+
+    def handle_model(self, data_model, data=None):
         self.dump(data_model)
-        self.draw(data_model)
+        if data is not None and self.save_source:
+            self.save(data_model, data)
+        self.draw(data_model, data)
 
-    def draw(self, data_model):
+    def draw(self, data_model, data=None):
         image_path = data_model.dest_filepath
         image_prefix, _ = os.path.splitext(image_path)
+        # no mask or blend images if setting labels None, both of them
+        # are derived from polygons rasterized once
+        mask_path = blend_path = None
+        if self.mask_label:
+            mask_path = image_prefix + self.mask_label + self.image_suffix
+        if self.blend_label:
+            blend_path = image_prefix + self.blend_label + self.image_suffix
+        if mask_path is None and blend_path is None:
+            return
         try:
-            # no mask or blend images if setting labels None
-            if self.mask_label:
-                mask_path = image_prefix + self.mask_label + self.image_suffix
-                draw.draw_polygons(image_path, mask_path, data_model.datalist, self.pallet)
-            if self.blend_label:
-                blend_path = image_prefix + self.blend_label + self.image_suffix
-                draw.blend(image_path, blend_path, data_model.datalist, self.pallet)
+            # decodes the image once
+            if data is not None:
+                image = draw.decode_image(data)
+            else:
+                image = draw.read_image(image_path)
+            draw.render(image, data_model.datalist, self.pallet, mask_path, blend_path)
+            for path in (mask_path, blend_path):
+                if path:
+                    self.track(data_model, path)
         except AttributeError as e:
             logger.error("Unable to read {}.".format(npath(image_path)))
@@ -75,7 +75,8 @@ class SperatedStatsCollector(MemoryStatsCollector):
         if self._dump:
             logger.info("Dumping Moose stats:\n" + pprint.pformat(self._stats),
                         extra={'action': action})
-        self._persist_stats(self._stats, identity)
+        # persists a copy since stats are cleared in place
+        self._persist_stats(dict(self._stats), identity)
         self.clear_stats()
 
 
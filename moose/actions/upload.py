@@ -10,7 +10,7 @@ from moose.shortcuts import ivisit
 from moose.utils._os import safe_join
 from moose.utils.encoding import smart_text
 from moose.utils.datautils import islicel
-from moose.connection.cloud import AzureBlobService
+from moose.connection.cloud import AzureBlobService, UploadJournal, ChecksumCache
 
 from .base import IllegalAction, InvalidConfig, SimpleAction
 
@@ -29,6 +29,14 @@ class BaseUpload(SimpleAction):
     generate_index  = True
     default_pattern = None
     ignorecase      = True
+    # records files uploaded to resume an interrupted upload, which is not
+    # used if overwriting
+    use_journal     = False
+    journal_dirname = settings.UPLOAD_JOURNAL_DIRNAME
+    # uploads files new or changed only, compared by size and md5, which
+    # takes precedence over `overwrite`
+    sync              = False
+    checksums_dirname = settings.UPLOAD_CHECKSUMS_DIRNAME
 
     def parse(self, kwargs):
         # Gets config from the kwargs
@@ -36,7 +44,9 @@ class BaseUpload(SimpleAction):
 
         # uses the custom settings if defined
         if self.azure_setting:
-            self.azure = AzureBlobService(self.azure_setting)
+            self.azure = AzureBlobService(
+                self.azure_setting,
+                index_dirname=os.path.join(self.app.data_dirname, settings.AZURE_INDEX_DIRNAME))
 
         environment = {
             # base dirname for files to upload
@@ -102,6 +112,26 @@ class BaseUpload(SimpleAction):
     def get_all_files(self, context):
         return self.lookup_files(context['root'], context)
 
+    def get_journal(self, container_name):
+        """
+        Returns the journal of files uploaded to the container, or None if
+        `use_journal` was disabled or overwriting, in which case files
+        recorded by an old journal must not be skipped.
+        """
+        if not self.use_journal or (self.overwrite and not self.sync):
+            return None
+        filepath = os.path.join(self.app.data_dirname, self.journal_dirname,
+                                '{}.journal'.format(container_name))
+        return UploadJournal(filepath)
+
+    def get_checksum_cache(self, container_name):
+        """
+        Returns the cache of checksums of files to upload to the container.
+        """
+        filepath = os.path.join(self.app.data_dirname, self.checksums_dirname,
+                                '{}.json'.format(container_name))
+        return ChecksumCache(filepath)
+
     def execute(self, context):
         files = self.get_all_files(context)
         self.stats.set_value("files/all", len(files))
@@ -114,7 +144,18 @@ class BaseUpload(SimpleAction):
         container_name = context['task_id']
         if self.upload_files:
             self.stats.set_value("upload/total", len(blob_pairs))
-            blobs = self.azure.upload(container_name, blob_pairs, overwrite=self.overwrite)
+            journal = self.get_journal(container_name)
+            try:
+                if self.sync:
+                    blobs = self.azure.sync(container_name, blob_pairs,
+                                            cache=self.get_checksum_cache(container_name),
+                                            journal=journal, stats=self.stats)
+                else:
+                    blobs = self.azure.upload(container_name, blob_pairs, overwrite=self.overwrite,
+                                              journal=journal, stats=self.stats)
+            finally:
+                if journal is not None:
+                    journal.close()
             self.stats.set_value("upload/upload", len(blobs))
             self.output.append("%s files were uploaded to [%s]." % (len(blobs), container_name))
 
@@ -176,8 +217,7 @@ class ReferredUpload(SimpleUpload):
 
     def get_all_files(self, context):
         referred_task = context['refer']
-        blob_names = self.azure.list_blobs(referred_task)
-        return blob_names
+        return self.azure.get_index(referred_task).names
 
     def get_blob_url(self, task_id, blobname):
         return settings.AZURE_FILELINK.format(task_id=task_id, file_path=blobname)
@@ -62,6 +62,96 @@ DATABASES = {}
 # Classes used to implement DB routing behavior.
 DATABASE_ROUTERS = []
 
+# Connections to sql databases are pooled by handlers with the same settings.
+# The maximum number of connections in a pool, how long (in second) an idle
+# connection is kept, an idle connection is checked before reused if it
+# was not used for `DB_POOL_PING_INTERVAL` seconds, and how long to wait
+# for a connection if all of them are in use.
+DB_POOL_MAX_SIZE = 10
+DB_POOL_IDLE_TIMEOUT = 300
+DB_POOL_PING_INTERVAL = 30
+DB_POOL_TIMEOUT = 300
+# The number of rows fetched from the server at a time when iterating a query.
+DB_QUERY_BATCH_SIZE = 1000
+
+# Directory (relative to the data directory of apps) to cache querysets,
+# and how long (in hour) a queryset cached is valid.
+DATACACHE_DIRNAME = '.database'
+DATACACHE_LIFETIME = 1
+# The budget (in byte) of the cache, least recently used querysets are
+# removed if exceeded.
+DATACACHE_MAX_SIZE = 2 * 1024 ** 3
+
+# Directory (relative to the data directory of apps) to keep watermarks
+# and manifests of incremental exports, and how long (in second) to move
+# the watermark back in case that clocks of hosts are not synchronized.
+MANIFEST_DIRNAME = '.manifests'
+WATERMARK_OVERLAP = 600
+
+# The number of threads to transfer blobs on Azure concurrently, and how
+# many times to retry a blob failed to transfer.
+AZURE_MAX_WORKERS = 16
+AZURE_MAX_RETRIES = 3
+# Directory (relative to the data directory of apps) to keep journals of
+# blobs uploaded, which makes an interrupted upload resumable.
+UPLOAD_JOURNAL_DIRNAME = '.journals'
+# Directory (relative to the data directory of apps) to cache indexes of
+# blobs in containers, and how long (in second) an index is valid. Indexes
+# are listed on each call if set to 0.
+AZURE_INDEX_DIRNAME = '.indexes'
+AZURE_INDEX_LIFETIME = 0
+# Directory (relative to the data directory of apps) to cache checksums of
+# files, which are computed again only if the size or mtime changed.
+UPLOAD_CHECKSUMS_DIRNAME = '.checksums'
+# The maximum number of server-side copies in progress, and how often (in
+# second) to poll the status of them.
+AZURE_COPY_WINDOW = 500
+AZURE_COPY_POLL_INTERVAL = 1
+# Server-side copies still pending after AZURE_COPY_TIMEOUT seconds are
+# aborted and counted as failed.
+AZURE_COPY_TIMEOUT = 3600
+# Files larger than AZURE_BLOCK_THRESHOLD (in byte) are uploaded in blocks
+# of AZURE_BLOCK_SIZE bytes, which are put by AZURE_BLOCK_WORKERS threads
+# for each file. Files not larger than AZURE_SMALL_FILE_SIZE are uploaded
+# AZURE_SMALL_FILE_BATCH at a time by a thread.
+AZURE_BLOCK_SIZE = 4 * 1024 ** 2
+AZURE_BLOCK_THRESHOLD = 64 * 1024 ** 2
+AZURE_BLOCK_WORKERS = 4
+AZURE_SMALL_FILE_SIZE = 256 * 1024
+AZURE_SMALL_FILE_BATCH = 32
+
+# The number of connections kept alive to each host when downloading files
+# over http, and how long (in second) addresses of hosts resolved are cached.
+HTTP_POOL_SIZE = 10
+DNS_CACHE_TTL = 300
+# Files downloaded are written to disk in chunks of DOWNLOAD_CHUNK_SIZE bytes,
+# which bounds the memory used by each download.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# The maximum number of models waiting to be downloaded, adding models is
+# blocked until workers catch up if reached. 0 means unbounded.
+DOWNLOAD_QUEUE_SIZE = 2500
+# Executor to call callbacks of models downloaded, they are called in the
+# download threads by default, use 'moose.models.downloader.ThreadPoolCallbackExecutor'
+# or '...ProcessPoolCallbackExecutor' to call them in a separate pool of
+# DOWNLOAD_CALLBACK_WORKERS workers.
+DOWNLOAD_CALLBACK_EXECUTOR = 'moose.models.downloader.InlineCallbackExecutor'
+DOWNLOAD_CALLBACK_WORKERS = 4
+# Whether to adjust the number of downloads in flight by the throughput,
+# latency and errors observed, within DOWNLOAD_MIN_WORKERS and
+# DOWNLOAD_MAX_WORKERS.
+DOWNLOAD_ADAPTIVE = False
+DOWNLOAD_MIN_WORKERS = 2
+DOWNLOAD_MAX_WORKERS = 64
+# Downloads not completed in DOWNLOAD_HEDGE_PERCENTILE (such as 95) of
+# latencies seen in the run are duplicated, and whichever completes first
+# wins, once DOWNLOAD_HEDGE_MIN_SAMPLES latencies were seen. None disables
+# hedging.
+DOWNLOAD_HEDGE_PERCENTILE = None
+DOWNLOAD_HEDGE_MIN_SAMPLES = 20
+# Seconds for a downloader to complete, models not downloaded before it are
+# given up. None means no deadline.
+DOWNLOAD_DEADLINE = None
+
 ###########
 # CONFIGS #
 ###########
@@ -273,3 +363,16 @@ LOGGING_CONFIG = 'logging.config.dictConfig'
 
 # Custom logging configuration.
 LOGGING = {}
+
+
+###########
+# ACTIONS #
+###########
+
+# Executor to run contexts scheduled by actions, contexts are executed one
+# by one with the serial executor, use 'moose.actions.executors.ThreadPoolExecutor'
+# or 'moose.actions.executors.ProcessPoolExecutor' to run them in parallel.
+ACTION_EXECUTOR = 'moose.actions.executors.SerialExecutor'
+
+# The number of workers for parallel executors.
+ACTION_MAX_WORKERS = 4
@@ -1,22 +1,239 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import io
 import os
 import sys
+import mmap
+import json
+import base64
+import time
 import urllib
-from azure.storage.blob import BlockBlobService, PublicAccess
+import tempfile
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+from azure.storage.blob import BlockBlobService, PublicAccess, ContentSettings
+from azure.storage.blob.models import BlobBlock
 from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError
 
 from moose.core.exceptions import ImproperlyConfigured
+from moose.utils.module_loading import import_string
 from moose.utils import progressbar
-from moose.utils.encoding import escape_uri_path
-from moose.utils._os import npath, ppath, safe_join, normpath
+from moose.utils.encoding import escape_uri_path, force_text
+from moose.utils.crypto import file_md5
+from moose.utils._os import npath, ppath, safe_join, normpath, makeparents, makedirs
 from moose.conf import settings
 from moose.shortcuts import get_matchfn
 import re
 import logging
 logger = logging.getLogger(__name__)
 
+def content_md5(filepath):
+    """
+    Returns the md5 of a file encoded in base64, the same as the property
+    `Content-MD5` of blobs.
+    """
+    return force_text(base64.b64encode(file_md5(filepath)))
+
+
+class ContainerIndex(object):
+    """
+    An index of blobs in a container, which maps names of blobs to their
+    size, etag and Content-MD5 (None if unknown). Membership tests take
+    constant time, instead of scanning a list of names.
+    """
+
+    def __init__(self, container_name, names=(), created=None):
+        self.container_name = container_name
+        self.created = created if created is not None else time.time()
+        # keeps the order blobs were listed
+        self.blobs = collections.OrderedDict((name, (None, None, None)) for name in names)
+
+    def __contains__(self, blob_name):
+        return blob_name in self.blobs
+
+    def __iter__(self):
+        return iter(self.blobs)
+
+    def __len__(self):
+        return len(self.blobs)
+
+    @property
+    def names(self):
+        return list(self.blobs)
+
+    def add(self, blob_name, size=None, etag=None, content_md5=None):
+        self.blobs[blob_name] = (size, etag, content_md5)
+
+    def discard(self, blob_name):
+        self.blobs.pop(blob_name, None)
+
+    def get_size(self, blob_name):
+        return self.blobs[blob_name][0]
+
+    def get_etag(self, blob_name):
+        return self.blobs[blob_name][1]
+
+    def get_content_md5(self, blob_name):
+        return self.blobs[blob_name][2]
+
+    @classmethod
+    def load(cls, filepath, lifetime):
+        """
+        Returns the index saved in the file, or None if it was missing,
+        broken or older than `lifetime` seconds.
+        """
+        try:
+            with io.open(filepath, encoding='utf-8') as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - content['created'] > lifetime:
+            return None
+
+        index = cls(content['container'], created=content['created'])
+        for blob in content['blobs']:
+            index.add(*blob)
+        return index
+
+    def save(self, filepath):
+        content = {
+            'container': self.container_name,
+            'created': self.created,
+            'blobs': [(name, ) + properties for name, properties in self.blobs.items()],
+        }
+        dirname = os.path.dirname(filepath)
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        try:
+            os.rename(tmp_path, filepath)
+        except OSError:
+            # rename doesn't replace an existing file on Windows
+            os.remove(filepath)
+            os.rename(tmp_path, filepath)
+
+
+class UploadJournal(object):
+    """
+    A local journal of blobs uploaded, which makes an interrupted upload
+    resumable without sending finished files again. Every line records the
+    blob name with size and mtime of the file, so that a file modified
+    since then is uploaded again.
+    """
+    sep = '\t'
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries  = self._load()
+        self._file    = None
+
+    def _load(self):
+        entries = {}
+        if not os.path.exists(self.filepath):
+            return entries
+        with io.open(self.filepath, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split(self.sep)
+                # the last line may be broken if the process was killed
+                if len(fields) == 3 and line.endswith('\n'):
+                    entries[fields[0]] = (int(fields[1]), int(fields[2]))
+        logger.debug("%d blobs found in journal '%s'." % (len(entries), self.filepath))
+        return entries
+
+    def _stat(self, filepath):
+        st = os.stat(filepath)
+        return st.st_size, int(st.st_mtime)
+
+    def is_done(self, blob_name, filepath):
+        """
+        Returns True if the file was uploaded as the blob and not modified.
+        """
+        entry = self.entries.get(force_text(blob_name))
+        return entry is not None and os.path.exists(filepath) and \
+            entry == self._stat(filepath)
+
+    def record(self, blob_name, filepath):
+        if self._file is None:
+            makeparents(self.filepath)
+            self._file = io.open(self.filepath, 'a', encoding='utf-8')
+        blob_name = force_text(blob_name)
+        size, mtime = self._stat(filepath)
+        self._file.write(self.sep.join([blob_name, str(size), str(mtime)]) + '\n')
+        # keeps the journal on disk in case of crashes
+        self._file.flush()
+        self.entries[blob_name] = (size, mtime)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """
+        Removes the journal, which is not needed once all files were uploaded.
+        """
+        self.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+        self.entries = {}
+
+
+class ChecksumCache(object):
+    """
+    Checksums of local files computed before, keyed by the path with size
+    and mtime of the file, so that a file is hashed again only if modified.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries  = {}
+        self.dirty    = False
+        self.lock     = threading.Lock()
+        try:
+            with io.open(filepath, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _stat(self, filepath):
+        st = os.stat(filepath)
+        return [st.st_size, st.st_mtime]
+
+    def get(self, filepath):
+        """
+        Returns the checksum of the file, or None if it was not computed
+        or the file was modified since then.
+        """
+        entry = self.entries.get(os.path.abspath(filepath))
+        if entry is not None and entry[:2] == self._stat(filepath):
+            return entry[2]
+        return None
+
+    def set(self, filepath, checksum):
+        with self.lock:
+            self.entries[os.path.abspath(filepath)] = self._stat(filepath) + [checksum]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.filepath)
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        try:
+            os.rename(tmp_path, self.filepath)
+        except OSError:
+            # rename doesn't replace an existing file on Windows
+            os.remove(self.filepath)
+            os.rename(tmp_path, self.filepath)
+        self.dirty = False
+
+
 class AzureBlobService(object):
     """
     Application interface to access <Azure Blob Storage Service>. A wrapper of
@@ -24,22 +241,57 @@ class AzureBlobService(object):
     """
 
     blob_pattern = 'http://([\w\.]+)/(\w+)/(.*)'
-
-
-    def __init__(self, settings_dict):
+    # The number of threads to transfer blobs
+    nworkers       = settings.AZURE_MAX_WORKERS
+    # How many times to retry a blob failed, waits for `retry_interval`
+    # seconds doubled each time
+    max_retries    = settings.AZURE_MAX_RETRIES
+    retry_interval = 1
+    # The maximum number of copies in progress, and how often (in second)
+    # to poll the status of them
+    copy_window        = settings.AZURE_COPY_WINDOW
+    copy_poll_interval = settings.AZURE_COPY_POLL_INTERVAL
+    # Copies still pending after the time (in second) are aborted
+    copy_timeout       = settings.AZURE_COPY_TIMEOUT
+    # Large files are uploaded in blocks by `block_workers` threads, and
+    # small ones are uploaded `small_file_batch` at a time by a worker
+    block_size       = settings.AZURE_BLOCK_SIZE
+    block_threshold  = settings.AZURE_BLOCK_THRESHOLD
+    block_workers    = settings.AZURE_BLOCK_WORKERS
+    small_file_size  = settings.AZURE_SMALL_FILE_SIZE
+    small_file_batch = settings.AZURE_SMALL_FILE_BATCH
+
+
+    def __init__(self, settings_dict, index_dirname=None):
         # Set settings for azure connections
         self.settings_dict = settings_dict
+        # Directory to cache indexes of containers, disabled if None
+        self.index_dirname = index_dirname
+        self.index_lifetime = settings.AZURE_INDEX_LIFETIME
         self.widgets = [ progressbar.Percentage(), ' ', progressbar.Bar(),
             ' ', progressbar.ETA()]
 
         self.account = settings_dict['ACCOUNT']
         self.host = settings_dict['ACCOUNT']+'.blob.'+settings_dict['ENDPOINT']
         logger.debug("Connectings to '%s'..." % self.host)
-        self.block_blob_service = BlockBlobService(
+        self.block_blob_service = self.get_storage(settings_dict)
+        logger.debug("Connection established.")
+
+    def get_storage(self, settings_dict):
+        """
+        Returns the backend of blob storage, which is `BlockBlobService` of
+        the Azure SDK unless another one was specified by the key 'BACKEND',
+        see `moose.connection.storage`.
+        """
+        backend = settings_dict.get('BACKEND')
+        if backend:
+            storage_cls = import_string(backend)
+            logger.debug("Using blob storage '%s'." % backend)
+            return storage_cls(settings_dict)
+        return BlockBlobService(
             account_name=settings_dict['ACCOUNT'],
             account_key=settings_dict['KEY'],
             endpoint_suffix=settings_dict['ENDPOINT'])
-        logger.debug("Connection established.")
 
     def create_container(self, container_name, set_public=False):
         """
@@ -109,9 +361,65 @@ class AzureBlobService(object):
         return blob_names
 
 
-    def create_blob_from_path(self, container_name, blob_name, filepath):
+    def _get_index_path(self, container_name):
+        return os.path.join(self.index_dirname, '{}-{}.json'.format(self.account, container_name))
+
+    def _is_index_cached(self):
+        return self.index_dirname is not None and self.index_lifetime > 0
+
+    def get_index(self, container_name, refresh=False):
+        """
+        Returns an instance of `ContainerIndex` of all blobs in the container.
+        The index is loaded from the cache if valid unless `refresh` was set.
+        """
+        if self._is_index_cached() and not refresh:
+            index = ContainerIndex.load(
+                self._get_index_path(container_name), self.index_lifetime)
+            if index is not None:
+                logger.debug("Using cached index of [%s]." % container_name)
+                return index
+
+        index = ContainerIndex(container_name)
+        logger.debug("Request to index blobs in container [%s]." % container_name)
+        try:
+            for blob in self.block_blob_service.list_blobs(
+                    container_name, timeout=self.settings_dict['TIMEOUT']):
+                properties = getattr(blob, 'properties', None)
+                index.add(blob.name,
+                          getattr(properties, 'content_length', None),
+                          getattr(properties, 'etag', None),
+                          getattr(getattr(properties, 'content_settings', None), 'content_md5', None))
+        except AzureMissingResourceHttpError as e:
+            logger.error(
+                "The specified container [%s] does not exist." % container_name
+                )
+            return index
+
+        logger.info("%d blobs found on [%s]." % (len(index), container_name))
+        self.save_index(index)
+        return index
+
+    def save_index(self, index):
+        """
+        Writes the index to the cache, if enabled.
+        """
+        if self._is_index_cached():
+            index.save(self._get_index_path(index.container_name))
+
+    def invalidate_index(self, container_name):
+        """
+        Removes the cached index of the container, which is out of date.
+        """
+        if self.index_dirname is None:
+            return
+        filepath = self._get_index_path(container_name)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+    def create_blob_from_path(self, container_name, blob_name, filepath, content_md5=None):
         """
-        Uploads a file to the container.
+        Uploads a file to the container, sets the property `Content-MD5` of
+        the blob if `content_md5` was given.
 
         Returns an instance of `Blob` with properties and metadata.
         """
@@ -119,20 +427,171 @@ class AzureBlobService(object):
             logger.error("File doesn't exist: %s." % filepath)
             return None
         logger.debug("Creates blob '{}'@[{}]".format(blob_name, container_name))
-        blob = self.block_blob_service.create_blob_from_path(
-            container_name, blob_name, filepath)
+        if content_md5 is None:
+            blob = self.block_blob_service.create_blob_from_path(
+                container_name, blob_name, filepath)
+        else:
+            blob = self.block_blob_service.create_blob_from_path(
+                container_name, blob_name, filepath,
+                content_settings=ContentSettings(content_md5=content_md5))
+        return blob
+
+
+    def imap(self, func, tasks):
+        """
+        Calls `func` with each of tasks in a pool of `nworkers` threads,
+        results are generated in the order of completion. Runs in the
+        calling thread if setting DEBUG mode, which makes it easier to trace.
+        """
+        nworkers = min(self.nworkers, len(tasks))
+        if settings.DEBUG or nworkers <= 1:
+            for task in tasks:
+                yield func(task)
+            return
+
+        pool = ThreadPool(nworkers)
+        try:
+            for result in pool.imap_unordered(func, tasks):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def retry(self, func, *args):
+        """
+        Calls `func` until it succeed or retried for `max_retries` times.
+        Returns a tuple of the result, or None if never succeed, and the
+        number of times retried.
+        """
+        for i in range(self.max_retries + 1):
+            try:
+                return func(*args), i
+            except Exception as e:
+                if i == self.max_retries:
+                    logger.error("Failed to call {} with {}: {}".format(func.__name__, args, e))
+                else:
+                    logger.warning("Retry to call {} with {}: {}".format(func.__name__, args, e))
+                    time.sleep(self.retry_interval * 2 ** i)
+        return None, self.max_retries
+
+    def create_blob_from_blocks(self, container_name, blob_name, filepath, content_md5=None):
+        """
+        Uploads a large file in blocks of `block_size` bytes, which are put
+        by `block_workers` threads concurrently and then committed as the
+        blob. Blocks are sliced from the file mapped in memory, therefore
+        only the blocks in transfer are loaded.
+        """
+        blob, _ = self._create_blob_from_blocks(container_name, blob_name, filepath, content_md5)
+        if blob is None:
+            raise IOError("Failed to put blocks of '{}'.".format(blob_name))
         return blob
 
+    def _create_blob_from_blocks(self, container_name, blob_name, filepath, content_md5=None):
+        """
+        Each of blocks and the block list is retried on its own, returns the
+        blob, or None if failed, and the number of times retried.
+        """
+        size = os.path.getsize(filepath)
+        offsets = list(range(0, size, self.block_size))
+        # ids of blocks in a blob must be in the same length
+        block_ids = [force_text(base64.b64encode('{:08d}'.format(i).encode('ascii')))
+                     for i in range(len(offsets))]
+        logger.debug("Puts {} blocks of '{}'@[{}]".format(len(offsets), blob_name, container_name))
+
+        with open(filepath, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            def put_block(i):
+                block = mm[offsets[i]:offsets[i] + self.block_size]
+                self.block_blob_service.put_block(container_name, blob_name, block, block_ids[i])
+                return i
+
+            pool = ThreadPool(max(1, min(self.block_workers, len(offsets))))
+            try:
+                results = pool.map(lambda i: self.retry(put_block, i), range(len(offsets)))
+            finally:
+                pool.close()
+                pool.join()
+                mm.close()
+
+        nretries = sum(n for _, n in results)
+        nfailed = sum(1 for i, _ in results if i is None)
+        if nfailed:
+            logger.error("Failed to put {} blocks of '{}'.".format(nfailed, blob_name))
+            return None, nretries
+        content_settings = ContentSettings(content_md5=content_md5) if content_md5 else None
+        blob, n = self.retry(
+            self.block_blob_service.put_block_list,
+            container_name, blob_name, [BlobBlock(id=block_id) for block_id in block_ids],
+            content_settings)
+        return blob, nretries + n
+
+    def _upload_blob(self, task):
+        container_name, blob_name, filepath, md5 = task
+        size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+        args = (container_name, blob_name, filepath) + ((md5, ) if md5 is not None else ())
+
+        start = time.time()
+        if size > self.block_threshold:
+            # retried block by block, never as a whole
+            blob, nretries = self._create_blob_from_blocks(*args)
+        else:
+            blob, nretries = self.retry(self.create_blob_from_path, *args)
+        elapsed = time.time() - start
+        if blob is not None:
+            logger.debug("Uploaded '{}' ({} bytes) in {:.3f}s, {:.1f} KB/s.".format(
+                blob_name, size, elapsed, size / 1024.0 / max(elapsed, 1e-6)))
+        return blob_name, filepath, blob is not None, nretries, size, elapsed
+
+    def _upload_batch(self, tasks):
+        return [self._upload_blob(task) for task in tasks]
 
-    def upload(self, container_name, blob_pairs, overwrite=False):
+    def batch_tasks(self, tasks):
+        """
+        Groups small files in batches of `small_file_batch`, which saves the
+        overhead of scheduling each of them. Large files are scheduled first
+        to avoid a long tail.
+        """
+        small, large = [], []
+        for task in tasks:
+            filepath = task[2]
+            size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
+            (small if size <= self.small_file_size else large).append(task)
+        batch_size = max(1, self.small_file_batch)
+        return [[task] for task in large] + \
+            [small[i:i + batch_size] for i in range(0, len(small), batch_size)]
+
+    def upload(self, container_name, blob_pairs, overwrite=False, journal=None,
+               stats=None, index=None, checksums=None):
         """
         Uploads files to the container on Azure. Note that 'blob_name' uploaded
         will be converted to posix-style names, which means sep for path is
-        '/'.
+        '/'. Files are uploaded by `nworkers` threads, and a file is retried
+        for `max_retries` times if failed.
 
         `blob_pairs`
             A tuple consists of 2 elements, blob_name and its filepath on local
             filesystem.
+
+        `journal`
+            An instance of `UploadJournal`, files recorded in which are
+            skipped and files uploaded are recorded. It's removed if all
+            files were uploaded, otherwise kept to resume in the next time.
+
+        `stats`
+            A stats collector to count files skipped, retried and failed,
+            bytes uploaded and the range of throughput (in byte per second)
+            of files.
+
+        `index`
+            The `ContainerIndex` of the container if gotten before, blobs
+            uploaded are added to it.
+
+        `checksums`
+            A dict maps blob names to Content-MD5 to set for the blobs.
         """
 
         if not self.block_blob_service.exists(container_name):
@@ -141,20 +600,118 @@ class AzureBlobService(object):
                 "creating now." % container_name)
             self.create_container(container_name, set_public=True)
 
-        blobs = []
-        blobs_in_container = self.list_blobs(container_name)
-        for blob_name, filepath in progressbar.progressbar(\
-                                    blob_pairs, widgets=self.widgets):
+        # blobs in the container are not checked if overwriting
+        if index is None and not overwrite:
+            index = self.get_index(container_name)
+        tasks = []
+        for blob_name, filepath in blob_pairs:
             posix_blob_name = ppath(blob_name)
-            if overwrite or (posix_blob_name not in blobs_in_container):
-                self.create_blob_from_path(
-                    container_name, posix_blob_name, filepath)
-                blobs.append(posix_blob_name)
-
-        logger.info("Uploaded %d files to [%s]." % (len(blobs), container_name))
+            if (not overwrite and posix_blob_name in index) or \
+                    (journal is not None and journal.is_done(posix_blob_name, filepath)):
+                continue
+            md5 = checksums.get(posix_blob_name) if checksums else None
+            tasks.append((container_name, posix_blob_name, filepath, md5))
+        if stats is not None:
+            stats.inc_value("upload/skipped", len(blob_pairs) - len(tasks))
+
+        blobs, failed = [], []
+        started = time.time()
+        bar = progressbar.ProgressBar(max_value=len(tasks), widgets=self.widgets)
+        bar.start()
+        results = (result for batch in self.imap(self._upload_batch, self.batch_tasks(tasks))
+                   for result in batch)
+        for blob_name, filepath, succeed, nretries, size, elapsed in results:
+            bar.update(len(blobs) + len(failed) + 1)
+            if stats is not None:
+                stats.inc_value("upload/retry", nretries)
+            if succeed:
+                if stats is not None:
+                    throughput = size / max(elapsed, 1e-6)
+                    stats.inc_value("upload/bytes", size)
+                    stats.max_value("upload/max_throughput", throughput)
+                    stats.min_value("upload/min_throughput", throughput)
+                blobs.append(blob_name)
+                if index is not None:
+                    size = os.path.getsize(filepath) if os.path.exists(filepath) else None
+                    index.add(blob_name, size,
+                              content_md5=checksums.get(blob_name) if checksums else None)
+                if journal is not None:
+                    journal.record(blob_name, filepath)
+            else:
+                failed.append(blob_name)
+
+        if failed:
+            logger.error("Failed to upload %d files to [%s]." % (len(failed), container_name))
+            if stats is not None:
+                stats.inc_value("upload/failed", len(failed))
+        elif journal is not None:
+            journal.remove()
+        if blobs and index is not None:
+            self.save_index(index)
+        elif blobs:
+            self.invalidate_index(container_name)
+        bar.finish()
+
+        logger.info("Uploaded %d files to [%s] in %.1fs." % (
+            len(blobs), container_name, time.time() - started))
         return blobs
 
 
+    def _hash_file(self, task):
+        blob_name, filepath = task
+        return blob_name, filepath, content_md5(filepath)
+
+    def sync(self, container_name, blob_pairs, cache=None, journal=None, stats=None, index=None):
+        """
+        Uploads files new or changed only, like `rsync`. A file is changed
+        if its size or md5 differs from the blob, and blobs uploaded are set
+        the property `Content-MD5` to compare in the next time.
+
+        `cache`
+            An instance of `ChecksumCache`, files not modified since hashed
+            are not read again.
+
+        Other arguments are the same as `upload()`.
+        """
+        if index is None:
+            index = self.get_index(container_name)
+
+        checksums, to_hash = {}, []
+        for blob_name, filepath in blob_pairs:
+            posix_blob_name = ppath(blob_name)
+            if not os.path.exists(filepath):
+                continue
+            md5 = cache.get(filepath) if cache is not None else None
+            if md5 is None:
+                to_hash.append((posix_blob_name, filepath))
+            else:
+                checksums[posix_blob_name] = md5
+
+        # files are hashed concurrently, hashlib releases the GIL
+        logger.info("Hashing %d files..." % len(to_hash))
+        for blob_name, filepath, md5 in self.imap(self._hash_file, to_hash):
+            checksums[blob_name] = md5
+            if cache is not None:
+                cache.set(filepath, md5)
+        if cache is not None:
+            cache.save()
+
+        changed = []
+        for blob_name, filepath in blob_pairs:
+            posix_blob_name = ppath(blob_name)
+            if posix_blob_name in index and os.path.exists(filepath) and \
+                    index.get_size(posix_blob_name) == os.path.getsize(filepath) and \
+                    index.get_content_md5(posix_blob_name) == checksums[posix_blob_name]:
+                continue
+            changed.append((posix_blob_name, filepath))
+
+        if stats is not None:
+            stats.inc_value("upload/hashed", len(to_hash))
+            stats.inc_value("upload/unchanged", len(blob_pairs) - len(changed))
+        logger.info("%d of %d files were changed." % (len(changed), len(blob_pairs)))
+        return self.upload(container_name, changed, overwrite=True, journal=journal,
+                           stats=stats, index=index, checksums=checksums)
+
     def get_blob_to_path(self, container_name, blob_name, filepath):
         """
         Gets a blob from the container. The filepath would be returned if gotten
@@ -172,21 +729,24 @@ class AzureBlobService(object):
         return blob
 
 
-    def download(self, container_name, dest, blob_names=None):
+    def download(self, container_name, dest, blob_names=None, index=None):
         """
         Get blobs from the container to the `dest` directory.
+
+        `index`
+            The `ContainerIndex` of the container if gotten before.
         """
         blobs = []
 
         if not self.block_blob_service.exists(container_name):
             logger.error("Container [%s] does not exist, aborted." % container_name)
             return blobs
-        # Get the list of blobs and then do comparision would be much more efficient
-        blobs_in_container = self.list_blobs(container_name)
+        # Get the index of blobs and then do comparision would be much more efficient
+        blobs_in_container = index if index is not None else self.get_index(container_name)
 
         # Get all blobs if blob_names was not specified
         if not blob_names:
-            blob_names = blobs_in_container
+            blob_names = blobs_in_container.names
 
         for blob_name in progressbar.progressbar(\
                             blob_names, widgets=self.widgets):
@@ -240,12 +800,48 @@ class AzureBlobService(object):
                 logger.warning(
                     "The sepcified blob '%s' on [%s] does not exist." % (blob_name, container_name))
 
+        self.invalidate_index(container_name)
         return blobs
 
 
-    def copy_blobs(self, blob_names, container_name, src_container=None, pattern=None):
+    def _start_copy(self, task):
+        container_name, blob_name, copy_source = task
+        try:
+            copy = self.block_blob_service.copy_blob(container_name, blob_name, copy_source)
+        except Exception as e:
+            logger.warning("Failed to copy '{}': {}".format(copy_source, e))
+            return task, 'failed', None
+        return task, getattr(copy, 'status', None), getattr(copy, 'id', None)
+
+    def _poll_copy(self, task):
+        """
+        Returns the task and the status of the copy to its blob, which is
+        still pending if failed to get.
+        """
+        container_name, blob_name, _ = task
+        try:
+            blob = self.block_blob_service.get_blob_properties(
+                container_name, blob_name, timeout=self.settings_dict['TIMEOUT'])
+        except Exception as e:
+            logger.warning("Failed to poll the copy to '{}': {}".format(blob_name, e))
+            return task, 'pending'
+        return task, blob.properties.copy.status
+
+    def _abort_copy(self, task, copy_id):
+        container_name, blob_name, _ = task
+        try:
+            self.block_blob_service.abort_copy_blob(container_name, blob_name, copy_id)
+        except Exception as e:
+            logger.warning("Failed to abort the copy to '{}': {}".format(blob_name, e))
+
+    def copy_blobs(self, blob_names, container_name, src_container=None, pattern=None,
+                   index=None, stats=None):
         """
-        Copy blobs listed in `blob_names` to the dest container.
+        Copy blobs listed in `blob_names` to the dest container. Copies are
+        started by `nworkers` threads with at most `copy_window` of them in
+        progress, whose status is polled every `copy_poll_interval` seconds.
+        Copies failed are started again for `max_retries` times, and those
+        still pending after `copy_timeout` seconds are aborted as failed.
 
         `src_container`
             if src_container was given, blob_names are OK to be relative path
@@ -256,13 +852,19 @@ class AzureBlobService(object):
             copies blobs in the src_container meanwhile matches the pattern to
             dest container.
 
+        `index`
+            The `ContainerIndex` of the src_container if gotten before.
+
+        `stats`
+            A stats collector to count blobs copied, retried and failed.
+
         """
         if blob_names == None:
             if src_container:
-                blobs_in_container = self.list_blobs(src_container)
+                blobs_in_container = index if index is not None else self.get_index(src_container)
                 matchfn = get_matchfn(pattern, True)
                 # gets blobs from the src_container which matches the pattern(with ignorecase)
-                blob_names = filter(lambda x: matchfn(x), blobs_in_container)
+                blob_names = [x for x in blobs_in_container if matchfn(x)]
             else:
                 raise ImproperlyConfigured(
                     "Method `copy_blobs` is ought to be called with "
@@ -279,28 +881,87 @@ class AzureBlobService(object):
                 urls.append(escape_uri_path(blob_name))
             blob_names = urls
 
-        blobs = []
-        logger.info("Will copy {} blobs to [{}].".format(len(blob_names), container_name))
-        for copy_source in progressbar.progressbar(blob_names, widgets=self.widgets):
+        tasks = collections.deque()
+        for copy_source in blob_names:
             r = re.match(self.blob_pattern, copy_source)
             if r:
-                blob_name = r.group(3)
+                tasks.append((container_name, r.group(3), copy_source))
             else:
                 logger.error("Blob name specified must be a url: '{}'.".format(copy_source))
-                continue
 
-            self.block_blob_service.copy_blob(container_name, \
-                                            blob_name, copy_source)
-            logger.debug("Copied '{}' to '{}'.".format(copy_source, blob_name))
-            blobs.append(blob_name)
+        logger.info("Will copy {} blobs to [{}].".format(len(tasks), container_name))
+        started = time.time()
+        bar = progressbar.ProgressBar(max_value=len(tasks), widgets=self.widgets)
+        bar.start()
+        # maps blob names to the task, the time it was started and the copy id
+        pending  = {}
+        attempts = collections.Counter()
+        blobs, failed = [], []
+
+        def settle(task, status, copy_id=None):
+            blob_name = task[1]
+            if status == 'pending':
+                pending.setdefault(blob_name, (task, time.time(), copy_id))
+                return
+            pending.pop(blob_name, None)
+            if status in ('failed', 'aborted'):
+                attempts[blob_name] += 1
+                if attempts[blob_name] <= self.max_retries:
+                    logger.warning("Retry to copy '{}'.".format(task[2]))
+                    tasks.append(task)
+                    return
+                failed.append(blob_name)
+            else:
+                logger.debug("Copied '{}' to '{}'.".format(task[2], blob_name))
+                blobs.append(blob_name)
+            bar.update(len(blobs) + len(failed))
+
+        while tasks or pending:
+            batch = [tasks.popleft() for _ in range(min(len(tasks), self.copy_window - len(pending)))]
+            nattempts = sum(attempts.values())
+            for task, status, copy_id in self.imap(self._start_copy, batch):
+                settle(task, status, copy_id)
+            if not pending:
+                if sum(attempts.values()) > nattempts:
+                    # waits before starting copies failed again
+                    time.sleep(self.retry_interval)
+                continue
 
+            time.sleep(self.copy_poll_interval)
+            polled = [task for task, _, _ in pending.values()]
+            for task, status in self.imap(self._poll_copy, polled):
+                if status != 'pending':
+                    settle(task, status)
+                    continue
+                _, since, copy_id = pending[task[1]]
+                if time.time() - since > self.copy_timeout:
+                    logger.error("Copy to '{}' timed out, aborted.".format(task[1]))
+                    self._abort_copy(task, copy_id)
+                    pending.pop(task[1])
+                    failed.append(task[1])
+                    bar.update(len(blobs) + len(failed))
+        bar.finish()
+        nretries = sum(min(n, self.max_retries) for n in attempts.values())
+
+        elapsed = time.time() - started
+        logger.info(
+            "Copied {} blobs to [{}] in {:.1f}s ({:.1f} blobs/s), {} retried, {} failed.".format(
+                len(blobs), container_name, elapsed, len(blobs) / max(elapsed, 1e-3),
+                nretries, len(failed)))
+        if stats is not None:
+            stats.inc_value("copy/copied", len(blobs))
+            stats.inc_value("copy/retry", nretries)
+            stats.inc_value("copy/failed", len(failed))
+
+        self.invalidate_index(container_name)
         return blobs
 
-    def copy_container(self, src_container, dst_container, pattern=None):
+    def copy_container(self, src_container, dst_container, pattern=None, stats=None):
         """
         Copies blobs in `src_container` meanwhile match the `pattern`.
         """
         # creates container if not exists
         self.create_container(dst_container, set_public=True)
         logger.info("Copy blobs from [{}] to [{}]".format(src_container, dst_container))
-        self.copy_blobs(None, dst_container,src_container=src_container,pattern=pattern)
+        return self.copy_blobs(None, dst_container, src_container=src_container,
+                               pattern=pattern, stats=stats)
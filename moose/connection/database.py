@@ -6,34 +6,77 @@
 import sys
 import time
 import random
+from contextlib import contextmanager
 
 from pymongo import MongoClient, errors
 from moose.core.exceptions import ConnectionTimeout, ImproperlyConfigured
+from . import pool
 
 import logging
 logger = logging.getLogger(__name__)
 
 MAX_INTERVAL = 500
 RETRY_TIME = 3
+# The number of rows fetched from the server at a time by `iter_query()`
+BATCH_SIZE = 1000
+
+class ConnectionRefused(ConnectionTimeout):
+    """
+    Raised by the pool when no connection could be established in
+    `RETRY_TIME` attempts, tells `connection()` to wait and try again.
+    """
+    pass
 
 class BaseSQLHandler(object):
     """
-    Interface class for all SQL database opreations.
+    Interface class for all SQL database opreations. Connections are
+    borrowed from the pool shared by handlers with the same settings.
     """
     database_name = None
 
     def __init__(self, settings_dict):
         self.settings_dict = settings_dict
         self.host = settings_dict['HOST']
-        self.conn = self.__connect()
+        self.pool = self._get_pool()
+
+    def _get_pool(self):
+        return pool.get_pool(
+            self.__class__, self.settings_dict,
+            connect=self._try_connect, ping=self.ping, reset=self.reset)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool during the block. If the database
+        is unreachable, waits a random interval and tries again until it
+        succeed, the place in the pool is given back while waiting.
+        """
+        while True:
+            if self.pool.closed:
+                self.pool = self._get_pool()
+            borrowed_from = self.pool
+            try:
+                conn = borrowed_from.acquire()
+                break
+            except ConnectionRefused:
+                self._wait()
+        try:
+            yield conn
+        finally:
+            borrowed_from.release(conn)
 
-    def __del__(self):
+    def ping(self, conn):
         try:
-            self.conn.close()
-        except AttributeError as e:
-            logger.debug("No connections established.")
-        else:
-            logger.debug("Connection to %s closed." % self.database_name)
+            cursor = conn.cursor()
+            cursor.execute("select 1")
+            cursor.fetchall()
+        except Exception as e:
+            logger.debug("Connection to %s is broken: %s" % (self.database_name, str(e)))
+            return False
+        return True
+
+    def reset(self, conn):
+        conn.rollback()
 
     # not guaranteed, try to connect in 3 times
     def __connect(self):
@@ -57,38 +100,42 @@ class BaseSQLHandler(object):
             "Subclass of 'BaseSQLHandler' must implement method get_connection().")
 
     def close(self):
-        try:
-            self.conn.close()
-            self.conn = None
-            self.cursor = None
-        except AttributeError as e:
+        if self.pool.closed:
             logger.warning("Connection closed already.")
+        else:
+            self.pool.close()
+
+    def _wait(self):
+        interval = random.randint(0, MAX_INTERVAL)
+        logger.warning("Will try to connect the database in next %ss." % interval)
+        time.sleep(interval)
+
+    # called by the pool, fails fast to give the place back before waiting
+    def _try_connect(self):
+        conn = self.__connect()
+        if not conn:
+            raise ConnectionRefused("Unable to connect to '%s'." % self.host)
+        return conn
 
     # guarantee to return a reliable connection
     def connect(self):
-        while not self.conn:
-            self.conn = self.__connect()
-            if not self.conn:
-                interval = random.randint(0, MAX_INTERVAL)
-                logger.warning("Will try to connect the database in next %ss." % interval)
-                time.sleep(interval)
-            return self.conn
+        conn = self.__connect()
+        while not conn:
+            self._wait()
+            conn = self.__connect()
+        return conn
 
     def exec_query(self, sql_query):
         if not sql_query:
             logger.error("Invalid SQL statement for no content, aborted.")
             return
 
-        if not self.conn:
-            self.conn = self.connect()
-
-        # Get the cursor
-        self.cursor = self.conn.cursor()
-
         try:
-            logger.info("Executing the statement:\n\t'%s'" % sql_query)
-            self.cursor.execute(sql_query)
-            result = self.cursor.fetchall()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                logger.info("Executing the statement:\n\t'%s'" % sql_query)
+                cursor.execute(sql_query)
+                result = cursor.fetchall()
         except Exception as e:
             logger.error(e)
             return
@@ -96,25 +143,50 @@ class BaseSQLHandler(object):
         logger.info("Quering executed successfully.")
         return result
 
+    def iter_query(self, sql_query, batch_size=BATCH_SIZE):
+        """
+        Generates rows of the query lazily, which are fetched from the server
+        `batch_size` by `batch_size` to keep memory bounded. A connection is
+        borrowed for the generator only until it was exhausted or closed.
+        """
+        if not sql_query:
+            logger.error("Invalid SQL statement for no content, aborted.")
+            return
+
+        with self.connection() as conn:
+            logger.info("Executing the statement:\n\t'%s'" % sql_query)
+            for row in self._iter_rows(conn, sql_query, batch_size):
+                yield row
+
+    def _iter_rows(self, conn, sql_query, batch_size):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql_query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     # to add, delete and update
     def exec_commit(self, sql_commit):
         if not sql_commit:
             logger.error("Invalid SQL statement for no content, aborted.")
             return
 
-        if not self.conn:
-            self.conn = self.connect()
-
-        self.cursor = self.conn.cursor()
-
         try:
-            logger.info("Executing the statement:\n\t'%s'." % sql_commit)
-            self.cursor.execute(sql_commit)
-            self.conn.commit()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                logger.info("Executing the statement:\n\t'%s'." % sql_commit)
+                cursor.execute(sql_commit)
+                conn.commit()
         except Exception as e:
             logger.error(e)
             return None
-        naffected =  self.cursor.rowcount
+        naffected =  cursor.rowcount
         logger.info("Commitment executed successfully with '{}' rows affected.".format(naffected))
         return naffected
 
@@ -157,16 +229,13 @@ class SQLServerHandler(BaseSQLHandler):
             logger.error("Invalid SQL statement for no content, aborted.")
             return
 
-        if not self.conn:
-            self.conn = self.connect()
-
-        self.cursor = self.conn.cursor()
-
         # see ref: http://pymssql.org/en/stable/pymssql_examples.html
         try:
-            logger.info("Executing the statement:\n\t'%s'." % sql_commit)
-            self.cursor.executemany(sql_commit, rows)
-            self.conn.commit()
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                logger.info("Executing the statement:\n\t'%s'." % sql_commit)
+                cursor.executemany(sql_commit, rows)
+                conn.commit()
         except Exception as e:
             logger.error(e)
             return
@@ -204,12 +273,33 @@ class MySQLHandler(BaseSQLHandler):
             raise ImproperlyConfigured("Fields missing: {}".format(str(e)))
         return conn
 
+    def _iter_rows(self, conn, sql_query, batch_size):
+        from MySQLdb.cursors import SSCursor
+
+        # The default cursor stores the whole result set in the client,
+        # uses the server-side one instead
+        cursor = conn.cursor(SSCursor)
+        try:
+            cursor.execute(sql_query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
 class PrimitiveMssqlHandler(BaseSQLHandler):
     """
     Uses the primitive mssql instead of BaseSQLHandler when doing insert
     see ref: http://pymssql.org/en/stable/_mssql_examples.html
     """
     database_name = '_mssql'
+    # Limits of a statement inserting multiple rows by `exec_many()`, note
+    # that sql server accepts 1000 rows in a VALUES clause at most
+    bulk_max_rows = 1000
+    bulk_max_size = 1024 * 1024
 
     def get_connection(self, settings_dict):
         import _mssql
@@ -235,6 +325,30 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
             raise ImproperlyConfigured("Fields missing: {}".format(str(e)))
         return conn
 
+    def ping(self, conn):
+        import _mssql
+        try:
+            return conn.connected and conn.execute_scalar("select 1") == 1
+        except _mssql.MssqlDatabaseException as e:
+            logger.debug("Connection to %s is broken: %s" % (self.database_name, str(e)))
+            return False
+
+    def reset(self, conn):
+        # `_mssql` runs in autocommit mode, nothing to roll back
+        pass
+
+    def _iter_rows(self, conn, sql_query, batch_size):
+        # rows are read from the server while iterating the connection
+        conn.execute_query(sql_query)
+        completed = False
+        try:
+            for row in conn:
+                yield row
+            completed = True
+        finally:
+            if not completed:
+                # discards rows pending before the connection is reused
+                conn.cancel()
 
     def exec_commit(self, sql_commit):
         import _mssql
@@ -242,12 +356,10 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
             logger.error("Invalid SQL statement for no content, aborted.")
             return False
 
-        if not self.conn:
-            self.conn = self.connect()
-
         try:
             logger.info("Executing the statement:\n\t'%s'." % sql_commit)
-            self.conn.execute_non_query(sql_commit)
+            with self.connection() as conn:
+                conn.execute_non_query(sql_commit)
         except _mssql.MssqlDatabaseException as e:
             if e.number == 2714 and e.severity == 16:
                 # table already existed, so quieten the error
@@ -258,23 +370,52 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
         logger.info("Commitment executed successfully.")
         return
 
+    def iter_batches(self, sql_commit, rows):
+        """
+        Splits rows into multi-row INSERT statements, each of which has
+        `bulk_max_rows` rows and `bulk_max_size` characters at most.
+        Yields pairs of the statement and the number of rows in it.
+        """
+        insert_op, _, value_op = sql_commit.rpartition('values')
+        insert_op += 'values'
+        values, size = [], len(insert_op)
+        for row in rows:
+            value = value_op % row
+            if values and (len(values) >= self.bulk_max_rows or \
+                    size + len(value) + 1 > self.bulk_max_size):
+                yield insert_op + ','.join(values), len(values)
+                values, size = [], len(insert_op)
+            values.append(value)
+            size += len(value) + 1
+        if values:
+            yield insert_op + ','.join(values), len(values)
+
     def exec_many(self, sql_commit, rows):
+        """
+        Inserts rows in batches within a transaction, all of them are
+        rolled back if any batch failed. Returns the number of rows inserted.
+        """
         import _mssql
         if not sql_commit:
             logger.error("Invalid SQL statement for no content, aborted.")
             return False
 
-        if not self.conn:
-            self.conn = self.connect()
-
+        logger.info("Executing the statement:\n\t'%s' in batches." % sql_commit)
+        nrows = 0
         try:
-            logger.info("Executing the statement:\n\t'%s' with %d rows." % (sql_commit, len(rows)))
-            insert_op, _, value_op = sql_commit.rpartition('values')
-            insert_op += 'values'
-            for row in rows:
-                insert_op += value_op % row + ','
-            insert_op = insert_op[:-1]
-            self.conn.execute_non_query(insert_op)
+            with self.connection() as conn:
+                conn.execute_non_query("BEGIN TRANSACTION")
+                try:
+                    for i, (statement, nbatch) in enumerate(self.iter_batches(sql_commit, rows)):
+                        start = time.time()
+                        conn.execute_non_query(statement)
+                        nrows += nbatch
+                        logger.info("Batch %d: %d rows (%d characters) inserted in %.3fs." % \
+                            (i, nbatch, len(statement), time.time() - start))
+                    conn.execute_non_query("COMMIT TRANSACTION")
+                except:
+                    conn.execute_non_query("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+                    raise
         except _mssql.MssqlDatabaseException as e:
             if e.number == 2714 and e.severity == 16:
                 # table already existed, so quieten the error
@@ -282,8 +423,8 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
             else:
                 raise # re-raise real error
 
-        logger.info("Commitment executed successfully.")
-        return
+        logger.info("Commitment executed successfully with %d rows inserted." % nrows)
+        return nrows
 
 
 class MongoDBHandler(object):
@@ -336,10 +477,10 @@ class MongoDBHandler(object):
         self.db_name = db_name
         self.db = self.client[db_name]
 
-    def fetch(self, coll, cond={}):
+    def fetch(self, coll, cond={}, projection=None):
         try:
             logger.debug("Fetch data from collection [%s] of '%s'." % (coll, self.db_name))
-            for item in self.db[coll].find(cond):
+            for item in self.db[coll].find(cond, projection):
                 yield item
         except errors.ServerSelectionTimeoutError as e:
             logger.warning("Timeout to fetch data from [%s]." % coll)
@@ -350,21 +491,31 @@ class MongoDBHandler(object):
             while count <= RETRY_TIME:
                 try:
                     time.sleep(5)
-                    for item in self.db[coll].find(cond):
+                    for item in self.db[coll].find(cond, projection):
                         yield item
                     break
                 except errors.AutoReconnect as e:
                     count += 1
                     logger.warning("Retry to fetch data from '%s' for %d time(s)." % (self.db_name, count))
 
-    def fetch_source(self, cond={}):
-        for item in self.fetch(self.coll_source, cond):
+    def fetch_source(self, cond={}, projection=None):
+        for item in self.fetch(self.coll_source, cond, projection):
             yield item
 
-    def fetch_result(self, cond={}):
-        for item in self.fetch(self.coll_result, cond):
+    def fetch_result(self, cond={}, projection=None):
+        for item in self.fetch(self.coll_result, cond, projection):
             yield item
 
+    def count(self, coll):
+        """
+        Returns the number of documents in the collection, which is estimated
+        from metadata of the collection if supported.
+        """
+        collection = self.db[coll]
+        if hasattr(collection, 'estimated_document_count'):
+            return collection.estimated_document_count()
+        return collection.count()
+
     def insert(self, coll, document):
         self.db[coll].insert(document)
 
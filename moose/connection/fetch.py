@@ -4,6 +4,7 @@ import logging
 from moose.core.exceptions import ImproperlyConfigured
 from moose.utils.module_loading import import_string
 from moose.utils import six
+from moose.utils.datautils import ichunk
 from . import query, database
 
 import logging
@@ -26,6 +27,12 @@ class BaseFetcher(object):
         - mongo_handler: Subclass of MongoDBHandler to connect mongodb;
         - mongo_context: A dict to represent configs for mongo connections;
     """
+    # The number of guid pairs to look up in mongodb at a time
+    chunk_size = 1000
+    # Scans the whole collection instead of looking up guids if the sql
+    # queryset covers more than the ratio of documents in the collection
+    full_scan_ratio = 0.5
+
     def __init__(self, query_cls, context):
         self.sql_handler = self.__load_or_import(context['sql_handler'], \
                                 database.BaseSQLHandler, context['sql_context'])
@@ -63,81 +70,180 @@ class BaseFetcher(object):
     def _indexing(self, records, key='_guid'):
         return {r[key]: r for r in records}
 
-    def fetch(self, **context):
+    def _lookup(self, fetch_fn, guids, projection=None, key='_guid'):
+        """
+        Gets documents whose `key` is in `guids` only, returns a dict indexed
+        by the key.
+        """
+        return self._indexing(fetch_fn({key: {'$in': guids}}, projection), key)
+
+    def count_documents(self):
+        """
+        Returns the number of documents in the collection to be scanned.
+        """
+        return self.mongodb.count(self.mongodb.coll_result)
+
+    def get_scan(self):
+        """
+        Returns the function to scan the collection counted by
+        `count_documents()`, and the index of its guids in pairs.
+        """
+        return self.mongodb.fetch_result, 1
+
+    def is_selective(self, queryset):
+        """
+        Returns True if the queryset selects only a small part of documents,
+        which makes looking up guids with `$in` much cheaper than a scan.
+        """
+        try:
+            nselected = len(queryset)
+        except TypeError:
+            # size of an iterator is unknown, assumes it was selective
+            return True
+        ndocuments = self.count_documents()
+        return nselected <= ndocuments * self.full_scan_ratio
+
+    def fetch(self, projection=None, **context):
+        return list(self.iter_fetch(projection, **context))
+
+    def iter_fetch(self, projection=None, **context):
+        """
+        Generates records matched in table source and result lazily. Pairs of
+        guid in the sql queryset are handled `chunk_size` by `chunk_size`,
+        therefore only documents in a chunk are kept in memory. Falls back
+        to scan the collection if the queryset is not selective.
+
+        `projection`
+            A dict maps 'source' and 'result' to a list of properties to be
+            fetched, fetches whole documents if it was None.
+        """
         project_id = str(context['project_id'])
+        self.mongodb.set_database(project_id)
 
         # get sql queryset
         queryset = self.querier.query(**context)
 
-        # get mongo result
-        source_records = self._indexing(self._fetch_source(project_id))
-        result_records = self._indexing(self._fetch_result(project_id))
-
-        # match records in table source and result
-        records = []
-        for source_guid, result_guid in queryset:
-            if result_records.get(str(result_guid)):
-                records.append({
+        if not self.is_selective(queryset):
+            logger.info("Queryset covers most of the collection, scans it instead.")
+            for record in self.iter_scan(queryset, projection or {}):
+                yield record
+            return
+
+        for pairs in ichunk(queryset, self.chunk_size):
+            for record in self.join(pairs, self._lookup, projection or {}):
+                yield record
+
+    def iter_scan(self, queryset, projection):
+        """
+        Scans the collection of `get_scan()` once, and joins documents in
+        the queryset `chunk_size` by `chunk_size` as they come, the other
+        collection is looked up for each chunk. Therefore only documents in
+        a chunk are kept in memory, and records are generated in the order
+        of the collection.
+        """
+        fetch_fn, index = self.get_scan()
+        pairs_by_guid = {}
+        for pair in queryset:
+            pairs_by_guid.setdefault(str(pair[index]), []).append(pair)
+
+        def lookup(fn, guids, projection=None, key='_guid'):
+            # documents scanned are not fetched again
+            if fn == fetch_fn:
+                return scanned
+            return self._lookup(fn, guids, projection, key)
+
+        def join_scanned():
+            pairs = [pair for guid in scanned for pair in pairs_by_guid.pop(guid)]
+            return self.join(pairs, lookup, projection)
+
+        scanned = {}
+        for document in fetch_fn({}, projection.get('result' if index else 'source')):
+            if document['_guid'] in pairs_by_guid and document['_guid'] not in scanned:
+                scanned[document['_guid']] = document
+                if len(scanned) >= self.chunk_size:
+                    for record in join_scanned():
+                        yield record
+                    scanned = {}
+        for record in join_scanned():
+            yield record
+
+        # pairs left were not found in the collection
+        for guid in pairs_by_guid:
+            logger.error("Unable to find match {} record for guid: '{}'".format(
+                'result' if index else 'source', guid))
+
+    def join(self, pairs, lookup, projection):
+        """
+        Matches records in table source and result for a chunk of pairs,
+        documents are gotten by `lookup(fetch_fn, guids, projection)`.
+        """
+        source_records = lookup(
+            self.mongodb.fetch_source, [str(source_guid) for source_guid, _ in pairs],
+            projection.get('source'))
+        result_records = lookup(
+            self.mongodb.fetch_result, [str(result_guid) for _, result_guid in pairs],
+            projection.get('result'))
+
+        for source_guid, result_guid in pairs:
+            if not result_records.get(str(result_guid)):
+                logger.error("Unable to find match result record for guid: '%s'" % str(result_guid))
+            elif not source_records.get(str(source_guid)):
+                logger.error("Unable to find match source record for guid: '%s'" % str(source_guid))
+            else:
+                yield {
                     'source': source_records[str(source_guid)],
                     'result': result_records[str(result_guid)],
-                    })
-            else:
-                logger.error("Unable to find match result record for guid: '%s'" % str(result_guid))
-        return records
+                    }
+
 
 class SourceFetcher(BaseFetcher):
 
-    def fetch(self, **context):
-        project_id = str(context['project_id'])
-        # get sql queryset
-        queryset = self.querier.query(**context)
-        # get mongo result
-        source_records = self._indexing(self._fetch_source(project_id))
+    def count_documents(self):
+        return self.mongodb.count(self.mongodb.coll_source)
 
-        records = []
-        for source_guid, _ in queryset:
+    def get_scan(self):
+        return self.mongodb.fetch_source, 0
+
+    def join(self, pairs, lookup, projection):
+        source_records = lookup(
+            self.mongodb.fetch_source, [str(source_guid) for source_guid, _ in pairs],
+            projection.get('source'))
+
+        for source_guid, _ in pairs:
             if source_records.get(str(source_guid)):
-                records.append({
+                yield {
                     'source': source_records[str(source_guid)],
                     'result': {},
-                    })
+                    }
             else:
-                logger.error("Unable to find match source record for guid: '%s'" % str(result_guid))
-        return records
+                logger.error("Unable to find match source record for guid: '%s'" % str(source_guid))
 
 
 class ResultFetcher(BaseFetcher):
 
-    def fetch(self, **context):
-        project_id = str(context['project_id'])
-        # get sql queryset
-        queryset = self.querier.query(**context)
-        # get mongo result
-        result_records = self._indexing(self._fetch_result(project_id))
+    def join(self, pairs, lookup, projection):
+        result_records = lookup(
+            self.mongodb.fetch_result, [str(result_guid) for _, result_guid in pairs],
+            projection.get('result'))
 
-        records = []
-        for _, result_guid in queryset:
+        for _, result_guid in pairs:
             if result_records.get(str(result_guid)):
-                records.append({
+                yield {
                     'source': {},
                     'result': result_records[str(result_guid)],
-                    })
+                    }
             else:
-                logger.error("Unable to find match source record for guid: '%s'" % str(result_guid))
-        return records
+                logger.error("Unable to find match result record for guid: '%s'" % str(result_guid))
 
 
 class AcquisitionFetcher(BaseFetcher):
 
-    def fetch(self, **context):
+    def iter_fetch(self, projection=None, **context):
         project_id = str(context['project_id'])
-        # get mongo result
-        result_records = self._indexing(self._fetch_result(project_id))
-
-        records = []
-        for _, result in result_records.items():
-            records.append({
+        self.mongodb.set_database(project_id)
+        # no sql queryset is needed, streams all documents in table result
+        for result in self.mongodb.fetch_result({}, (projection or {}).get('result')):
+            yield {
                 'source': {},
                 'result': result,
-                })
-        return records
+                }
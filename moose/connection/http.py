@@ -0,0 +1,737 @@
+# -*- coding: utf-8 -*-
+"""
+A download engine keeping connections alive.
+
+`urlopen()` opens a new connection for every file, which pays a TCP (and
+often TLS) handshake each time, though files are mostly fetched from the
+same blob host. `HTTPClient` keeps connections to each host in a pool and
+caches resolved addresses, and reports the latency of requests to the
+stats collector as a histogram. Files are streamed to disk in chunks by
+`HTTPClient.download()`, and resumed with a Range request if a previous
+attempt was interrupted, unless the file was changed meanwhile. `AdaptiveConcurrency` limits downloads in flight
+to a number adjusted by the throughput, latency and errors observed, and
+downloads slower than most of others are hedged with `HedgingPolicy`.
+Proxies set by `http_proxy`, `https_proxy` and `no_proxy` are honored as
+`urlopen()` does, https requests are tunnelled through them.
+"""
+from __future__ import unicode_literals
+
+import os
+import time
+import base64
+import socket
+import math
+import threading
+import collections
+
+from moose.utils.six.moves import http_client, queue
+from moose.utils.six.moves.urllib.parse import urlsplit, unquote
+from moose.utils.six.moves.urllib.request import urlopen, getproxies, proxy_bypass
+from moose.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds (in millisecond) of buckets of the latency histogram
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def record_latency(stats, key, latency):
+    """
+    Counts the latency (in second) in the histogram `key` of the stats
+    collector, a bucket is named by its upper bound, such as
+    'download/latency_ms/le_100', and 'le_inf' for the rest.
+    """
+    ms = latency * 1000
+    for bound in LATENCY_BUCKETS:
+        if ms <= bound:
+            break
+    else:
+        bound = 'inf'
+    stats.inc_value('{}/le_{}'.format(key, bound))
+    stats.inc_value('{}/count'.format(key))
+    stats.inc_value('{}/sum'.format(key), int(ms))
+    stats.max_value('{}/max'.format(key), int(ms))
+
+
+class HTTPError(IOError):
+    """
+    Raised if the server responded with a status code of error.
+    """
+    def __init__(self, url, status, reason):
+        super(HTTPError, self).__init__('HTTP Error {}: {}'.format(status, reason))
+        self.url    = url
+        self.status = status
+        self.reason = reason
+
+
+class IncompleteDownload(IOError):
+    """
+    Raised if the connection was closed before the whole body was received,
+    the part received is kept to be resumed.
+    """
+    def __init__(self, url, received, expected):
+        super(IncompleteDownload, self).__init__(
+            'Incomplete download: {} of {} bytes received'.format(received, expected))
+        self.url      = url
+        self.received = received
+        self.expected = expected
+
+
+class DownloadCancelled(IOError):
+    """
+    Raised if a download was cancelled before completed.
+    """
+    def __init__(self, url):
+        super(DownloadCancelled, self).__init__('Download cancelled: {}'.format(url))
+        self.url = url
+
+
+def get_part_path(filepath):
+    """
+    Returns the path a file is downloaded to before completed.
+    """
+    return filepath + '.part'
+
+
+def get_validator_path(part_path):
+    """
+    Returns the path the validator (ETag or Last-Modified) of the file
+    being downloaded to `part_path` is saved to, which is sent as If-Range
+    to resume the download only if the file is not changed.
+    """
+    return part_path + '.validator'
+
+
+def read_validator(part_path):
+    try:
+        with open(get_validator_path(part_path)) as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def write_validator(part_path, validator):
+    validator_path = get_validator_path(part_path)
+    if validator:
+        with open(validator_path, 'w') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+
+def discard_part(part_path):
+    """
+    Removes the part received and its validator.
+    """
+    for path in (part_path, get_validator_path(part_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class DNSCache(object):
+    """
+    Caches addresses resolved for `ttl` seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl     = ttl
+        self.entries = {}
+        self.lock    = threading.Lock()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        address = infos[0][4][0]
+        with self.lock:
+            self.entries[key] = (address, time.time())
+        return address
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def get_proxy(scheme, host):
+    """
+    Returns the url of the proxy to request the host, which is set by
+    environment variables such as `http_proxy`, or None if not set or the
+    host was excluded by `no_proxy`.
+    """
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return proxy
+
+
+def _create_connection(conn, dns):
+    sock = socket.create_connection(
+        (dns.resolve(conn.host, conn.port), conn.port), conn.timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class _HTTPConnection(http_client.HTTPConnection):
+
+    def __init__(self, host, port, timeout, dns):
+        http_client.HTTPConnection.__init__(self, host, port, timeout=timeout)
+        self.dns = dns
+
+    def connect(self):
+        self.sock = _create_connection(self, self.dns)
+
+
+class _HTTPSConnection(http_client.HTTPSConnection):
+
+    def __init__(self, host, port, timeout, dns):
+        http_client.HTTPSConnection.__init__(self, host, port, timeout=timeout)
+        self.dns = dns
+
+    def connect(self):
+        self.sock = _create_connection(self, self.dns)
+        if self._tunnel_host:
+            # connected to the proxy, which is asked to open a tunnel
+            self._tunnel()
+        # the hostname is still used to verify the certificate
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self._tunnel_host or self.host)
+
+
+class HostPool(object):
+    """
+    Connections idle to a host, at most `maxsize` of them are kept. New
+    connections are opened if all of them are in use, therefore requests
+    are never blocked by the pool. Connections are opened to the `proxy`
+    instead if it was given, which tunnels ones of https.
+    """
+    connection_classes = {
+        'http': _HTTPConnection,
+        'https': _HTTPSConnection,
+    }
+
+    def __init__(self, scheme, host, port, maxsize, timeout, dns, proxy=None):
+        self.scheme  = scheme
+        self.host    = host
+        self.port    = port
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.dns     = dns
+        self.proxy   = urlsplit(proxy) if proxy else None
+        # headers to authenticate to the proxy
+        self.proxy_headers = {}
+        if self.proxy is not None and self.proxy.username:
+            credentials = '{}:{}'.format(
+                unquote(self.proxy.username), unquote(self.proxy.password or ''))
+            self.proxy_headers['Proxy-Authorization'] = \
+                'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        self.idle    = collections.deque()
+        self.lock    = threading.Lock()
+
+    def get(self):
+        """
+        Returns a pair of a connection and whether it was reused.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        conn_cls = self.connection_classes[self.scheme]
+        if self.proxy is None:
+            return conn_cls(self.host, self.port, self.timeout, self.dns), False
+        conn = conn_cls(self.proxy.hostname, self.proxy.port or 80, self.timeout, self.dns)
+        if self.scheme == 'https':
+            conn.set_tunnel(self.host, self.port, self.proxy_headers)
+        return conn, False
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            conns = list(self.idle)
+            self.idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+class Response(object):
+    """
+    A response of the pooled connection, which is returned to the pool
+    once read to the end, or discarded if closed before that.
+    """
+
+    def __init__(self, response, conn, pool):
+        self._response = response
+        self._conn     = conn
+        self._pool     = pool
+        self.status    = response.status
+        self.reason    = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, size=None):
+        data = self._response.read() if size is None else self._response.read(size)
+        if size is None or not data:
+            self._release()
+        return data
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.put(self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            # the rest of the body would be read by the next request
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _URLResponse(object):
+    """
+    Wraps responses of `urlopen()` for schemes not pooled, such as 'file'.
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self.status    = getattr(response, 'code', None) or 200
+        self.reason    = 'OK'
+
+    def getheader(self, name, default=None):
+        return self._response.info().get(name, default)
+
+    def read(self, size=None):
+        return self._response.read() if size is None else self._response.read(size)
+
+    def close(self):
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HTTPClient(object):
+    """
+    Sends requests on connections pooled by hosts.
+
+    `pool_size`
+        The number of connections kept alive for each host.
+
+    `dns_ttl`
+        How long (in second) addresses resolved are cached.
+
+    `stats`
+        A stats collector to record the latency of requests in the
+        histogram 'download/latency_ms', which is the time until the
+        status and headers were received.
+    """
+    latency_key = 'download/latency_ms'
+    chunk_size  = settings.DOWNLOAD_CHUNK_SIZE
+
+    def __init__(self, pool_size=None, timeout=None, dns_ttl=None, stats=None):
+        self.pool_size = pool_size or settings.HTTP_POOL_SIZE
+        self.timeout   = timeout or settings.DEFAULT_TIMEOUT
+        self.dns       = DNSCache(dns_ttl if dns_ttl is not None else settings.DNS_CACHE_TTL)
+        self.stats     = stats
+        self.pools     = {}
+        self.lock      = threading.Lock()
+
+    def get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = HostPool(
+                    scheme, host, port, self.pool_size, self.timeout, self.dns,
+                    get_proxy(scheme, host))
+            return pool
+
+    def request(self, url, headers=None, method='GET', stats=None):
+        """
+        Sends the request and returns the response when its headers were
+        received, raises `HTTPError` if the status was not successful.
+        A connection reused which was closed by the server meanwhile is
+        replaced with a new one.
+        """
+        stats = stats if stats is not None else self.stats
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        started = time.time()
+        if scheme not in HostPool.connection_classes:
+            response = _URLResponse(urlopen(url, timeout=self.timeout))
+        else:
+            response = self._request(parts, method, headers or {})
+        if stats is not None:
+            record_latency(stats, self.latency_key, time.time() - started)
+
+        if response.status >= 400:
+            response.close()
+            raise HTTPError(url, response.status, response.reason)
+        return response
+
+    def _request(self, parts, method, headers):
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        pool = self.get_pool(scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if pool.proxy is not None and scheme == 'http':
+            # the proxy is requested with the absolute url
+            path = '{}://{}{}'.format(scheme, parts.netloc, path)
+            headers = dict(headers)
+            headers.update(pool.proxy_headers)
+
+        while True:
+            conn, reused = pool.get()
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http_client.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # closed by the server when it was idle
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            return Response(response, conn, pool)
+
+    def get(self, url, headers=None, stats=None, cancelled=None):
+        """
+        Returns the whole body of the url.
+
+        `cancelled` is a function called between chunks of `chunk_size`
+        bytes, `DownloadCancelled` is raised if it returned True.
+        """
+        if cancelled is None:
+            with self.request(url, headers, stats=stats) as response:
+                return response.read()
+
+        if cancelled():
+            raise DownloadCancelled(url)
+        chunks = []
+        with self.request(url, headers, stats=stats) as response:
+            length = response.getheader('Content-Length')
+            for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                chunks.append(chunk)
+                if cancelled():
+                    raise DownloadCancelled(url)
+        data = b''.join(chunks)
+        if length is not None and len(data) < int(length):
+            raise IncompleteDownload(url, len(data), int(length))
+        return data
+
+    def download(self, url, filepath, stats=None, part_path=None, cancelled=None):
+        """
+        Streams the url to the file in chunks of `chunk_size` bytes, which
+        is written to a '.part' file first and renamed once completed. If
+        the '.part' file exists, only the rest of it is requested with the
+        validator saved along with it as If-Range, the whole file is sent
+        again if it was changed. The directory of the file must exist.
+        Returns the number of bytes received.
+
+        `cancelled` is a function called between chunks, `DownloadCancelled`
+        is raised if it returned True.
+        """
+        stats = stats if stats is not None else self.stats
+        part_path = part_path or get_part_path(filepath)
+        validator = read_validator(part_path)
+        offset = 0
+        if validator and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator} if offset else None
+        if cancelled is not None and cancelled():
+            raise DownloadCancelled(url)
+        try:
+            response = self.request(url, headers, stats=stats)
+        except HTTPError as e:
+            if not offset or e.status != 416:
+                raise
+            # the range is not satisfiable if the file was changed
+            discard_part(part_path)
+            return self.download(url, filepath, stats, part_path, cancelled)
+
+        with response:
+            if offset and response.status == 206:
+                mode = 'ab'
+                if stats is not None:
+                    stats.inc_value('download/resumed')
+            else:
+                # the range was ignored or the file was changed, the whole
+                # file is sent
+                mode, offset = 'wb', 0
+                etag = response.getheader('ETag')
+                # weak etags can't be used in If-Range
+                if etag and etag.startswith('W/'):
+                    etag = None
+                write_validator(part_path, etag or response.getheader('Last-Modified'))
+            length = response.getheader('Content-Length')
+            received = 0
+            with open(part_path, mode) as f:
+                for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if cancelled is not None and cancelled():
+                        raise DownloadCancelled(url)
+        if stats is not None:
+            stats.inc_value('download/bytes', received)
+        if length is not None and received < int(length):
+            raise IncompleteDownload(url, offset + received, offset + int(length))
+
+        try:
+            os.rename(part_path, filepath)
+        except OSError:
+            # rename doesn't replace an existing file on Windows
+            os.remove(filepath)
+            os.rename(part_path, filepath)
+        write_validator(part_path, None)
+        return received
+
+    def _hedge(self, attempt, delay, stats=None, cancelled=None, discard=None):
+        """
+        Calls `attempt(hedged, cancelled)` in a thread, and again in another
+        one with `hedged` True if it didn't complete in `delay` seconds.
+        Whichever completes first wins and the other one is cancelled, which
+        is cleaned up by `discard(hedged)` if given. The error is raised
+        only if both of them failed.
+        """
+        results = queue.Queue()
+        done = threading.Event()
+
+        def is_cancelled():
+            return done.is_set() or (cancelled is not None and cancelled())
+
+        def run(hedged):
+            try:
+                results.put((hedged, attempt(hedged, is_cancelled), None))
+            except Exception as e:
+                # whatever the loser received is useless
+                if done.is_set() and discard is not None:
+                    discard(hedged)
+                results.put((hedged, None, e))
+
+        def start(hedged):
+            thread = threading.Thread(target=run, args=(hedged, ))
+            thread.daemon = True
+            thread.start()
+
+        start(False)
+        try:
+            hedged, result, error = results.get(timeout=delay)
+        except queue.Empty:
+            if stats is not None:
+                stats.inc_value('download/hedged')
+            start(True)
+            hedged, result, error = results.get()
+            if error is not None:
+                # waits for the other one
+                hedged, result, other_error = results.get()
+                if other_error is None:
+                    error = None
+        done.set()
+
+        if error is not None:
+            raise error
+        if hedged and stats is not None:
+            stats.inc_value('download/hedge_won')
+        return result
+
+    def hedged_download(self, url, filepath, delay, stats=None, cancelled=None):
+        """
+        Downloads the url like `download()`, but sends a duplicate request
+        to another '.part' file if it didn't complete in `delay` seconds.
+        Whichever completes first wins and the other one is cancelled, the
+        error is raised only if both of them failed.
+        """
+        stats = stats if stats is not None else self.stats
+        part_paths = {
+            False: get_part_path(filepath),
+            True: get_part_path(filepath + '.hedge'),
+        }
+
+        def attempt(hedged, is_cancelled):
+            if hedged:
+                discard_part(part_paths[hedged])
+            return self.download(url, filepath, stats, part_paths[hedged], is_cancelled)
+
+        return self._hedge(attempt, delay, stats, cancelled,
+                           discard=lambda hedged: discard_part(part_paths[hedged]))
+
+    def hedged_get(self, url, delay, headers=None, stats=None, cancelled=None):
+        """
+        Returns the whole body of the url like `get()`, but hedged like
+        `hedged_download()`.
+        """
+        stats = stats if stats is not None else self.stats
+
+        def attempt(hedged, is_cancelled):
+            return self.get(url, headers, stats, is_cancelled)
+
+        return self._hedge(attempt, delay, stats, cancelled)
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools.clear()
+        for pool in pools:
+            pool.close()
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the number of requests in flight, which is adjusted AIMD-style
+    each time as many requests as the limit completed: it's halved if any
+    of them failed (including being throttled) or their average latency
+    rose above `latency_tolerance` times the lowest seen, and increased by
+    one unless the throughput dropped below `throughput_tolerance` times
+    the last one, within [`min_limit`, `max_limit`].
+
+    The limit is recorded in 'download/concurrency', and the history of
+    it in 'download/concurrency_history' as pairs of seconds elapsed and
+    the limit if `stats` was given.
+    """
+    backoff = 0.5
+    latency_tolerance = 2.0
+    throughput_tolerance = 0.9
+    # the lowest latency seen is raised by it for each window, so that
+    # a lucky window is forgotten
+    latency_drift = 1.1
+
+    def __init__(self, min_limit, max_limit, initial=None, stats=None):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit     = self.clamp(initial or self.min_limit)
+        self.stats     = stats
+        self.active    = 0
+        self.cond      = threading.Condition()
+        self.started   = time.time()
+        self.history   = []
+        self.base_latency = None
+        self.throughput   = None
+        self.reset_window()
+        self.record()
+
+    def clamp(self, limit):
+        return min(self.max_limit, max(self.min_limit, int(limit)))
+
+    def reset_window(self):
+        self.window_started = time.time()
+        self.ncompleted  = 0
+        self.nfailed     = 0
+        self.latency_sum = 0.0
+
+    def record(self):
+        self.history.append((int(time.time() - self.started), self.limit))
+        if self.stats is not None:
+            self.stats.set_value('download/concurrency', self.limit)
+            self.stats.max_value('download/concurrency_max', self.limit)
+            self.stats.min_value('download/concurrency_min', self.limit)
+            self.stats.set_value('download/concurrency_history', self.history)
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, succeed=True):
+        with self.cond:
+            self.active -= 1
+            self.ncompleted += 1
+            self.latency_sum += latency
+            if not succeed:
+                self.nfailed += 1
+            if self.ncompleted >= self.limit:
+                self.adjust()
+            self.cond.notify_all()
+
+    def adjust(self):
+        elapsed = max(time.time() - self.window_started, 1e-6)
+        latency = self.latency_sum / self.ncompleted
+        throughput = self.ncompleted / elapsed
+        if self.base_latency is None:
+            self.base_latency = latency
+
+        limit = self.limit
+        if self.nfailed or latency > self.base_latency * self.latency_tolerance:
+            limit = self.clamp(limit * self.backoff)
+        elif self.throughput is None or \
+                throughput >= self.throughput * self.throughput_tolerance:
+            limit = self.clamp(limit + 1)
+        self.base_latency = min(latency, self.base_latency * self.latency_drift)
+        self.throughput = throughput
+
+        if limit != self.limit:
+            self.limit = limit
+            self.record()
+        self.reset_window()
+
+
+class HedgingPolicy(object):
+    """
+    Learns the latency of the latest `window` downloads, a download not
+    completed in the `percentile` of them is hedged once `min_samples`
+    latencies were learned.
+    """
+
+    def __init__(self, percentile, min_samples=20, window=1000):
+        self.percentile  = percentile
+        self.min_samples = min_samples
+        self.samples     = collections.deque(maxlen=window)
+        self.lock        = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+
+    def get_delay(self):
+        """
+        Returns seconds to wait before hedging, or None if not learned yet.
+        """
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            samples = sorted(self.samples)
+        index = int(math.ceil(self.percentile / 100.0 * len(samples))) - 1
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the client shared in the process.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient()
+        return _client
@@ -92,6 +92,17 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
         """
         return None
 
+    def _ping(self, conn):
+        try:
+            return conn.connected and conn.execute_scalar("select 1") == 1
+        except _mssql.MssqlDatabaseException as e:
+            stdout.debug("Connection to {} is broken: {}".format(self.db_name, str(e)))
+            return False
+
+    def _reset(self, conn):
+        # `_mssql` runs in autocommit mode, nothing to roll back
+        pass
+
     def exec_query(self, operation):
         # About more details on `execute_query`, see:
         # http://pymssql.org/en/stable/ref/_mssql.html#_mssql.MSSQLConnection.execute_query
@@ -101,6 +112,20 @@ class PrimitiveMssqlHandler(BaseSQLHandler):
 
         return self.execute(operation, _operator)
 
+    def _iter_rows(self, conn, operation, batch_size):
+        # rows are read from the server while iterating the connection, see:
+        # http://pymssql.org/en/stable/_mssql_examples.html#quickstart-usage-of-various-methods
+        conn.execute_query(operation)
+        completed = False
+        try:
+            for row in conn:
+                yield row
+            completed = True
+        finally:
+            if not completed:
+                # discards rows pending before the connection is reused
+                conn.cancel()
+
     def exec_commit(self, operation):
         # About more details on `execute_non_query`, see:
         # http://pymssql.org/en/stable/ref/_mssql.html#_mssql.MSSQLConnection.execute_non_query
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import MySQLdb as mysqldb
+from MySQLdb.cursors import SSCursor
 
 from .sqlhandler import BaseSQLHandler
 from moose.core.terminal import stdout
@@ -34,3 +35,18 @@ class MySQLHandler(BaseSQLHandler):
             stdout.warn(str(e))
             raise ConnectionTimeout
         return conn
+
+    def _iter_rows(self, conn, operation, batch_size):
+        # The default cursor stores the whole result set in the client,
+        # uses the server-side one instead
+        cursor = conn.cursor(SSCursor)
+        try:
+            cursor.execute(operation)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
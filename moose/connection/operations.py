@@ -52,11 +52,24 @@ class BaseOperation(object):
 
 class BaseQuery(BaseOperation):
 
-    def query(self, **context):
+    # The number of rows fetched from the server at a time by `iter()`,
+    # uses `settings.DB_QUERY_BATCH_SIZE` if it was None.
+    batch_size = None
+
+    def get_operation(self, context):
         try:
-            operation = self.operation_template.format(**context)
+            return self.operation_template.format(**context)
         except KeyError as e:
             raise ImproperlyConfigured("Key missing: {}".format(str(e)))
+
+    def iter(self, **context):
+        """
+        Generates rows of the query lazily instead of returning all of them.
+        """
+        return self.handler.iter_query(self.get_operation(context), self.batch_size)
+
+    def query(self, **context):
+        operation = self.get_operation(context)
         # execute the query with context provided
         return self.handler.exec_query(operation)
 
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide pools of connections to sql databases.
+
+Handlers are created by every `create_from_context()`, which used to open a
+new connection each time. Now handlers with the same class and settings
+share a pool, and borrow a connection from it for each operation only.
+"""
+import os
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+from moose.core.exceptions import ConnectionTimeout
+from moose.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of connections to a database.
+
+    `connect`
+        A function to establish a new connection.
+
+    `ping`
+        A function returns False if the connection is not usable any more,
+        called on checkout when the connection was idle for `ping_interval`.
+
+    `reset`
+        A function to restore the state of a connection returned, such as
+        rolling back the uncommitted transaction.
+
+    `max_size`
+        The maximum number of connections opened, checkout is blocked
+        until one was returned if exceeded.
+
+    `idle_timeout`
+        Connections not used for the time (in second) are closed.
+
+    `timeout`
+        How long (in second) to wait for a connection when all of them are
+        in use, raises `ConnectionTimeout` if expired.
+    """
+
+    def __init__(self, connect, ping=None, reset=None, max_size=None,
+                 idle_timeout=None, ping_interval=None, timeout=None):
+        self._connect = connect
+        self._ping    = ping
+        self._reset   = reset
+        self.max_size      = max_size or settings.DB_POOL_MAX_SIZE
+        self.idle_timeout  = idle_timeout if idle_timeout is not None else settings.DB_POOL_IDLE_TIMEOUT
+        self.ping_interval = ping_interval if ping_interval is not None else settings.DB_POOL_PING_INTERVAL
+        self.timeout       = timeout if timeout is not None else settings.DB_POOL_TIMEOUT
+        # pairs of (connection, time returned), the last is the latest
+        self._idle   = collections.deque()
+        # the number of connections opened, either in use or idle
+        self._nconns = 0
+        self._cond   = threading.Condition(threading.Lock())
+        self.closed  = False
+
+    @property
+    def size(self):
+        return self._nconns
+
+    @property
+    def nidle(self):
+        return len(self._idle)
+
+    def _close_conn(self, conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug("Failed to close the connection: %s" % str(e))
+
+    def _discard(self, conn):
+        self._close_conn(conn)
+        with self._cond:
+            self._nconns -= 1
+            self._cond.notify()
+
+    def _prune(self):
+        """
+        Pops connections idle for too long, must be called with the lock held.
+        """
+        stale = []
+        deadline = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < deadline:
+            stale.append(self._idle.popleft()[0])
+        self._nconns -= len(stale)
+        return stale
+
+    def _checkout(self):
+        """
+        Returns a pair of an idle connection and the time it was returned,
+        or (None, None) if a new connection is allowed to be opened.
+        """
+        deadline = time.time() + self.timeout
+        stale = []
+        try:
+            with self._cond:
+                if self.closed:
+                    raise ConnectionTimeout("Connection pool was closed.")
+                stale = self._prune()
+                while True:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._nconns < self.max_size:
+                        # reserves the place for the new connection
+                        self._nconns += 1
+                        return None, None
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionTimeout(
+                            "All of {} connections are in use.".format(self.max_size))
+                    self._cond.wait(remaining)
+        finally:
+            for conn in stale:
+                self._close_conn(conn)
+
+    def acquire(self):
+        """
+        Borrows a connection, which must be returned by `release()` later.
+        """
+        while True:
+            conn, returned = self._checkout()
+            if conn is None:
+                break
+            if self._ping is None or time.time() - returned < self.ping_interval \
+                    or self._ping(conn):
+                return conn
+            logger.warning("Connection is broken, discards it.")
+            self._discard(conn)
+
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._nconns -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        """
+        Returns the connection borrowed to the pool.
+        """
+        if self._reset is not None:
+            try:
+                self._reset(conn)
+            except Exception as e:
+                logger.warning("Failed to reset the connection: %s" % str(e))
+                self._discard(conn)
+                return
+
+        with self._cond:
+            if not self.closed:
+                self._idle.append((conn, time.time()))
+                self._cond.notify()
+                return
+            self._nconns -= 1
+        # the pool was closed when the connection was in use
+        self._close_conn(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes connections idle, the ones in use are closed when returned.
+        """
+        with self._cond:
+            self.closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._nconns -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_conn(conn)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+_pools = {}
+_lock  = threading.Lock()
+
+def get_pool(handler_cls, settings_dict, **kwargs):
+    """
+    Returns the pool shared by handlers of `handler_cls` with the same
+    settings, creates it with `kwargs` if not existed. Pools are not shared
+    with forked processes, since a connection can't be used by processes
+    at the same time.
+    """
+    key = (os.getpid(), handler_cls.__module__, handler_cls.__name__, _freeze(settings_dict))
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None or pool.closed:
+            pool = _pools[key] = ConnectionPool(**kwargs)
+        return pool
+
+def close_all():
+    """
+    Closes all pools in the current process.
+    """
+    pid = os.getpid()
+    with _lock:
+        keys = [key for key in _pools if key[0] == pid]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.close()
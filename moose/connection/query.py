@@ -48,12 +48,24 @@ class SQLOperation(object):
 
 class BaseQuery(SQLOperation):
 
-    def query(self, **context):
+    # The number of rows fetched from the server at a time by `iter()`
+    batch_size = database.BATCH_SIZE
+
+    def get_statement(self, context):
         try:
             context.update(self.table_alias)
-            sql_statement = self.statement_template.format(**context)
+            return self.statement_template.format(**context)
         except KeyError as e:
             raise ImproperlyConfigured("Keys missing: {}".format(str(e)))
+
+    def iter(self, **context):
+        """
+        Generates rows of the query lazily instead of returning all of them.
+        """
+        return self.handler.iter_query(self.get_statement(context), self.batch_size)
+
+    def query(self, **context):
+        sql_statement = self.get_statement(context)
         # execute the query with context provided
         return self.handler.exec_query(sql_statement)
 
@@ -113,6 +125,19 @@ class AccessedTimeGuidQuery(AllGuidQuery):
         "dr.ProjectId = {project_id} and dr.LastEditTime {less_or_more} '{datetime}'"
     )
 
+def edited_query(query_cls):
+    """
+    Returns a guid query selecting records of `query_cls` which were
+    accessed before or after the given datetime, like `AccessedTimeGuidQuery`.
+    The clause is formatted with `edited_less_or_more` and `edited_datetime`,
+    which never overwrite arguments of `query_cls` with the same meaning,
+    such as those of `CreatedTimeGuidQuery`.
+    """
+    return type(str('Edited' + query_cls.__name__), (query_cls, ), {
+        'conditions': "{} and dr.LastEditTime {{edited_less_or_more}} '{{edited_datetime}}'".format(
+            query_cls.conditions),
+        })
+
 class AccountGuidQuery(BaseGuidQuery):
     """
     Get records annotated by specified accounts.
@@ -8,11 +8,14 @@ import sys
 import time
 import random
 import string
+import threading
+from contextlib import contextmanager
 
 from moose.core.terminal import stdout
 from moose.core.exceptions import \
     ConnectionTimeout, SuspiciousOperation, ImproperlyConfigured
 from moose.conf import settings
+from . import pool
 
 import logging
 logger = logging.getLogger(__name__)
@@ -27,6 +30,8 @@ class BaseSQLHandler(object):
     to provide a uniform interface, different drivers were wrapped. Therefore,
     if the python module was writen as `PEP-249`, the `BaseSQLHandler` has
     already implemented almost all features need.
+    Handlers don't own connections but borrow one from the pool shared by
+    handlers with the same class and settings for each operation.
     """
     db_name = None
     table_alias_name   = "TABLE_ALIAS"
@@ -38,7 +43,12 @@ class BaseSQLHandler(object):
                 "which must be an instance of `dict`.")
 
         self.settings_dict = settings_dict
-        self._conn = self.get_connection(settings_dict)
+        # connections borrowed by threads, see `_conn`
+        self._local = threading.local()
+        self._pool  = self._get_pool()
+        # checks the settings and warms up the pool
+        with self._borrow():
+            pass
 
         if settings_dict.get(self.table_alias_name):
             self._table_alias = settings_dict[self.table_alias_name]
@@ -49,6 +59,41 @@ class BaseSQLHandler(object):
 
         self._cursor = None
 
+    def _get_pool(self):
+        return pool.get_pool(
+            self.__class__, self.settings_dict,
+            connect=lambda: self.get_connection(self.settings_dict),
+            ping=self._ping, reset=self._reset)
+
+    @property
+    def _conn(self):
+        """
+        The connection borrowed by the current thread, it's None outside
+        of an operation.
+        """
+        return getattr(self._local, 'conn', None)
+
+    @contextmanager
+    def _borrow(self):
+        """
+        Borrows a connection from the pool as `_conn` during the block.
+        """
+        if self._conn is not None:
+            # nested operations share the connection
+            yield self._conn
+            return
+
+        if self._pool.closed:
+            self._pool = self._get_pool()
+        self._local.conn = self._pool.acquire()
+        try:
+            yield self._local.conn
+        finally:
+            conn, self._local.conn = self._local.conn, None
+            # unless released by `close()` during the block
+            if conn is not None:
+                self._pool.release(conn)
+
     def get_connection(self, settings_dict):
         if settings_dict.get('HOST') and settings_dict.get('PORT'):
             stdout.debug(
@@ -85,23 +130,41 @@ class BaseSQLHandler(object):
         """
         raise NotImplementedError("Subclass of 'BaseSQLHandler' must provide method _connect().")
 
+    def _ping(self, conn):
+        """
+        Entry for subclass to check if the connection is still usable.
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute("select 1")
+            cursor.fetchall()
+        except Exception as e:
+            stdout.debug("Connection to {} is broken: {}".format(self.db_name, str(e)))
+            return False
+        return True
+
+    def _reset(self, conn):
+        """
+        Entry for subclass to clean up the connection returned to the pool,
+        rolls back the transaction uncommitted by default.
+        """
+        conn.rollback()
+
     def close(self):
+        """
+        Returns the connection borrowed by the current thread to the pool.
+        The pool is shared by handlers with the same settings, which may be
+        still in use by others, so it's closed by `pool.close_all()` only.
+        """
         stdout.debug("Closing connection to {}.".format(self.db_name))
-        try:
-            self._close()
-        except AttributeError as e:
+        conn, self._local.conn = self._conn, None
+        self._cursor = None
+        if conn is None:
             stdout.debug("Connection was closed already.")
         else:
-            self._conn = None
-            self._cursor = None
+            self._pool.release(conn)
             stdout.debug("Connection closed.")
 
-    def _close(self):
-        """
-        Entry for subclass to define closing connection method.
-        """
-        self._conn.close()
-
     def _get_cursor(self):
         """
         Entry for subclass to provide the cursor of connection.
@@ -114,10 +177,11 @@ class BaseSQLHandler(object):
             raise SuspiciousOperation
 
         try:
-            cursor = self._get_cursor()
-            operation = string.Template(operation).substitute(self._table_alias)
-            stdout.info("Executing the operation:\n\t'{}'.".format(operation))
-            result = operator(cursor, operation, *args)
+            with self._borrow():
+                cursor = self._get_cursor()
+                operation = string.Template(operation).substitute(self._table_alias)
+                stdout.info("Executing the operation:\n\t'{}'.".format(operation))
+                result = operator(cursor, operation, *args)
         # TODO: defines more detailed errors
         except Exception as e:
             stdout.error("Operation failed: '{}'.".format(str(e)))
@@ -139,6 +203,48 @@ class BaseSQLHandler(object):
 
         return self.execute(operation, _operator)
 
+    def iter_query(self, operation, batch_size=None):
+        """
+        Generates rows of the query operation lazily, which are fetched from
+        the server `batch_size` by `batch_size`, so that memory is bounded
+        however large the result set is. A connection is borrowed for the
+        generator only until it was exhausted or closed.
+        """
+        if not operation:
+            stdout.error("No operation specified.")
+            raise SuspiciousOperation
+
+        batch_size = batch_size or settings.DB_QUERY_BATCH_SIZE
+        operation = string.Template(operation).substitute(self._table_alias)
+        if self._pool.closed:
+            self._pool = self._get_pool()
+        # not shared with the thread by `_borrow()`, operations executed
+        # during the iteration mustn't interrupt the result set
+        with self._pool.connection() as conn:
+            stdout.info("Executing the operation:\n\t'{}'.".format(operation))
+            try:
+                for row in self._iter_rows(conn, operation, batch_size):
+                    yield row
+            except Exception as e:
+                stdout.error("Operation failed: '{}'.".format(str(e)))
+                raise
+
+    def _iter_rows(self, conn, operation, batch_size):
+        """
+        Entry for subclass to generate rows of the operation from the
+        connection.
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute(operation)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
 
     def exec_commit(self, operation):
         """
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Backends of blob storage used by `AzureBlobService`.
+
+`BaseBlobStorage` declares the part of `BlockBlobService` that
+`AzureBlobService` relies on, with the same signatures, models and
+exceptions, so that a backend can take the place of the Azure SDK. It's
+selected by the key 'BACKEND' in `settings.AZURE`, for example:
+
+    AZURE = {
+        'ACCOUNT': 'local',
+        'ENDPOINT': 'localhost',
+        'TIMEOUT': 300,
+        'BACKEND': 'moose.connection.storage.LocalBlobStorage',
+        'ROOT': '/data/blobs',
+        'LATENCY': 0.05,
+        'BANDWIDTH': 10 * 1024 ** 2,
+    }
+"""
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import time
+import uuid
+import shutil
+import binascii
+import hashlib
+import base64
+import tempfile
+import datetime
+
+from azure.common import AzureHttpError, AzureConflictHttpError, AzureMissingResourceHttpError
+from azure.storage.blob.models import \
+    Blob, BlobProperties, Container, ContentSettings, CopyProperties, ResourceProperties
+
+from moose.utils.encoding import force_text, force_bytes
+from moose.utils.six.moves.urllib.parse import urlparse, unquote
+from moose.utils._os import makedirs, makeparents, safe_join
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BaseBlobStorage(object):
+    """
+    Interface of blob storage, subclasses are initialized with the dict
+    `settings.AZURE`.
+    """
+
+    def __init__(self, settings_dict):
+        self.settings_dict = settings_dict
+
+    def exists(self, container_name, blob_name=None, timeout=None):
+        raise NotImplementedError
+
+    def create_container(self, container_name, metadata=None, public_access=None,
+                         fail_on_exist=False, timeout=None):
+        raise NotImplementedError
+
+    def list_containers(self, prefix=None, timeout=None):
+        raise NotImplementedError
+
+    def set_container_acl(self, container_name, signed_identifiers=None,
+                          public_access=None, timeout=None):
+        raise NotImplementedError
+
+    def list_blobs(self, container_name, prefix=None, include=None, timeout=None):
+        raise NotImplementedError
+
+    def get_blob_properties(self, container_name, blob_name, timeout=None):
+        raise NotImplementedError
+
+    def create_blob_from_path(self, container_name, blob_name, file_path,
+                              content_settings=None, timeout=None):
+        raise NotImplementedError
+
+    def put_block(self, container_name, blob_name, block, block_id, timeout=None):
+        raise NotImplementedError
+
+    def put_block_list(self, container_name, blob_name, block_list,
+                       content_settings=None, timeout=None):
+        raise NotImplementedError
+
+    def get_blob_to_path(self, container_name, blob_name, file_path, timeout=None):
+        raise NotImplementedError
+
+    def copy_blob(self, container_name, blob_name, copy_source, timeout=None):
+        raise NotImplementedError
+
+    def abort_copy_blob(self, container_name, blob_name, copy_id, timeout=None):
+        raise NotImplementedError
+
+    def delete_blob(self, container_name, blob_name, timeout=None):
+        raise NotImplementedError
+
+
+class LocalBlobStorage(BaseBlobStorage):
+    """
+    Keeps containers as directories under `ROOT` on the local filesystem,
+    which makes it possible to run and measure transfers offline. Every
+    request is delayed for `LATENCY` seconds, and data is transferred at
+    `BANDWIDTH` bytes per second for each connection if set.
+
+    Properties of blobs are kept in the directory '.properties' under
+    `ROOT`, and blocks not committed in '.blocks', which are never listed
+    as containers since names of containers can't start with a dot.
+    """
+    properties_dirname = '.properties'
+    blocks_dirname     = '.blocks'
+    chunk_size = 64 * 1024
+
+    def __init__(self, settings_dict):
+        super(LocalBlobStorage, self).__init__(settings_dict)
+        self.root      = settings_dict['ROOT']
+        self.latency   = settings_dict.get('LATENCY', 0)
+        self.bandwidth = settings_dict.get('BANDWIDTH')
+        makedirs(self.root)
+
+    def _delay(self):
+        """
+        Charges the latency, once per request.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _transfer(self, nbytes):
+        """
+        Charges the time to transfer `nbytes` at the speed of `BANDWIDTH`.
+        """
+        if self.bandwidth and nbytes:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+    def _container_path(self, container_name):
+        return safe_join(self.root, container_name)
+
+    def _blob_path(self, container_name, blob_name):
+        return safe_join(self.root, container_name, blob_name)
+
+    def _properties_path(self, container_name, blob_name):
+        return safe_join(self.root, self.properties_dirname, container_name, blob_name + '.json')
+
+    def _blocks_path(self, container_name, blob_name):
+        return safe_join(self.root, self.blocks_dirname, container_name, blob_name)
+
+    def _check_container(self, container_name):
+        if not os.path.isdir(self._container_path(container_name)):
+            raise AzureMissingResourceHttpError(
+                "The specified container [{}] does not exist.".format(container_name), 404)
+
+    def _check_blob(self, container_name, blob_name):
+        self._check_container(container_name)
+        if not os.path.isfile(self._blob_path(container_name, blob_name)):
+            raise AzureMissingResourceHttpError(
+                "The specified blob '{}' does not exist.".format(blob_name), 404)
+
+    def _get_blob(self, container_name, blob_name):
+        path = self._blob_path(container_name, blob_name)
+        st = os.stat(path)
+        props = BlobProperties()
+        props.blob_type = 'BlockBlob'
+        props.content_length = st.st_size
+        props.last_modified = datetime.datetime.utcfromtimestamp(st.st_mtime)
+        props.etag = '"0x{:X}"'.format(int(st.st_mtime * 1e6))
+        props.copy.status = 'success'
+        try:
+            with io.open(self._properties_path(container_name, blob_name), encoding='utf-8') as f:
+                props.content_settings = ContentSettings(**json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+        return Blob(name=blob_name, props=props)
+
+    def _write(self, srcs, path, md5=None):
+        """
+        Copies streams one after another to the path at the speed of
+        `BANDWIDTH`, the file is replaced only if completed.
+        """
+        makeparents(path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                for src in srcs:
+                    for chunk in iter(lambda: src.read(self.chunk_size), b''):
+                        self._transfer(len(chunk))
+                        if md5 is not None:
+                            md5.update(chunk)
+                        dst.write(chunk)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # rename doesn't replace an existing file on Windows
+                os.remove(path)
+                os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def exists(self, container_name, blob_name=None, timeout=None):
+        self._delay()
+        if blob_name is None:
+            return os.path.isdir(self._container_path(container_name))
+        return os.path.isfile(self._blob_path(container_name, blob_name))
+
+    def create_container(self, container_name, metadata=None, public_access=None,
+                         fail_on_exist=False, timeout=None):
+        self._delay()
+        path = self._container_path(container_name)
+        if os.path.isdir(path):
+            if fail_on_exist:
+                raise AzureConflictHttpError(
+                    "The specified container [{}] already exists.".format(container_name), 409)
+            return False
+        makedirs(path)
+        return True
+
+    def list_containers(self, prefix=None, timeout=None):
+        self._delay()
+        return [Container(name) for name in sorted(os.listdir(self.root))
+                if not name.startswith('.') and os.path.isdir(self._container_path(name))
+                and (not prefix or name.startswith(prefix))]
+
+    def set_container_acl(self, container_name, signed_identifiers=None,
+                          public_access=None, timeout=None):
+        self._delay()
+        self._check_container(container_name)
+        return ResourceProperties()
+
+    def list_blobs(self, container_name, prefix=None, include=None, timeout=None):
+        # copies are completed synchronously, their status is always 'success'
+        self._delay()
+        self._check_container(container_name)
+        container_path = self._container_path(container_name)
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(container_path):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                blob_name = os.path.relpath(
+                    os.path.join(dirpath, filename), container_path).replace(os.sep, '/')
+                if not prefix or blob_name.startswith(prefix):
+                    blobs.append(self._get_blob(container_name, blob_name))
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def get_blob_properties(self, container_name, blob_name, timeout=None):
+        self._delay()
+        self._check_blob(container_name, blob_name)
+        return self._get_blob(container_name, blob_name)
+
+    def _commit(self, container_name, blob_name, content_settings):
+        """
+        Writes properties of the blob written, returns its etag and time
+        modified like Azure.
+        """
+        properties_path = self._properties_path(container_name, blob_name)
+        makeparents(properties_path)
+        with io.open(properties_path, 'w', encoding='utf-8') as f:
+            f.write(force_text(json.dumps(vars(content_settings or ContentSettings()))))
+
+        props = self._get_blob(container_name, blob_name).properties
+        result = ResourceProperties()
+        result.etag, result.last_modified = props.etag, props.last_modified
+        return result
+
+    def create_blob_from_path(self, container_name, blob_name, file_path,
+                              content_settings=None, timeout=None, **kwargs):
+        self._delay()
+        self._check_container(container_name)
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as src:
+            self._write([src], self._blob_path(container_name, blob_name), md5)
+
+        # Content-MD5 is computed if not given, like blobs put at once
+        content_settings = content_settings or ContentSettings()
+        if not content_settings.content_md5:
+            content_settings.content_md5 = force_text(base64.b64encode(md5.digest()))
+        return self._commit(container_name, blob_name, content_settings)
+
+    def put_block(self, container_name, blob_name, block, block_id, timeout=None, **kwargs):
+        self._delay()
+        self._check_container(container_name)
+        # ids are encoded in base64, which may contain '/'
+        path = os.path.join(self._blocks_path(container_name, blob_name),
+                            binascii.hexlify(force_bytes(block_id)).decode('ascii'))
+        self._write([io.BytesIO(block)], path)
+
+    def put_block_list(self, container_name, blob_name, block_list,
+                       content_settings=None, timeout=None, **kwargs):
+        """
+        Concatenates blocks put in the order of `block_list` as the blob,
+        Content-MD5 is not computed, like Azure.
+        """
+        self._delay()
+        self._check_container(container_name)
+        blocks_path = self._blocks_path(container_name, blob_name)
+        paths = [os.path.join(blocks_path, binascii.hexlify(force_bytes(block.id)).decode('ascii'))
+                 for block in block_list]
+        for path in paths:
+            if not os.path.exists(path):
+                raise AzureHttpError("The specified block list is invalid.", 400)
+
+        def iter_blocks():
+            for path in paths:
+                with open(path, 'rb') as f:
+                    yield f
+        self._write(iter_blocks(), self._blob_path(container_name, blob_name))
+        shutil.rmtree(blocks_path)
+        return self._commit(container_name, blob_name, content_settings)
+
+    def get_blob_to_path(self, container_name, blob_name, file_path, timeout=None, **kwargs):
+        self._delay()
+        self._check_blob(container_name, blob_name)
+        with open(self._blob_path(container_name, blob_name), 'rb') as src:
+            self._write([src], file_path)
+        return self._get_blob(container_name, blob_name)
+
+    def copy_blob(self, container_name, blob_name, copy_source, timeout=None, **kwargs):
+        """
+        Copies the blob at the url `copy_source` synchronously, whose path is
+        '/<container>/<blob>'.
+        """
+        self._delay()
+        src_container, src_blob = unquote(urlparse(copy_source).path).lstrip('/').split('/', 1)
+        self._check_blob(src_container, src_blob)
+        self._check_container(container_name)
+        with open(self._blob_path(src_container, src_blob), 'rb') as src:
+            self._write([src], self._blob_path(container_name, blob_name))
+        src_properties = self._properties_path(src_container, src_blob)
+        dst_properties = self._properties_path(container_name, blob_name)
+        if os.path.exists(src_properties) and src_properties != dst_properties:
+            makeparents(dst_properties)
+            shutil.copyfile(src_properties, dst_properties)
+
+        copy = CopyProperties()
+        copy.id = str(uuid.uuid4())
+        copy.source = copy_source
+        copy.status = 'success'
+        return copy
+
+    def abort_copy_blob(self, container_name, blob_name, copy_id, timeout=None, **kwargs):
+        """
+        Copies are completed once started, so there is never one to abort.
+        """
+        self._delay()
+        self._check_blob(container_name, blob_name)
+        raise AzureConflictHttpError("There is currently no pending copy operation.", 409)
+
+    def delete_blob(self, container_name, blob_name, timeout=None, **kwargs):
+        self._delay()
+        self._check_blob(container_name, blob_name)
+        os.remove(self._blob_path(container_name, blob_name))
+        properties_path = self._properties_path(container_name, blob_name)
+        if os.path.exists(properties_path):
+            os.remove(properties_path)
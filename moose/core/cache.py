@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+An on-disk cache for records fetched from databases.
+
+Each entry is a file named by the hash of its key, which starts with a header
+(magic, format version and created time) followed by frames. A frame is a
+chunk of records pickled and compressed with zlib, prefixed with its length,
+therefore entries can be read back as a stream instead of loading the whole.
+
+Entries are written to a temporary file and renamed when completed, readers
+never see a half-written entry. Once the total size of entries exceeds the
+budget, the least recently used ones are removed.
+"""
+import os
+import time
+import zlib
+import struct
+import pickle
+import hashlib
+import tempfile
+
+from moose.utils.encoding import force_bytes
+from moose.utils._os import makedirs
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DataCache(object):
+    """
+    `dirname`
+        Directory to keep entries of cache.
+
+    `lifetime`
+        How long (in hour) an entry is valid since it was created.
+
+    `max_size`
+        The budget (in byte) of the total size of entries.
+
+    `stats`
+        A stats collector to count hits, misses and bytes read or written.
+    """
+    magic   = b'MOOSEDC'
+    # Increases the version when the format changes, entries in an
+    # unknown version are treated as missing
+    version = 1
+    header_format = '>7sBd'
+    frame_format  = '>I'
+    chunk_size    = 1000
+    compress_level = 6
+    tmp_prefix    = '.tmp-'
+
+    def __init__(self, dirname, lifetime, max_size, stats=None):
+        self.dirname  = dirname
+        self.lifetime = lifetime
+        self.max_size = max_size
+        self.stats    = stats
+
+    def _inc(self, key, count=1):
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
+
+    def get_cache_id(self, key):
+        return hashlib.md5(force_bytes(key)).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.dirname, self.get_cache_id(key))
+
+    def _read_header(self, f):
+        header = f.read(struct.calcsize(self.header_format))
+        try:
+            magic, version, created = struct.unpack(self.header_format, header)
+        except struct.error:
+            return None
+        if magic != self.magic or version != self.version:
+            return None
+        return created
+
+    def _is_valid(self, created):
+        return created is not None and \
+            time.time() - created <= self.lifetime * 3600
+
+    def get(self, key):
+        """
+        Returns an iterator of records cached with the key, or None if the
+        entry was missing, expired or written in another version.
+        """
+        path = self.get_path(key)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            self._inc("cache/miss")
+            return None
+
+        if not self._is_valid(self._read_header(f)):
+            f.close()
+            self._inc("cache/miss")
+            return None
+
+        self._inc("cache/hit")
+        # marks the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        logger.warning("Using cached queryset '%s'." % self.get_cache_id(key))
+        return self._iter_frames(f)
+
+    def _iter_frames(self, f):
+        frame_size = struct.calcsize(self.frame_format)
+        try:
+            while True:
+                prefix = f.read(frame_size)
+                if len(prefix) < frame_size:
+                    break
+                length, = struct.unpack(self.frame_format, prefix)
+                data = f.read(length)
+                self._inc("cache/bytes_read", frame_size + length)
+                for record in pickle.loads(zlib.decompress(data)):
+                    yield record
+        finally:
+            f.close()
+
+    def _write_frame(self, f, chunk):
+        data = zlib.compress(pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL), self.compress_level)
+        f.write(struct.pack(self.frame_format, len(data)))
+        f.write(data)
+        self._inc("cache/bytes_written", struct.calcsize(self.frame_format) + len(data))
+
+    def iter_set(self, key, records):
+        """
+        Yields records from the iterable meanwhile writes them to the cache,
+        the entry is committed only if all records were consumed.
+        """
+        makedirs(self.dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=self.dirname, prefix=self.tmp_prefix)
+        completed = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(struct.pack(self.header_format, self.magic, self.version, time.time()))
+                chunk = []
+                for record in records:
+                    chunk.append(record)
+                    if len(chunk) == self.chunk_size:
+                        self._write_frame(f, chunk)
+                        chunk = []
+                    yield record
+                if chunk:
+                    self._write_frame(f, chunk)
+            self._commit(tmp_path, self.get_path(key))
+            completed = True
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict()
+
+    def set(self, key, records):
+        """
+        Writes all records to the cache.
+        """
+        for _ in self.iter_set(key, records):
+            pass
+
+    def _commit(self, tmp_path, path):
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # rename doesn't replace an existing file on Windows
+            os.remove(path)
+            os.rename(tmp_path, path)
+
+    def delete(self, key):
+        path = self.get_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def entries(self):
+        """
+        Returns (mtime, size, path) of committed entries.
+        """
+        entries = []
+        if not os.path.isdir(self.dirname):
+            return entries
+        for name in os.listdir(self.dirname):
+            if name.startswith(self.tmp_prefix):
+                continue
+            path = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size fits
+        the budget.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # in using or removed by another process
+                continue
+            total -= size
+            self._inc("cache/evicted")
+            logger.debug("Evicted cached queryset '%s'." % os.path.basename(path))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Watermark and manifest of incremental exports.
+
+A manifest is kept for each task, it records when the last export started
+(the watermark), and which files were written for every record. The next
+export queries records edited after the watermark only, and removes files
+that a record re-exported doesn't write any more.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+
+from moose.utils._os import makedirs
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ExportManifest(object):
+    """
+    `path`
+        File to load and save the manifest.
+
+    `root`
+        Directory that paths of outputs are relative to.
+    """
+    version = 1
+    datetime_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, path, root):
+        self.path      = path
+        self.root      = root
+        self.watermark = None
+        # maps guid of records to a list of relative paths of outputs
+        self.outputs   = {}
+        # outputs written in this run, which replace ones recorded
+        self.updated   = {}
+        self.started   = time.time()
+        self.lock      = threading.Lock()
+
+    @classmethod
+    def load(cls, path, root):
+        manifest = cls(path, root)
+        try:
+            with open(path) as f:
+                content = json.load(f)
+        except (IOError, OSError):
+            return manifest
+        except ValueError:
+            logger.warning("Manifest '%s' is broken, exports all records." % path)
+            return manifest
+
+        if content.get('version') == cls.version:
+            manifest.watermark = content['watermark']
+            manifest.outputs   = content['outputs']
+        return manifest
+
+    def since(self, overlap=0):
+        """
+        Returns the watermark moved back by `overlap` seconds in the format
+        of sql datetime, or None if it was the first export.
+        """
+        if self.watermark is None:
+            return None
+        return time.strftime(self.datetime_format,
+                             time.localtime(self.watermark - overlap))
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def add(self, guid, path):
+        """
+        Records a file written for the record.
+        """
+        with self.lock:
+            self.updated.setdefault(guid, set()).add(self.relpath(path))
+
+    def discard(self, guid):
+        """
+        Marks the record not to be exported any more, files written for it
+        previously are to be removed.
+        """
+        with self.lock:
+            self.updated.setdefault(guid, set())
+
+    def clean(self):
+        """
+        Removes files no longer written by records updated and merges them
+        into `outputs`.
+        """
+        with self.lock:
+            for guid, paths in self.updated.items():
+                for relpath in set(self.outputs.get(guid, ())) - paths:
+                    path = os.path.join(self.root, relpath)
+                    if os.path.exists(path):
+                        os.remove(path)
+                        logger.debug("Removed stale output '%s'." % relpath)
+                if paths:
+                    self.outputs[guid] = sorted(paths)
+                else:
+                    self.outputs.pop(guid, None)
+            self.updated = {}
+
+    def save(self):
+        """
+        Cleans stale outputs and writes the manifest with the time this run
+        started as the new watermark. It's called only if the export was
+        completed, otherwise records are exported again in the next run.
+        """
+        self.clean()
+        self.watermark = self.started
+        content = {
+            'version': self.version,
+            'watermark': self.watermark,
+            'outputs': self.outputs,
+        }
+
+        dirname = os.path.dirname(self.path)
+        makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f)
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # rename doesn't replace an existing file on Windows
+            os.remove(self.path)
+            os.rename(tmp_path, self.path)
+
+
+class ManifestRecorder(object):
+    """
+    Stands for the manifest in another process, where the manifest is not
+    able to be sent for the lock it holds. Files recorded are sent back and
+    replayed on the manifest by `replay()`.
+    """
+
+    def __init__(self):
+        # pairs of the guid and the path added, or None if discarded
+        self.records = []
+
+    def add(self, guid, path):
+        self.records.append((guid, path))
+
+    def discard(self, guid):
+        self.records.append((guid, None))
+
+    def replay(self, manifest):
+        for guid, path in self.records:
+            if path is None:
+                manifest.discard(guid)
+            else:
+                manifest.add(guid, path)
@@ -29,6 +29,17 @@ class BaseModel(object):
     output_suffix = '.json'
     effective_values = ('1', 1, 'true')
 
+    # Whether documents of `source` and `result` were fetched with the
+    # properties the model reads only, see `get_projection()`.
+    projected   = False
+    # Properties read by `BaseModel` itself
+    base_props  = {
+        'source': ('_guid', ),
+        'result': ('_guid', '_personInProjectId', 'effective', 'Effective'),
+    }
+    # Properties read by the subclass but not declared as mapping fields,
+    # for example: {'source': ('url', ), 'result': ('markResult', )}
+    extra_props = {}
 
     def __init__(self, annotation, app, stats, **context):
         self.annotation = annotation
@@ -49,6 +60,31 @@ class BaseModel(object):
                     # replace the field-object with real value
                     self.__setattr__(field, obj.get_val(self.annotation))
 
+    @classmethod
+    def get_projection(cls):
+        """
+        Returns a dict contains properties of `source` and `result` the model
+        reads, which are collected from `base_props`, `extra_props` and
+        mapping fields declared. Returns None if the model was not `projected`
+        or whatever a `LambdaMappingField` reads is unknown.
+        """
+        if not cls.projected:
+            return None
+
+        props = {}
+        for dict_name in ('source', 'result'):
+            props[dict_name] = set(cls.base_props.get(dict_name, ())) | \
+                                set(cls.extra_props.get(dict_name, ()))
+
+        for klass in inspect.getmro(cls):
+            for field, obj in klass.__dict__.items():
+                if isinstance(obj, fields.CommonMappingField):
+                    props.setdefault(obj.dict_name, set()).add(obj.prop_name)
+                elif isinstance(obj, fields.AbstractMappingField):
+                    return None
+
+        return {k: sorted(v) for k, v in props.items()}
+
     def set_base_context(self, context):
         self.title   = context['title']
         self.task_id = str(context['task_id'])
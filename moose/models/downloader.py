@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import os
+import time
 import socket
-import Queue
-import urllib2
-import httplib
+import pickle
+import functools
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from moose.utils._os import makedirs, makeparents, safe_join
 from moose.utils.encoding import force_bytes
 from moose.utils.module_loading import import_string
+from moose.utils import six
+from moose.utils.six.moves import queue, http_client
+from moose.utils.six.moves.urllib.error import URLError
+from moose.connection.http import \
+    HTTPError, IncompleteDownload, DownloadCancelled, AdaptiveConcurrency, \
+    HedgingPolicy, get_client, get_part_path, discard_part
+from moose.apps import apps
+from moose.actions.executors import merge_stats
+from moose.core.manifest import ExportManifest, ManifestRecorder
 from moose.conf import settings
+from .base import BaseModel
 
 """
 Provides an uniform interface with multithreading, but in a blocked way.
@@ -31,7 +44,8 @@ logger = logging.getLogger(__name__)
 
 
 class DownloadWorker(_threading.Thread):
-    def __init__(self, queue, callback, stats, timeout, overwrite=False):
+    def __init__(self, queue, callback, stats, timeout, overwrite=False, client=None,
+                 limiter=None, hedging=None, expired=None, keep_data=False):
         super(DownloadWorker, self).__init__()
         self.queue     = queue
         self.callback  = callback
@@ -39,106 +53,473 @@ class DownloadWorker(_threading.Thread):
         self.stats     = stats
         self.timeout   = timeout
         self.overwrite = overwrite
+        # connections are kept alive and shared by workers
+        self.client    = client or get_client()
+        # limits downloads in flight if the concurrency is adaptive
+        self.limiter   = limiter
+        # an instance of `HedgingPolicy` if slow downloads are hedged
+        self.hedging   = hedging
+        # a function returns True once the deadline passed
+        self.expired   = expired
+        # keeps the data downloaded in memory and passes it to the callback
+        # as `callback(data_model, data)` instead of writing to the file,
+        # `data` is None if the file existed
+        self.keep_data = keep_data
 
     def run(self):
         while True:
             try:
                 data_model = self.queue.get(timeout=self.timeout)
-                if not self.overwrite and \
-                    os.path.exists(data_model.dest_filepath):
-                    self.stats.inc_value("download/conflict")
-                    self.callback(data_model)
-                else:
-                    data = self.fetch(data_model.filelink, data_model.retry)
-
-                    if data != None:
-                        self.write(data, data_model.dest_filepath)
-                        self.callback(data_model)
-                        self.stats.inc_value("download/ok")
-                    else:
-                        if data_model.retry > 0:
-                            data_model.retry -= 1
-                            self.queue.put(data_model)
-                            self.stats.inc_value("download/retry")
-                        else:
-                            self.stats.inc_value("download/failed")
+            except queue.Empty as e:
+                break
 
+            try:
+                self.handle(data_model)
+            except Exception:
+                # the thread would exit and `join()` would hang otherwise
+                logger.exception('failed to handle the model: %s' % data_model.filelink)
+                self.stats.inc_value("download/callback_error")
+            finally:
                 self.queue.task_done()
 
-            except Queue.Empty as e:
-                break
+    def handle(self, data_model):
+        while True:
+            filepath = data_model.dest_filepath
+            if self.expired is not None and self.expired():
+                # drains the queue without downloading
+                self.discard(filepath)
+                self.stats.inc_value("download/deadline_exceeded")
+                return
+
+            if not self.overwrite and \
+                os.path.exists(data_model.dest_filepath):
+                self.stats.inc_value("download/conflict")
+                self.call(data_model, None)
+                return
+
+            succeed, data = self.fetch(data_model.filelink, filepath, data_model.retry)
+            if succeed:
+                self.call(data_model, data)
+                self.stats.inc_value("download/ok")
+                return
+
+            if self.expired is not None and self.expired():
+                # cancelled at the deadline, which is given up above
+                continue
+
+            if data_model.retry > 0:
+                data_model.retry -= 1
+                self.stats.inc_value("download/retry")
+                try:
+                    self.queue.put_nowait(data_model)
+                    return
+                except queue.Full:
+                    # Retries at once, workers would be deadlocked if all
+                    # of them were blocked to put into the bounded queue
+                    continue
+            else:
+                self.discard(filepath)
+                self.stats.inc_value("download/failed")
+                return
+
+    def call(self, data_model, data):
+        if self.keep_data:
+            self.callback(data_model, data)
+        else:
+            self.callback(data_model)
+
+    def discard(self, filepath):
+        """
+        Gives up the part received.
+        """
+        discard_part(get_part_path(filepath))
+
+    def retrieve(self, url, filepath, delay=None):
+        """
+        Streams the url to the filepath, or reads it into memory if
+        `keep_data` was set. Returns the data kept or None.
+        """
+        if self.keep_data:
+            if delay is None:
+                return self.client.get(url, stats=self.stats, cancelled=self.expired)
+            return self.client.hedged_get(url, delay, stats=self.stats, cancelled=self.expired)
+
+        lock.acquire()
+        makeparents(filepath)
+        lock.release()
+
+        if delay is None:
+            self.client.download(url, filepath, stats=self.stats, cancelled=self.expired)
+        else:
+            self.client.hedged_download(
+                url, filepath, delay, stats=self.stats, cancelled=self.expired)
+        return None
 
-    def fetch(self, url, retry):
-        data = None
+    def fetch(self, url, filepath, retry):
+        """
+        Retrieves the url, the part streamed to the filepath is kept and
+        resumed by the next try if interrupted. Returns a pair of whether
+        it succeed and the data kept.
+        """
         # Logs error only if it was the last time to try
         warn = logger.error if retry == 0 else logger.info
 
+        if self.limiter:
+            self.limiter.acquire()
+        started = time.time()
+        succeed, data = False, None
+        delay = self.hedging.get_delay() if self.hedging else None
         try:
-            response = urllib2.urlopen(url, timeout=self.timeout)
-            data = response.read()
-        except urllib2.HTTPError, e:
+            data = self.retrieve(url, filepath, delay)
+            succeed = True
+            if self.hedging:
+                self.hedging.record(time.time() - started)
+        except DownloadCancelled as e:
+            warn('download cancelled for the deadline: %s' % url)
+        except HTTPError as e:
             self.stats.inc_value("download/http_error")
+            if e.status in (429, 503):
+                self.stats.inc_value("download/throttled")
             warn('falied to connect to %s, may for %s' % (url, e.reason))
-        except urllib2.URLError, e:
+        except (IncompleteDownload, http_client.IncompleteRead) as e:
+            self.stats.inc_value("download/incomplete")
+            warn('incomplete download: %s' % url)
+        except URLError as e:
             self.stats.inc_value("download/url_error")
             warn('unable to open url %s for %s' % (url, e.reason))
-        except socket.error, e:
+        except socket.error as e:
             self.stats.inc_value("download/socket_error")
             warn('socket error: %s' % url)
-        except httplib.BadStatusLine, e:
+        except http_client.BadStatusLine as e:
             self.stats.inc_value("download/bad_status_line")
             warn('BadStatusLine: %s' % url)
-        return data
+        finally:
+            if self.limiter:
+                self.limiter.release(time.time() - started, succeed)
+        return succeed, data
 
-    def write(self, data, filepath):
-        lock.acquire()
-        makeparents(filepath)
-        lock.release()
 
-        with open(filepath, 'wb') as f:
-            f.write(data)
-        return
+class InlineCallbackExecutor(object):
+    """
+    Calls the callback in the download thread, which is not able to
+    download until the callback returned.
+    """
+
+    def __init__(self, callback, stats, nworkers=None):
+        self.callback = callback
+        self.stats    = stats
+        self.nworkers = nworkers or settings.DOWNLOAD_CALLBACK_WORKERS
+
+    def start(self):
+        pass
+
+    def submit(self, *args):
+        self.callback(*args)
+
+    def join(self):
+        pass
+
+
+class ThreadPoolCallbackExecutor(InlineCallbackExecutor):
+    """
+    Calls callbacks in a pool of threads, so that downloading and handling
+    models are sized independently, which fits callbacks releasing GIL,
+    such as drawing with OpenCV. Download threads are blocked if more than
+    twice as many models as workers are waiting to be handled.
+    """
+    pool_class = ThreadPool
+
+    def __init__(self, callback, stats, nworkers=None):
+        super(ThreadPoolCallbackExecutor, self).__init__(callback, stats, nworkers)
+        self.pool  = None
+        self.slots = _threading.BoundedSemaphore(self.nworkers * 2)
+        # results to be watched for errors, since `error_callback` is not
+        # supported by Python 2
+        self.results = queue.Queue()
+        self.watcher = None
+
+    def create_pool(self):
+        return self.pool_class(self.nworkers)
+
+    def get_task(self):
+        return self.call
+
+    def call(self, *args):
+        try:
+            self.callback(*args)
+        except Exception:
+            logger.exception('failed to handle the model: %s' % args[0].filelink)
+            self.stats.inc_value("download/callback_error")
+
+    def handle_result(self, result):
+        self.slots.release()
+
+    def handle_error(self, error):
+        # the task was never run if its arguments were not picklable
+        logger.error('failed to handle the model in the pool: %s' % error)
+        self.stats.inc_value("download/callback_error")
+        self.slots.release()
+
+    def watch(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            result.wait()
+            if not result.successful():
+                try:
+                    result.get()
+                except Exception as e:
+                    self.handle_error(e)
+
+    def start(self):
+        self.pool = self.create_pool()
+        if six.PY2:
+            self.watcher = _threading.Thread(target=self.watch)
+            self.watcher.setDaemon(True)
+            self.watcher.start()
+
+    def submit(self, *args):
+        self.slots.acquire()
+        if six.PY2:
+            self.results.put(self.pool.apply_async(
+                self.get_task(), args, callback=self.handle_result))
+        else:
+            self.pool.apply_async(
+                self.get_task(), args, callback=self.handle_result,
+                error_callback=self.handle_error)
+
+    def join(self):
+        self.pool.close()
+        self.pool.join()
+        if self.watcher is not None:
+            self.results.put(None)
+            self.watcher.join()
+
+
+# The arguments to create a model again in another process
+ModelState = collections.namedtuple('ModelState', ['model_cls', 'annotation', 'app_label', 'context'])
+
+# The executor whose callback to be called in the processes, which is
+# passed by the initializer of the pool, so that it is inherited by forked
+# processes and pickled only once for spawned ones.
+_process_executor = None
+
+def _init_process(executor):
+    global _process_executor
+    _process_executor = executor
+
+def _call_in_process(state, *args):
+    executor = _process_executor
+    executor.stats.clear_stats()
+    try:
+        data_model = executor.load_model(state)
+    except Exception:
+        logger.exception('failed to create the model again: %r' % (state, ))
+        executor.stats.inc_value("download/callback_error")
+    else:
+        executor.call(data_model, *args)
+    recorders = {}
+    if isinstance(state, ModelState):
+        # files recorded are replayed on manifests in the parent
+        recorders = {k: v for k, v in state.context.items() if isinstance(v, ManifestRecorder)}
+    return executor.stats.get_stats(), recorders
+
+
+class ProcessPoolCallbackExecutor(ThreadPoolCallbackExecutor):
+    """
+    Calls callbacks in a pool of processes, which fits callbacks spending
+    most of time on CPU in Python. Instances of `BaseModel` hold the app
+    and stats which are not picklable, so they are created again in the
+    children from the annotation, the label of the app and the context,
+    whose items not picklable are left out. Manifests of incremental
+    exports in the context are replaced by recorders, and files recorded
+    in the children are replayed on them. Stats made in the children are
+    sent back and merged, but other changes made by callbacks are lost.
+    """
+    # a function in Python 2, which is not to be bound as a method
+    pool_class = staticmethod(multiprocessing.Pool)
+
+    def __init__(self, callback, stats, nworkers=None):
+        super(ProcessPoolCallbackExecutor, self).__init__(callback, stats, nworkers)
+        # maps keys of contexts to types of values which are not picklable,
+        # values are mostly shared by models
+        self.unpicklable = {}
+
+    def __getstate__(self):
+        # the pool and the synchronization are left in the parent
+        state = self.__dict__.copy()
+        for name in ('pool', 'slots', 'results', 'watcher'):
+            state[name] = None
+        return state
+
+    def create_pool(self):
+        return self.pool_class(self.nworkers, _init_process, (self, ))
+
+    def get_task(self):
+        return _call_in_process
+
+    def is_picklable(self, key, value):
+        if type(value) is self.unpicklable.get(key):
+            return False
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            return True
+        except Exception:
+            logger.debug("'%s' of the context is not sent to processes." % key)
+            self.unpicklable[key] = type(value)
+            return False
+
+    def dump_context(self, context):
+        """
+        Returns the picklable items of the context, and the manifests
+        replaced by recorders.
+        """
+        picklable = {}
+        manifests = {}
+        for key, value in context.items():
+            if isinstance(value, ExportManifest):
+                picklable[key] = ManifestRecorder()
+                manifests[key] = value
+            elif self.is_picklable(key, value):
+                picklable[key] = value
+        return picklable, manifests
+
+    def dump_model(self, data_model):
+        """
+        Returns the picklable state to create the model again and the
+        manifests in its context, other models are pickled as they are.
+        """
+        if not isinstance(data_model, BaseModel):
+            return data_model, {}
+        context, manifests = self.dump_context(data_model.context)
+        state = ModelState(
+            data_model.__class__, data_model.annotation, data_model.app.label, context)
+        return state, manifests
+
+    def load_model(self, state):
+        if not isinstance(state, ModelState):
+            return state
+        return state.model_cls(
+            state.annotation, apps.get_app_config(state.app_label), self.stats, **state.context)
+
+    def submit(self, data_model, *args):
+        state, manifests = self.dump_model(data_model)
+        callback = functools.partial(self.handle_result, manifests=manifests)
+        self.slots.acquire()
+        if six.PY2:
+            self.results.put(self.pool.apply_async(
+                self.get_task(), (state, ) + args, callback=callback))
+        else:
+            self.pool.apply_async(
+                self.get_task(), (state, ) + args, callback=callback,
+                error_callback=self.handle_error)
+
+    def handle_result(self, result, manifests=None):
+        stats, recorders = result
+        merge_stats(self.stats, stats)
+        for key, recorder in recorders.items():
+            recorder.replay(manifests[key])
+        self.slots.release()
 
 
 class ModelDownloader(object):
 
     DEFAULT_WORKER_CLASS = "moose.models.downloader.DownloadWorker"
 
-    def __init__(self, callback, stats, worker_cls=None, timeout=None, overwrite=False, nworkers=10):
-        self.queue     = Queue.Queue()
+    def __init__(self, callback, stats, worker_cls=None, timeout=None, overwrite=False,
+                 nworkers=10, client=None, maxsize=None, executor_cls=None, adaptive=None,
+                 hedge_percentile=None, deadline=None, keep_data=False):
+        # `add_task` is blocked if workers fall behind, which bounds the
+        # models kept in memory. Tasks are handled after all of them were
+        # added in DEBUG mode, so the queue is unbounded.
+        if maxsize is None:
+            maxsize = settings.DOWNLOAD_QUEUE_SIZE
+        self.queue     = queue.Queue(0 if settings.DEBUG else maxsize)
         self.callback  = callback
         self.stats     = stats
         self.timeout   = timeout or settings.DEFAULT_TIMEOUT
         self.overwrite = overwrite
         # Run in one loop if setting DEBUG mode
         self.nworkers  = nworkers
+        self.client    = client or get_client()
         worker_cls_str = worker_cls if worker_cls else self.DEFAULT_WORKER_CLASS
         self.worker_cls = import_string(worker_cls_str)
+        # Callbacks are called by download threads in DEBUG mode
+        if settings.DEBUG:
+            executor_cls = InlineCallbackExecutor
+        else:
+            executor_cls = import_string(executor_cls or settings.DOWNLOAD_CALLBACK_EXECUTOR)
+        self.executor = executor_cls(callback, stats)
+        # Threads are started as many as DOWNLOAD_MAX_WORKERS if the
+        # concurrency is adaptive, `nworkers` of them download at first
+        if adaptive is None:
+            adaptive = settings.DOWNLOAD_ADAPTIVE
+        self.limiter = None
+        if adaptive and not settings.DEBUG:
+            self.limiter = AdaptiveConcurrency(
+                settings.DOWNLOAD_MIN_WORKERS, settings.DOWNLOAD_MAX_WORKERS, nworkers, stats)
+        # Downloads slower than the percentile of latencies in this run
+        # are hedged, which runs them in helper threads
+        if hedge_percentile is None:
+            hedge_percentile = settings.DOWNLOAD_HEDGE_PERCENTILE
+        self.hedging = None
+        if hedge_percentile and not settings.DEBUG:
+            self.hedging = HedgingPolicy(hedge_percentile, settings.DOWNLOAD_HEDGE_MIN_SAMPLES)
+        # Models not downloaded in `deadline` seconds since started are
+        # given up, and downloads in progress are cancelled
+        self.deadline = deadline if deadline is not None else settings.DOWNLOAD_DEADLINE
+        self.deadline_at = None
+        self.keep_data   = keep_data
+
+    def expired(self):
+        return self.deadline_at is not None and time.time() > self.deadline_at
 
     def start(self):
+        if self.deadline:
+            self.deadline_at = time.time() + self.deadline
         if not settings.DEBUG:
-            for i in range(self.nworkers):
-                worker = self.worker_cls(self.queue, self.callback, self.stats, \
-                            self.timeout, self.overwrite)
+            # processes are forked before threads started
+            self.executor.start()
+            nthreads = self.limiter.max_limit if self.limiter else self.nworkers
+            for i in range(nthreads):
+                worker = self.create_worker(
+                    self.executor.submit, limiter=self.limiter, hedging=self.hedging)
                 worker.setDaemon(True)
                 worker.start()
 
+    def create_worker(self, callback, **options):
+        """
+        Creates the worker with the arguments of `DownloadWorker` as ever,
+        the others are set as attributes after created, so that workers
+        subclassed before they were added still work.
+        """
+        worker = self.worker_cls(self.queue, callback, self.stats, self.timeout, self.overwrite)
+        options.update(client=self.client, expired=self.expired, keep_data=self.keep_data)
+        for name, value in options.items():
+            setattr(worker, name, value)
+        return worker
+
     def add_task(self, data_model):
+        # For every models, we would like to try to fetch
+        # data from urls the model provides for 3 times,
+        # and give up if it never succeed.
+        data_model.retry = 3
         try:
-            # For every models, we would like to try to fetch
-            # data from urls the model provides for 3 times,
-            # and give up if it never succeed.
-            data_model.retry = 3
+            self.queue.put_nowait(data_model)
+        except queue.Full:
+            # waits for workers to catch up
+            started = time.time()
             self.queue.put(data_model)
-        except Queue.Full as e:
-            logger.error('Try to put an element in a full queue.')
-            raise e
+            self.stats.inc_value("download/queue_blocked")
+            self.stats.inc_value("download/queue_blocked_ms", int((time.time() - started) * 1000))
+        self.stats.max_value("download/queue_max_depth", self.queue.qsize())
 
     def join(self):
         if settings.DEBUG:
             # waitting for data to be handled one by one
-            _worker = self.worker_cls(
-                self.queue, self.callback, self.stats, self.timeout, self.overwrite)
+            _worker = self.create_worker(self.callback)
             _worker.start()
         else:
             self.queue.join()
+            self.executor.join()
@@ -6,6 +6,23 @@ from PIL import Image, ImageDraw, ImageFont
 from moose.utils._os import npath
 from .pallet import dip, create_pallet
 
+def read_image(src):
+	"""
+	Returns the image of `src`, which is either a path or an array decoded
+	already, None if unable to read.
+	"""
+	if isinstance(src, np.ndarray):
+		return src
+	return cv2.imread(npath(src))
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+	"""
+	Decodes an image from the bytes in memory, None if unable to decode.
+	"""
+	return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+
 def get_label_color(label, pallet, default):
 	color = pallet.get(label, default)
 	# reverse the color for opencv, cause the default order is BGR
@@ -51,7 +68,7 @@ def draw_polygons(img_name, dst_name, datalist, pallet=None, border=False, grays
 	Draws a mask on a black background.
 
 	`img_name`
-		source file path
+		source file path, or the image decoded already
 
 	`dst_name`
 		dstination file path
@@ -75,7 +92,7 @@ def draw_polygons(img_name, dst_name, datalist, pallet=None, border=False, grays
 	`grayscale`
 		a boolean indicates whether the image was grayscale or rgb
 	"""
-	image = cv2.imread(npath(img_name))
+	image = read_image(img_name)
 
 	# constructs the pallet if not defined before
 	if not pallet:
@@ -114,7 +131,7 @@ def blend(img_name, dst_name, datalist, pallet=None, alpha=0.4, beta=0.6):
 	Blends the raw image with a mask which segmented according to the datalist.
 
 	`img_name`
-		source file path
+		source file path, or the image decoded already
 
 	`dst_name`
 		dstination file path
@@ -135,7 +152,7 @@ def blend(img_name, dst_name, datalist, pallet=None, alpha=0.4, beta=0.6):
 	`alpha, beta`
 		weights for the proportion of raw image and mask
 	"""
-	image = cv2.imread(npath(img_name))
+	image = read_image(img_name)
 
 	# constructs the pallet if not defined before
 	if not pallet:
@@ -152,3 +169,48 @@ def blend(img_name, dst_name, datalist, pallet=None, alpha=0.4, beta=0.6):
 	blended = cv2.addWeighted(image, alpha, mask, beta, 0)
 	cv2.imwrite(npath(dst_name), blended)
 	return pallet
+
+
+def render(img_name, datalist, pallet=None, mask_name=None, blend_name=None, alpha=0.4, beta=0.6):
+	"""
+	Draws the mask and blends it with the raw image at once, which is the
+	same as calling `draw_polygons()` and `blend()`, but the image is read
+	and polygons are rasterized only once.
+
+	`img_name`
+		source file path, or the image decoded already
+
+	`datalist`
+		a tuple of two-element-tuple contains `label` and `points`, as
+		`draw_polygons()`
+
+	`pallet`
+		a dict represents label and corresponding color to draw
+
+	`mask_name`, `blend_name`
+		destination file paths of the mask and the blended image, skipped
+		if None
+
+	`alpha, beta`
+		weights for the proportion of raw image and mask
+	"""
+	image = read_image(img_name)
+
+	# constructs the pallet if not defined before
+	if not pallet:
+		pallet = create_pallet(datalist, is_global=True)
+
+	default = pallet.get('default', None)
+
+	# draw
+	mask = np.zeros(image.shape, np.uint8)
+	for label, points in datalist:
+		pts = np.array(points, np.int32)
+		cv2.fillPoly(mask, [pts], (get_label_color(label, pallet, default)))
+
+	if mask_name:
+		cv2.imwrite(npath(mask_name), mask)
+	if blend_name:
+		blended = cv2.addWeighted(image, alpha, mask, beta, 0)
+		cv2.imwrite(npath(blend_name), blended)
+	return pallet
@@ -2,12 +2,15 @@
 from __future__ import unicode_literals
 import os
 import copy
+import multiprocessing
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 from collections import Container
 
 import cv2
 import numpy as np
 from moose.conf import settings
-from moose.utils._os import npath
+from moose.utils._os import npath, makedirs
 from moose.core.exceptions import ImproperlyConfigured
 
 from . import colors
@@ -55,6 +58,8 @@ class BaseShape(object):
 		self._filled = options.get('filled', self.drawn_filled)
 		self._thickness = options.get('thickness', self.default_thickness)
 		self._options = options
+		# cache of `to_nparray()`
+		self._nparray = None
 
 	def _is_valid_coordinates(self, coordinates):
 		return True
@@ -115,10 +120,7 @@ class BaseShape(object):
 		Note that (R, G, B) was reversed in OpenCV, meanwhile the color
 		was a integer when the canvas was a grayscale image.
 		"""
-		if isinstance(self._color, list) or isinstance(self._color, tuple):
-			return self._color[::-1]
-		else:
-			return self._color
+		return to_bgr(self._color)
 
 	def draw_on(self, im):
 		"""
@@ -129,6 +131,34 @@ class BaseShape(object):
 		else:
 			self._outline(im)
 
+	def to_nparray(self):
+		# coordinates are never changed once normalized, and `fromiter` is
+		# much faster than `np.array` on a list of tuples
+		if self._nparray is None:
+			self._nparray = np.fromiter(
+				chain.from_iterable(self._coordinates), np.int32, len(self._coordinates) * 2).reshape(-1, 2)
+		return self._nparray
+
+	def get_bounds(self):
+		"""
+		Returns the box (x1, y1, x2, y2) in integers which pixels drawn are
+		within, to tell whether shapes overlap.
+		"""
+		x, y, w, h = cv2.boundingRect(self.to_nparray())
+		# lines are drawn `thickness` away from points at most
+		pad = 1 if self._filled else abs(self._thickness) + 1
+		return (x - pad, y - pad, x + w + pad, y + h + pad)
+
+	def get_contours(self):
+		"""
+		Returns (key, contours) if the shape can be drawn along with others
+		of the same key and color in one call, where the key is ('fill', )
+		for `cv2.fillPoly` or ('polylines', is_closed, thickness) for
+		`cv2.polylines`, or None if it is drawn by `draw_on()` only.
+		Subclasses overriding `draw_on()` should override it as well.
+		"""
+		return None
+
 	def _fill(self, im):
 		"""
 		Fills the shape with colors on the image, it is allowed to raise an error
@@ -161,6 +191,11 @@ class Point(BaseShape):
 	def normalize(self, coord):
 		return (int(coord[0]), int(coord[1]))
 
+	def get_bounds(self):
+		x, y = self._coordinates
+		pad = self.radius + 1
+		return (x - pad, y - pad, x + pad, y + pad)
+
 	def draw_on(self, im):
 		# let thickness be a negative value to fill the circle
 		cv2.circle(im, self._coordinates, self.radius, self.color, -1)
@@ -179,6 +214,10 @@ class LineString(BaseShape):
 		else:
 			return False
 
+	def get_contours(self):
+		# the same as drawing segments one by one
+		return ('polylines', False, self._thickness), [self.to_nparray()]
+
 	def draw_on(self, im):
 		for start, end in zip(self._coordinates[:-1], self._coordinates[1:]):
 			cv2.line(im, start, end, self.color, self._thickness)
@@ -200,8 +239,10 @@ class Polygon(BaseShape):
 		else:
 			return False
 
-	def to_nparray(self):
-		return np.array(self._coordinates, np.int32)
+	def get_contours(self):
+		if self._filled:
+			return ('fill', ), [self.to_nparray()]
+		return ('polylines', self.is_closed, self._thickness), [self.to_nparray()]
 
 	def _fill(self, im):
 		cv2.fillPoly(im, [self.to_nparray()], self.color)
@@ -249,6 +290,17 @@ class Rectangle(BaseShape):
 		x2, y2 = self._coordinates[1]
 		return [[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]
 
+	def to_nparray(self):
+		if self._nparray is None:
+			self._nparray = np.array(self.to_points()[:-1], np.int32)
+		return self._nparray
+
+	def get_contours(self):
+		# OpenCV draws rectangles as the polygon of corners
+		if self._filled:
+			return ('fill', ), [self.to_nparray()]
+		return ('polylines', True, self._thickness), [self.to_nparray()]
+
 	def _outline(self, im):
 		cv2.rectangle(im, tuple(self._coordinates[0]), tuple(self._coordinates[1]), self.color, self._thickness)
 
@@ -256,6 +308,24 @@ class Rectangle(BaseShape):
 		cv2.rectangle(im, tuple(self._coordinates[0]), tuple(self._coordinates[1]), self.color, -1)
 
 
+def to_bgr(color):
+	# (R, G, B) was reversed in OpenCV, an integer for grayscale images
+	if isinstance(color, list) or isinstance(color, tuple):
+		return color[::-1]
+	return color
+
+
+def opaque(color):
+	"""
+	Returns the color to draw on a canvas of 4 channels, whose last channel
+	is set 255 to mark pixels covered. Note that the color is reversed by
+	shapes, and an integer is drawn in the first channel by OpenCV.
+	"""
+	if isinstance(color, list) or isinstance(color, tuple):
+		return (255, ) + tuple(color)
+	return (255, 0, 0, color)
+
+
 class GeneralPainter(object):
 	"""
 	在绘图的颜色选择上有三种可能:
@@ -271,6 +341,13 @@ class GeneralPainter(object):
 	shape_polygon_cls   = Polygon
 	shape_rectangle_cls = Rectangle
 	persistent_pallet   = {}
+	# outputs of `batch_render()`, written as '<name>_<output><suffix>'
+	outputs             = ('mask', 'blend', 'draw')
+	output_suffix       = '.png'
+	# jobs sent to a worker at a time
+	batch_chunksize     = 16
+	# size of cells in pixels to tell whether shapes overlap
+	grid_size           = 32
 
 	def __init__(self, image_path, pallet=None, autofill=False, use_default=False, persistent=True):
 		if not os.path.exists(image_path):
@@ -288,6 +365,8 @@ class GeneralPainter(object):
 		if pallet:
 			self.update_pallet(pallet)
 		self._shapes      = []
+		# shapes rasterized, shared by outputs until shapes or colors changed
+		self._layer       = None
 
 	def get_color(self, label):
 		if self._use_default:
@@ -303,25 +382,35 @@ class GeneralPainter(object):
 
 		return self._pallet[label]
 
+	def get_shape_color(self, shape):
+		# the default color of the shape is kept when no pallet used
+		color = self.get_color(shape._label)
+		return shape._color if color is None else color
+
 	def add_color(self, label, color):
 		self._pallet[label] = color
+		self._layer = None
 
 	def update_pallet(self, pallet):
 		if isinstance(pallet, dict):
 			self._pallet.update(pallet)
+			self._layer = None
 		else:
 			raise ImproperlyConfigured("`Pallet` must be a type 'dict'")
 
 	def add_shape(self, shape):
 		# A shape object must provide attribute `label` and method `draw_on`
 		self._shapes.append(shape)
+		self._layer = None
 
 	def from_shapes(self, shapes):
 		# `shapes` may be a generator
 		self._shapes.extend(list(shapes))
+		self._layer = None
 
 	def clear(self):
 		self._shapes = []
+		self._layer = None
 
 	def add_line(self, p1, p2, label, **options):
 		shape = self.shape_line_cls([p1, p2], label, **options)
@@ -342,31 +431,219 @@ class GeneralPainter(object):
 	def render(self, canvas):
 		for shape in self._shapes:
 			shape.set_color(self.get_color(shape._label))
-			shape.draw_on(canvas)
+		return self._draw(canvas)
+
+	def group_shapes(self, colors=None):
+		"""
+		Groups shapes to draw in as few calls as possible, returns a list of
+		(key, color, contours), or (None, color, shape) for shapes drawn by
+		`draw_on()`, see `BaseShape.get_contours()`. Shapes are drawn in their
+		own colors, unless `colors` is given, one for each shape, in which
+		case shapes drawn by `draw_on()` come with it, else None.
+
+		A shape joins the latest group of the same key and color only if it
+		doesn't overlap shapes in groups after, which keeps the order of
+		shapes overlapped. Filled ones must not overlap each other in a group
+		either, since `cv2.fillPoly` fills overlapped areas by parity. So the
+		result is pixel-identical to drawing shapes one by one.
+		"""
+		# the latest group drawn in each cell of the grid, which tells
+		# overlaps roughly but fast, shapes without bounds overlap all
+		grid = {}
+		size = self.grid_size
+		floor = -1
+		groups = []
+		latest = {}
+		for i, shape in enumerate(self._shapes):
+			bounds = shape.get_bounds() if hasattr(shape, 'get_bounds') else None
+			if bounds is None:
+				cells = ()
+			else:
+				x1, y1, x2, y2 = bounds
+				cells = [(row, col) for row in range(y1 // size, y2 // size + 1)
+						 for col in range(x1 // size, x2 // size + 1)]
+
+			contours = shape.get_contours() if hasattr(shape, 'get_contours') else None
+			if contours:
+				key, contours = contours
+				color = shape.color if colors is None else to_bgr(colors[i])
+				if isinstance(color, list):
+					color = tuple(color)
+				index = latest.get((key, color), -1)
+				# the latest group overlapped, only if possible to join one
+				if index > floor and bounds is not None:
+					overlapped = max([floor] + [grid.get(cell, -1) for cell in cells])
+					if index > overlapped or (index == overlapped and key[0] == 'polylines'):
+						groups[index][2].extend(contours)
+						for cell in cells:
+							if grid.get(cell, -1) < index:
+								grid[cell] = index
+						continue
+				latest[(key, color)] = len(groups)
+				groups.append((key, color, list(contours)))
+			else:
+				groups.append((None, None if colors is None else colors[i], shape))
+			if bounds is None:
+				floor = len(groups) - 1
+			for cell in cells:
+				grid[cell] = len(groups) - 1
+		return groups
+
+	def _draw(self, canvas, colors=None):
+		# draws shapes with colors set already, or in `colors` given
+		for key, color, contours in self.group_shapes(colors):
+			if key is None:
+				if color is not None:
+					# never changes the shape, which may be shared
+					contours = copy.copy(contours)
+					contours._color = color
+				contours.draw_on(canvas)
+			elif key[0] == 'fill':
+				cv2.fillPoly(canvas, contours, color)
+			else:
+				cv2.polylines(canvas, contours, key[1], color, key[2])
 		return canvas
 
-	def draw(self, filename):
+	def get_layer(self):
+		"""
+		Rasterizes shapes once on a canvas of 4 channels, the first three of
+		which are the mask, and the last one marks pixels covered by shapes.
+		The outputs are all derived from it, and are the same as rendering
+		shapes on each of them, as long as shapes are drawn without
+		anti-aliasing.
+		"""
+		if self._layer is None:
+			layer = np.zeros(self.im.shape[:2] + (4, ), np.uint8)
+			# colors are passed rather than set on shapes, since shapes may
+			# be shared by jobs rendered in threads, see `batch_render()`
+			opaques = [opaque(self.get_shape_color(shape)) for shape in self._shapes]
+			self._layer = self._draw(layer, opaques)
+		return self._layer
+
+	def get_mask(self):
+		return np.ascontiguousarray(self.get_layer()[:, :, :3])
+
+	def get_drawn(self):
+		layer = self.get_layer()
+		covered = layer[:, :, 3] > 0
 		# Do not draw on the original image
-		img = copy.deepcopy(self.im)
-		img = self.render(img)
-		cv2.imwrite(npath(filename), img)
+		img = self.im.copy()
+		img[covered] = layer[:, :, :3][covered]
+		return img
+
+	def get_blended(self, alpha=0.7, gamma=0.0):
+		if alpha < 1.0 and alpha > 0.0:
+			beta = 1.0 - alpha
+		else:
+			raise PaintingFailed("Parameter `alpha` is ought to be in the range of 0 and 1.0")
+		return cv2.addWeighted(self.im, alpha, self.get_mask(), beta, gamma)
+
+	def draw(self, filename):
+		cv2.imwrite(npath(filename), self.get_drawn())
 
 	def masking(self, filename):
-		mask = np.zeros(self.im.shape, np.uint8)
-		mask = self.render(mask)
-		cv2.imwrite(npath(filename), mask)
+		cv2.imwrite(npath(filename), self.get_mask())
 
 	# More detailes on addWeighted
 	# http://www.opencv.org.cn/opencvdoc/2.3.2/html/doc/tutorials/core/adding_images/adding_images.html
 	def blend(self, filename, alpha=0.7, gamma=0.0):
-		if alpha < 1.0 and alpha > 0.0:
-			beta = 1.0 - alpha
+		cv2.imwrite(npath(filename), self.get_blended(alpha, gamma))
+
+	@classmethod
+	def resolve_pallets(cls, jobs, autofill=False, use_default=False, persistent=True):
+		"""
+		Returns the pallet of each job of (image_path, shapes, pallet), with
+		colors of all labels in shapes resolved as if jobs were drawn one by
+		one, so that workers draw the same label in the same color even if
+		added automatically.
+		"""
+		pallet = cls.persistent_pallet if persistent else {}
+		pallets = []
+		for _, shapes, job_pallet in jobs:
+			if not persistent:
+				pallet = {}
+			if job_pallet:
+				if not isinstance(job_pallet, dict):
+					raise ImproperlyConfigured("`Pallet` must be a type 'dict'")
+				pallet.update(job_pallet)
+			if not use_default:
+				for shape in shapes:
+					if pallet.get(shape._label) == None:
+						if autofill:
+							pallet[shape._label] = colors.choice(exclude=list(pallet.values()))
+						else:
+							raise ImproperlyConfigured("Color for lable '{}' was not set.".format(shape._label))
+			pallets.append(dict(pallet))
+		return pallets
+
+	@classmethod
+	def batch_render(cls, jobs, outputs=('mask', 'blend', 'draw'), workers=None,
+					 threads=False, dst_dir=None, alpha=0.7, **options):
+		"""
+		Renders jobs of (image_path, shapes, pallet) in a pool of `workers`
+		processes, or threads if `threads` was True, which is sufficient
+		since OpenCV releases the GIL while drawing and coding images.
+		Jobs are rendered in place if `workers` was 1.
+
+		Each of `outputs` is written as '<name>_<output>.png' in `dst_dir`,
+		or the directory of the image if not set. `options` are passed to
+		`resolve_pallets()`. Returns a dict of output paths for each job,
+		or None if failed to render it.
+		"""
+		for output in outputs:
+			if output not in cls.outputs:
+				raise ImproperlyConfigured("Unknown output '{}', expected one of {}.".format(
+					output, ', '.join(cls.outputs)))
+		if dst_dir:
+			makedirs(dst_dir)
+		jobs = [(image_path, list(shapes), pallet) for image_path, shapes, pallet in jobs]
+		pallets = cls.resolve_pallets(jobs, **options)
+		args = [(cls, image_path, shapes, pallet, outputs, dst_dir, alpha, options.get('use_default', False))
+				for (image_path, shapes, _), pallet in zip(jobs, pallets)]
+
+		if workers == 1:
+			return [_render_job(arg) for arg in args]
+		pool = ThreadPool(workers) if threads else multiprocessing.Pool(workers)
+		try:
+			return pool.map(_render_job, args, chunksize=cls.batch_chunksize)
+		finally:
+			pool.close()
+			pool.join()
+
+	def get_output(self, output, alpha=0.7):
+		if output == 'mask':
+			return self.get_mask()
+		elif output == 'blend':
+			return self.get_blended(alpha)
 		else:
-			raise PaintingFailed("Parameter `alpha` is ought to be in the range of 0 and 1.0")
-		mask = np.zeros(self.im.shape, np.uint8)
-		mask = self.render(mask)
-		blended_img = cv2.addWeighted(self.im, alpha, mask, beta, gamma)
-		cv2.imwrite(npath(filename), blended_img)
+			return self.get_drawn()
+
+	def get_output_path(self, output, dst_dir=None):
+		name, _ = os.path.splitext(os.path.basename(self.image_path))
+		dirname = dst_dir or os.path.dirname(self.image_path)
+		return os.path.join(dirname, '{}_{}{}'.format(name, output, self.output_suffix))
+
+
+def _render_job(args):
+	"""
+	Renders a job in the worker with the pallet resolved, outputs are
+	derived from shapes rasterized once.
+	"""
+	painter_cls, image_path, shapes, pallet, outputs, dst_dir, alpha, use_default = args
+	try:
+		painter = painter_cls(image_path, pallet=pallet, use_default=use_default, persistent=False)
+	except IOError:
+		return None
+	if painter.im is None:
+		# the failure of one job must not discard the results of the batch
+		logger.error("Unable to decode the image: {}".format(image_path))
+		return None
+	painter.from_shapes(shapes)
+	paths = {}
+	for output in outputs:
+		paths[output] = painter.get_output_path(output, dst_dir)
+		cv2.imwrite(npath(paths[output]), painter.get_output(output, alpha))
+	return paths
 
 
 class GeoJSONPainter(GeneralPainter):
@@ -105,6 +105,18 @@ else:
         return result == 0
 
 
+def file_md5(filepath, chunk_size=1024 * 1024):
+    """
+    Returns the md5 digest of a file, which is read `chunk_size` bytes at a
+    time instead of loading the whole file into memory.
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
 def _bin_to_long(x):
     """
     Convert a binary string into a long integer
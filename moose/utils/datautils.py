@@ -37,3 +37,18 @@ def islicel(l, m):
     """
     for i, start, end in islice(len(l), m):
         yield i, l[start:end]
+
+def ichunk(iterable, m):
+    """
+    An iterator to return lists from any iterable, each list has m elements
+    except for the last one. Unlike `islicel`, the iterable is consumed
+    lazily and never be loaded as a whole.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == m:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
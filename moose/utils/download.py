@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import time
 import Queue
 import socket
 import urllib2
@@ -8,6 +9,7 @@ import threading
 
 from moose.conf import settings
 from moose.utils._os import makeparents
+from moose.connection.http import HTTPError, AdaptiveConcurrency, get_client
 
 import logging
 logger = logging.getLogger(__name__)
@@ -23,7 +25,7 @@ class PipelineDownloader(threading.Thread):
     generate and digest data.
     """
     def __init__(self, src_queue=None, dst_queue=None,
-        set_up=None, tear_down=None, timeout=settings.DEFAULT_TIMEOUT):
+        set_up=None, tear_down=None, timeout=settings.DEFAULT_TIMEOUT, limiter=None):
         super(PipelineDownloader, self).__init__()
         if set_up:
             self.src_queue = set_up()
@@ -35,6 +37,8 @@ class PipelineDownloader(threading.Thread):
             self.dst_queue = dst_queue if dst_queue else Queue.Queue()
 
         self.timeout = timeout
+        # an instance of `AdaptiveConcurrency` shared by downloaders
+        self.limiter = limiter
 
     def run(self):
         while True:
@@ -54,11 +58,15 @@ class PipelineDownloader(threading.Thread):
         data = None
         retry = 3
         while retry > 0:
+            if self.limiter:
+                self.limiter.acquire()
+            started = time.time()
+            succeed = False
             try:
-                response = urllib2.urlopen(url, timeout=self.timeout)
-                data = response.read()
+                data = get_client().get(url)
+                succeed = True
                 return (data, name)
-            except urllib2.HTTPError, e:
+            except HTTPError, e:
                 retry -= 1
                 if retry == 0:
                     logger.error('falied to connect to %s, may for %s' % (url, e.reason))
@@ -74,6 +82,9 @@ class PipelineDownloader(threading.Thread):
                 retry -= 0.5
                 if retry == 0:
                     logger.error('An unknown http status returned: %s' % url)
+            finally:
+                if self.limiter:
+                    self.limiter.release(time.time() - started, succeed)
 
         return None
 
@@ -88,7 +99,7 @@ class DownloadStat:
         return 'Download Result: OK: %d, FAILED: %d' % (self.nok, self.nfail)
 
 
-def download(urls, dirpath, workers=10, overwrite=False):
+def download(urls, dirpath, workers=10, overwrite=False, adaptive=False):
     """
     A convenient way to download files to a directory. It returns a
     "DownloadStat" object to report the statistic of result.
@@ -105,6 +116,11 @@ def download(urls, dirpath, workers=10, overwrite=False):
 
     `overwrite`
         A flag to indicate whether to overwrite files existed.
+
+    `adaptive`
+        A flag to adjust the number of downloads in flight within
+        DOWNLOAD_MIN_WORKERS and DOWNLOAD_MAX_WORKERS, starting from
+        `workers`.
     """
     stat = DownloadStat()
     src_queue = Queue.Queue()
@@ -125,8 +141,14 @@ def download(urls, dirpath, workers=10, overwrite=False):
                 f.write(data)
             stat.nok += 1
 
+    limiter = None
+    if adaptive:
+        limiter = AdaptiveConcurrency(
+            settings.DOWNLOAD_MIN_WORKERS, settings.DOWNLOAD_MAX_WORKERS, workers)
+        workers = limiter.max_limit
+
     for _ in range(workers):
-        downloader = PipelineDownloader(src_queue=src_queue, tear_down=write)
+        downloader = PipelineDownloader(src_queue=src_queue, tear_down=write, limiter=limiter)
         downloader.setDaemon(True)
         downloader.start()
 
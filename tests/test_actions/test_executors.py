@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+
+from moose.actions.base import BaseAction
+from moose.actions import executors
+from moose.actions.stats import SperatedStatsCollector
+
+
+class CountingAction(BaseAction):
+    """
+    Executes contexts of integers and records them in the output.
+    """
+    stats_dump = False
+
+    def parse(self, kwargs):
+        return kwargs
+
+    def schedule(self, env):
+        for i in range(env['ncontexts']):
+            yield i
+
+    def execute(self, context):
+        self.stats.inc_value("context/executed")
+        self.output.append("context %d" % context)
+        return context
+
+
+class RecycledProcessPoolExecutor(executors.ProcessPoolExecutor):
+    """
+    Replaces processes after each context.
+    """
+
+    def create_pool(self):
+        return self.pool_class(self.nworkers, executors._init_process, (self.action, ), 1)
+
+
+class ExecutorTest(object):
+
+    executor_class = None
+
+    def run_action(self, ncontexts=8, stats_class=None):
+        action = CountingAction(mock.Mock(), stdout=mock.Mock(), stderr=mock.Mock(), style=mock.Mock())
+        action.executor_class = self.executor_class
+        action.nworkers = 4
+        if stats_class:
+            action.stats = stats_class(action)
+        else:
+            action.stats.close_action = mock.Mock()
+        output = action.run(ncontexts=ncontexts)
+        return action, output
+
+    def test_run(self):
+        action, output = self.run_action()
+        self.assertEqual(sorted(output.split('\n')), sorted(["context %d" % i for i in range(8)]))
+        self.assertEqual(action.stats.get_value("context/executed"), 8)
+        self.assertEqual(
+            sorted(c[0][1] for c in action.stats.close_action.call_args_list),
+            list(range(8)))
+
+    def test_separated_stats(self):
+        # stats of each context are closed separately
+        action, _ = self.run_action(stats_class=SperatedStatsCollector)
+        self.assertEqual(action.stats.action_stats,
+                         dict((i, {"context/executed": 1}) for i in range(8)))
+
+
+class SerialExecutorTestCase(ExecutorTest, unittest.TestCase):
+    executor_class = 'moose.actions.executors.SerialExecutor'
+
+    def test_order(self):
+        _, output = self.run_action()
+        self.assertEqual(output.split('\n'), ["context %d" % i for i in range(8)])
+
+
+class ThreadPoolExecutorTestCase(ExecutorTest, unittest.TestCase):
+    executor_class = 'moose.actions.executors.ThreadPoolExecutor'
+
+
+class ProcessPoolExecutorTestCase(ExecutorTest, unittest.TestCase):
+    executor_class = 'moose.actions.executors.ProcessPoolExecutor'
+
+
+class RecycledProcessPoolExecutorTestCase(ExecutorTest, unittest.TestCase):
+    executor_class = 'tests.test_actions.test_executors.RecycledProcessPoolExecutor'
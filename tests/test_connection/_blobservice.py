@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory stand-in of `BlockBlobService`, which makes it possible to test
+transfers of `AzureBlobService` without accessing Azure.
+"""
+import hashlib
+import threading
+import collections
+
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from moose.utils.six.moves.urllib.parse import urlparse, unquote
+
+
+Blob = collections.namedtuple('Blob', ['name', 'content', 'properties'])
+BlobProperties = collections.namedtuple(
+    'BlobProperties', ['content_length', 'etag', 'content_settings', 'copy'])
+ContentSettings = collections.namedtuple('ContentSettings', ['content_md5'])
+CopyProperties = collections.namedtuple('CopyProperties', ['status'])
+
+
+def make_blob(name, content, content_md5=None, copy_status=None):
+    return Blob(name, content, BlobProperties(
+        len(content), hashlib.md5(content).hexdigest(), ContentSettings(content_md5),
+        CopyProperties(copy_status)))
+
+
+class LocalBlockBlobService(object):
+    """
+    Keeps containers as dicts mapping blob names to contents.
+
+    `failures`
+        A dict maps blob names to how many times the requests on them are
+        to fail before succeed.
+
+    `copy_polls`
+        How many times a copy is listed as pending before succeed.
+    """
+
+    def __init__(self, failures=None, copy_polls=0):
+        self.containers = {}
+        self.copy_polls = copy_polls
+        # maps (container, blob) to the number of polls the copy is pending
+        self.pending_copies = {}
+        self.nlisted    = 0
+        # (container, blob) of copies aborted
+        self.aborted    = []
+        # blocks not committed, maps (container, blob) to a dict of blocks
+        self.blocks     = {}
+        # Content-MD5 set for blobs, which is not computed by the stand-in
+        self.content_md5s = {}
+        self.failures   = dict(failures or {})
+        # blob names in the order of requests, retries included
+        self.requests   = []
+        self.lock       = threading.Lock()
+
+    def _request(self, blob_name):
+        with self.lock:
+            self.requests.append(blob_name)
+            if self.failures.get(blob_name, 0) > 0:
+                self.failures[blob_name] -= 1
+                raise AzureHttpError("Injected failure on '{}'.".format(blob_name), 500)
+
+    def _get_container(self, container_name):
+        if container_name not in self.containers:
+            raise AzureMissingResourceHttpError(
+                "Container [{}] doesn't exist.".format(container_name), 404)
+        return self.containers[container_name]
+
+    def exists(self, container_name, blob_name=None, **kwargs):
+        if blob_name is None:
+            return container_name in self.containers
+        return blob_name in self.containers.get(container_name, {})
+
+    def create_container(self, container_name, **kwargs):
+        self.containers.setdefault(container_name, {})
+        return True
+
+    def _copy_status(self, container_name, blob_name):
+        key = (container_name, blob_name)
+        if key not in self.pending_copies:
+            return None
+        if self.pending_copies[key] > 0:
+            self.pending_copies[key] -= 1
+            return 'pending'
+        return 'success'
+
+    def list_blobs(self, container_name, prefix=None, include=None, **kwargs):
+        blobs = self._get_container(container_name)
+        self.nlisted += 1
+        return [make_blob(name, content, self.content_md5s.get((container_name, name)),
+                          self._copy_status(container_name, name) if include else None)
+                for name, content in sorted(blobs.items())
+                if not prefix or name.startswith(prefix)]
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        blobs = self._get_container(container_name)
+        if blob_name not in blobs:
+            raise AzureMissingResourceHttpError(
+                "Blob '{}' doesn't exist.".format(blob_name), 404)
+        return make_blob(blob_name, blobs[blob_name],
+                         self.content_md5s.get((container_name, blob_name)),
+                         self._copy_status(container_name, blob_name))
+
+    def create_blob_from_path(self, container_name, blob_name, file_path,
+                              content_settings=None, **kwargs):
+        self._request(blob_name)
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        self._get_container(container_name)[blob_name] = content
+        content_md5 = content_settings.content_md5 if content_settings else None
+        self.content_md5s[(container_name, blob_name)] = content_md5
+        return make_blob(blob_name, content, content_md5)
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        blobs = self._get_container(container_name)
+        if blob_name not in blobs:
+            raise AzureMissingResourceHttpError(
+                "Blob '{}' doesn't exist.".format(blob_name), 404)
+        del blobs[blob_name]
+
+    def copy_blob(self, container_name, blob_name, copy_source, **kwargs):
+        self._request(blob_name)
+        src_container, src_blob = unquote(urlparse(copy_source).path).lstrip('/').split('/', 1)
+        content = self._get_container(src_container)[src_blob]
+        self._get_container(container_name)[blob_name] = content
+        self.pending_copies[(container_name, blob_name)] = self.copy_polls
+        return CopyProperties('pending' if self.copy_polls else 'success')
+
+    def abort_copy_blob(self, container_name, blob_name, copy_id, **kwargs):
+        self.pending_copies.pop((container_name, blob_name))
+        self.aborted.append((container_name, blob_name))
+
+    def put_block(self, container_name, blob_name, block, block_id, **kwargs):
+        self._request(blob_name)
+        self._get_container(container_name)
+        with self.lock:
+            self.blocks.setdefault((container_name, blob_name), {})[block_id] = bytes(block)
+
+    def put_block_list(self, container_name, blob_name, block_list, content_settings=None, **kwargs):
+        blocks = self.blocks.pop((container_name, blob_name))
+        content = b''.join(blocks[block.id] for block in block_list)
+        self._get_container(container_name)[blob_name] = content
+        content_md5 = content_settings.content_md5 if content_settings else None
+        self.content_md5s[(container_name, blob_name)] = content_md5
+        return make_blob(blob_name, content, content_md5)
@@ -2,17 +2,21 @@
 from __future__ import unicode_literals
 import os
 from os.path import abspath, join
+import shutil
+import tempfile
 import unittest
 import mock
 import platform
 from azure.storage.blob import BlockBlobService, PublicAccess
 from azure.common import AzureConflictHttpError, AzureMissingResourceHttpError
 from moose.utils import six
-from moose.connection.cloud import AzureBlobService
+from moose.connection.cloud import \
+    AzureBlobService, ContainerIndex, UploadJournal, ChecksumCache
 from moose.core.exceptions import \
     ConnectionTimeout, SuspiciousOperation, ImproperlyConfigured
 
 from .config import azure_settings
+from ._blobservice import LocalBlockBlobService
 
 
 if platform.system()=="Windows":
@@ -132,10 +136,10 @@ class AzureBlobServiceTest(unittest.TestCase):
         self.mock_blob_service.create_blob_from_path.assert_called_with(
             "test", 'blobname', 'filepath')
 
-    @mock.patch.object(AzureBlobService, 'list_blobs')
+    @mock.patch.object(AzureBlobService, 'get_index')
     @mock.patch.object(AzureBlobService, 'create_container')
     @mock.patch.object(AzureBlobService, 'create_blob_from_path')
-    def test_upload(self, mock_create_blob, mock_create_container, mock_list_blobs):
+    def test_upload(self, mock_create_blob, mock_create_container, mock_get_index):
         blob_pairs = [
             ('to/blob1.txt', '/path/to/file1.txt'),
             ('to\\blob2.txt', '\\path\\to\\file2.txt'),
@@ -145,7 +149,7 @@ class AzureBlobServiceTest(unittest.TestCase):
         # container and some blobs were created before,
         # and upload with overwritting
         self.mock_blob_service.exists = mock.Mock(return_value=True)
-        mock_list_blobs.return_value = ['to/blob1.txt', 'to/blob2.txt']
+        mock_get_index.return_value = ContainerIndex('test', ['to/blob1.txt', 'to/blob2.txt'])
         six.assertCountEqual(
             self,
             self.azure_handler.upload('test', blob_pairs, overwrite=False),
@@ -168,7 +172,9 @@ class AzureBlobServiceTest(unittest.TestCase):
                 mock.call('test', 'to/blob1.txt', '/path/to/file1.txt'),
                 mock.call('test', 'to/blob2.txt', '\\path\\to\\file2.txt'),
                 mock.call('test', 'to/blob3.txt', '/path/to/file3.txt')
-            ]
+            ],
+            # blobs are uploaded concurrently
+            any_order=True
         )
 
         # container was not exist
@@ -186,9 +192,9 @@ class AzureBlobServiceTest(unittest.TestCase):
         self.mock_blob_service.get_blob_to_path.assert_called_with(
             "test", "to/blob1.txt", "/path/to/blob1.txt")
 
-    @mock.patch.object(AzureBlobService, 'list_blobs')
+    @mock.patch.object(AzureBlobService, 'get_index')
     @mock.patch.object(AzureBlobService, 'get_blob_to_path')
-    def test_download(self, mock_get_blob, mock_list_blobs):
+    def test_download(self, mock_get_blob, mock_get_index):
 
         # case 1. the container does not exist
         self.mock_blob_service.exists = mock.Mock(return_value=False)
@@ -201,9 +207,9 @@ class AzureBlobServiceTest(unittest.TestCase):
 
         # case 2. the container exists and `blob_names` was not specified
         self.mock_blob_service.exists = mock.Mock(return_value=True)
-        mock_list_blobs.return_value = [
+        mock_get_index.return_value = ContainerIndex('test', [
             'to/blob1.txt', 'to/blob2.txt', 'to/blob3.txt'
-        ]
+        ])
         six.assertCountEqual(
             self,
             self.azure_handler.download('test', 'dest'),
@@ -271,12 +277,12 @@ class AzureBlobServiceTest(unittest.TestCase):
             self.azure_handler.delete_blobs('test', blob_names),
             [])
 
-    @mock.patch.object(AzureBlobService, 'list_blobs')
-    def test_copy_blobs(self, mock_list_blobs):
+    @mock.patch.object(AzureBlobService, 'get_index')
+    def test_copy_blobs(self, mock_get_index):
         # case 1. `blob_names` was set to None but src_container was given
-        mock_list_blobs.return_value = [
+        mock_get_index.return_value = ContainerIndex('source', [
             'to/blob1.txt', 'to/blob1.wav', 'to/blob2.txt'
-        ]
+        ])
         azure_host = "test.blob.endpoint"
         six.assertCountEqual(
             self,
@@ -288,7 +294,9 @@ class AzureBlobServiceTest(unittest.TestCase):
                 mock.call('test', 'to/blob1.txt', 'http://{}/source/to/blob1.txt'.format(azure_host)),
                 mock.call('test', 'to/blob1.wav', 'http://{}/source/to/blob1.wav'.format(azure_host)),
                 mock.call('test', 'to/blob2.txt', 'http://{}/source/to/blob2.txt'.format(azure_host)),
-            ])
+            ],
+            # copies are started concurrently
+            any_order=True)
 
         six.assertCountEqual(
             self,
@@ -304,11 +312,11 @@ class AzureBlobServiceTest(unittest.TestCase):
         with self.assertRaises(ImproperlyConfigured):
             self.azure_handler.copy_blobs(None, 'test', None)
 
-    @mock.patch.object(AzureBlobService, 'list_blobs')
-    def test_copy_container(self, mock_list_blobs):
-        mock_list_blobs.return_value = [
+    @mock.patch.object(AzureBlobService, 'get_index')
+    def test_copy_container(self, mock_get_index):
+        mock_get_index.return_value = ContainerIndex('source', [
             'to/blob1.txt', 'to/blob1.wav', 'to/blob2.txt'
-        ]
+        ])
         azure_host = "test.blob.endpoint"
 
         self.azure_handler.copy_container('source', 'test', pattern=None)
@@ -321,4 +329,244 @@ class AzureBlobServiceTest(unittest.TestCase):
             mock.call('test', 'to/blob1.txt', 'http://{}/source/to/blob1.txt'.format(azure_host)),
             mock.call('test', 'to/blob1.wav', 'http://{}/source/to/blob1.wav'.format(azure_host)),
             mock.call('test', 'to/blob2.txt', 'http://{}/source/to/blob2.txt'.format(azure_host))
-        ])
+        ], any_order=True)
+
+
+class AzureTransferTest(unittest.TestCase):
+    """
+    Tests transfers against the local stand-in of `BlockBlobService`.
+    """
+
+    def setUp(self):
+        self.blob_service = LocalBlockBlobService()
+        self.azure_patcher = mock.patch(
+            "moose.connection.cloud.BlockBlobService", return_value=self.blob_service)
+        self.azure_patcher.start()
+        self.azure_handler = AzureBlobService(azure_settings)
+        self.azure_handler.nworkers = 4
+        self.azure_handler.retry_interval = 0
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.blob_pairs = []
+        for i in range(10):
+            filepath = join(self.tmpdir, 'file{}.txt'.format(i))
+            with open(filepath, 'w') as f:
+                f.write('content{}'.format(i))
+            self.blob_pairs.append(('to/blob{}.txt'.format(i), filepath))
+        self.blob_names = [blob_name for blob_name, _ in self.blob_pairs]
+        self.journal_path = join(self.tmpdir, 'journals', 'test.journal')
+
+    def tearDown(self):
+        self.azure_patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_upload(self):
+        stats = mock.Mock()
+        six.assertCountEqual(
+            self, self.azure_handler.upload('test', self.blob_pairs, stats=stats),
+            self.blob_names)
+        self.assertEqual(self.blob_service.containers['test']['to/blob3.txt'], b'content3')
+
+        # blobs existed are skipped
+        self.assertEqual(self.azure_handler.upload('test', self.blob_pairs, stats=stats), [])
+        stats.inc_value.assert_any_call("upload/skipped", 10)
+
+    def test_upload_retry(self):
+        self.blob_service.failures = {'to/blob1.txt': 2, 'to/blob2.txt': 5}
+        stats = mock.Mock()
+        blobs = self.azure_handler.upload('test', self.blob_pairs, stats=stats)
+
+        six.assertCountEqual(
+            self, blobs, [name for name in self.blob_names if name != 'to/blob2.txt'])
+        # blob2 was requested once and retried for `max_retries` times
+        self.assertEqual(self.blob_service.requests.count('to/blob1.txt'), 3)
+        self.assertEqual(
+            self.blob_service.requests.count('to/blob2.txt'),
+            self.azure_handler.max_retries + 1)
+        stats.inc_value.assert_any_call("upload/failed", 1)
+
+    def test_upload_resume(self):
+        self.blob_service.failures = {'to/blob2.txt': 10}
+        journal = UploadJournal(self.journal_path)
+        self.azure_handler.upload('test', self.blob_pairs, overwrite=True, journal=journal)
+        journal.close()
+
+        # blobs uploaded are recorded, and the journal is kept to resume
+        journal = UploadJournal(self.journal_path)
+        self.assertEqual(len(journal.entries), 9)
+        self.assertFalse(journal.is_done('to/blob2.txt', self.blob_pairs[2][1]))
+        self.assertTrue(journal.is_done('to/blob3.txt', self.blob_pairs[3][1]))
+
+        # sends the ones failed only even if overwriting
+        self.blob_service.failures = {}
+        self.blob_service.requests = []
+        self.assertEqual(
+            self.azure_handler.upload('test', self.blob_pairs, overwrite=True, journal=journal),
+            ['to/blob2.txt'])
+        self.assertEqual(self.blob_service.requests, ['to/blob2.txt'])
+        # removed once all files were uploaded
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_get_index(self):
+        self.azure_handler.upload('test', self.blob_pairs)
+        index = self.azure_handler.get_index('test')
+        six.assertCountEqual(self, index.names, self.blob_names)
+        self.assertIn('to/blob3.txt', index)
+        self.assertNotIn('to/blob10.txt', index)
+        self.assertEqual(index.get_size('to/blob3.txt'), len(b'content3'))
+        self.assertIsNotNone(index.get_etag('to/blob3.txt'))
+
+        # the container doesn't exist
+        self.assertEqual(len(self.azure_handler.get_index('missing')), 0)
+
+    def test_cached_index(self):
+        self.azure_handler.index_dirname = join(self.tmpdir, 'indexes')
+        self.azure_handler.index_lifetime = 60
+        self.azure_handler.upload('test', self.blob_pairs[:5])
+        self.azure_handler.get_index('test')
+
+        # blobs created elsewhere are not seen until the index expired
+        self.blob_service.containers['test']['to/blob5.txt'] = b'content5'
+        self.assertNotIn('to/blob5.txt', self.azure_handler.get_index('test'))
+        self.assertIn('to/blob5.txt', self.azure_handler.get_index('test', refresh=True))
+
+        # blobs uploaded are added to the cached index
+        self.azure_handler.upload('test', self.blob_pairs[6:])
+        self.assertIn('to/blob9.txt', self.azure_handler.get_index('test'))
+
+        # and it's invalidated once blobs were deleted
+        self.azure_handler.delete_blobs('test', ['to/blob9.txt'])
+        self.assertNotIn('to/blob9.txt', self.azure_handler.get_index('test'))
+
+        self.azure_handler.index_lifetime = 0
+        self.blob_service.containers['test']['to/blob0.txt'] = b'modified'
+        self.assertEqual(self.azure_handler.get_index('test').get_size('to/blob0.txt'), 8)
+
+    def test_sync(self):
+        cache = ChecksumCache(join(self.tmpdir, 'checksums', 'test.json'))
+        stats = mock.Mock()
+        six.assertCountEqual(
+            self, self.azure_handler.sync('test', self.blob_pairs, cache=cache),
+            self.blob_names)
+        # nothing changed
+        self.assertEqual(self.azure_handler.sync('test', self.blob_pairs, cache=cache, stats=stats), [])
+        stats.inc_value.assert_any_call("upload/unchanged", 10)
+        stats.inc_value.assert_any_call("upload/hashed", 0)
+
+        # modified with the same size, and changed remotely
+        with open(self.blob_pairs[1][1], 'w') as f:
+            f.write('CONTENT1')
+        self.blob_service.containers['test']['to/blob2.txt'] = b'changed'
+        self.assertEqual(
+            sorted(self.azure_handler.sync('test', self.blob_pairs, cache=ChecksumCache(cache.filepath))),
+            ['to/blob1.txt', 'to/blob2.txt'])
+        self.assertEqual(self.blob_service.containers['test']['to/blob1.txt'], b'CONTENT1')
+
+    def test_checksum_cache(self):
+        filepath = self.blob_pairs[0][1]
+        cache = ChecksumCache(join(self.tmpdir, 'checksums', 'test.json'))
+        self.assertIsNone(cache.get(filepath))
+        cache.set(filepath, 'md5')
+        cache.save()
+
+        cache = ChecksumCache(cache.filepath)
+        self.assertEqual(cache.get(filepath), 'md5')
+        with open(filepath, 'w') as f:
+            f.write('modified content')
+        self.assertIsNone(cache.get(filepath))
+
+    def test_upload_blocks(self):
+        large = join(self.tmpdir, 'large.bin')
+        content = os.urandom(1000)
+        with open(large, 'wb') as f:
+            f.write(content)
+        self.azure_handler.block_threshold = 100
+        self.azure_handler.block_size = 64
+        self.azure_handler.small_file_batch = 3
+        self.blob_service.failures = {'to/large.bin': 2}
+        stats = mock.Mock()
+
+        six.assertCountEqual(
+            self, self.azure_handler.upload('test', self.blob_pairs + [('to/large.bin', large)], stats=stats),
+            self.blob_names + ['to/large.bin'])
+        self.assertEqual(self.blob_service.containers['test']['to/large.bin'], content)
+        self.assertEqual(self.blob_service.containers['test']['to/blob9.txt'], b'content9')
+        # 16 blocks were put, 2 of them retried
+        self.assertEqual(self.blob_service.requests.count('to/large.bin'), 18)
+        stats.inc_value.assert_any_call("upload/bytes", 1000)
+        self.assertTrue(stats.max_value.called)
+
+    def test_upload_blocks_failed(self):
+        large = join(self.tmpdir, 'large.bin')
+        with open(large, 'wb') as f:
+            f.write(os.urandom(1000))
+        self.azure_handler.block_threshold = 100
+        self.azure_handler.block_size = 64
+        self.azure_handler.block_workers = 1
+        self.blob_service.failures = {'to/large.bin': self.azure_handler.max_retries + 1}
+        stats = mock.Mock()
+
+        self.assertEqual(self.azure_handler.upload('test', [('to/large.bin', large)], stats=stats), [])
+        # the first block failed, which is retried on its own, but the file
+        # is never uploaded again as a whole
+        self.assertEqual(
+            self.blob_service.requests.count('to/large.bin'), 16 + self.azure_handler.max_retries)
+        stats.inc_value.assert_any_call("upload/retry", self.azure_handler.max_retries)
+
+    def test_batch_tasks(self):
+        self.azure_handler.small_file_size = 8
+        self.azure_handler.small_file_batch = 4
+        large = join(self.tmpdir, 'large.bin')
+        with open(large, 'wb') as f:
+            f.write(b'0' * 100)
+        tasks = [('test', name, filepath, None) for name, filepath in self.blob_pairs]
+        tasks.append(('test', 'to/large.bin', large, None))
+
+        batches = self.azure_handler.batch_tasks(tasks)
+        self.assertEqual([len(batch) for batch in batches], [1, 4, 4, 2])
+        self.assertEqual(batches[0][0][1], 'to/large.bin')
+
+    def test_copy_blobs(self):
+        self.azure_handler.upload('source', self.blob_pairs)
+        self.azure_handler.copy_window = 3
+        self.azure_handler.copy_poll_interval = 0
+        self.blob_service.copy_polls = 2
+        self.blob_service.failures = {'to/blob1.txt': 2, 'to/blob2.txt': 10}
+        self.blob_service.nlisted = 0
+        stats = mock.Mock()
+
+        blobs = self.azure_handler.copy_container('source', 'test', stats=stats)
+        six.assertCountEqual(
+            self, blobs, [name for name in self.blob_names if name != 'to/blob2.txt'])
+        self.assertEqual(self.blob_service.containers['test']['to/blob3.txt'], b'content3')
+        stats.inc_value.assert_any_call("copy/copied", 9)
+        stats.inc_value.assert_any_call("copy/retry", 2 + self.azure_handler.max_retries)
+        stats.inc_value.assert_any_call("copy/failed", 1)
+        # copies in progress are polled blob by blob, only the source is
+        # listed to get its index
+        self.assertEqual(self.blob_service.nlisted, 1)
+
+    def test_copy_timeout(self):
+        self.azure_handler.upload('source', self.blob_pairs[:3])
+        self.azure_handler.copy_poll_interval = 0
+        self.azure_handler.copy_timeout = 0
+        self.blob_service.copy_polls = 100
+
+        self.assertEqual(self.azure_handler.copy_container('source', 'test'), [])
+        six.assertCountEqual(
+            self, self.blob_service.aborted, [('test', name) for name in self.blob_names[:3]])
+
+    def test_journal_modified(self):
+        blob_name, filepath = self.blob_pairs[0]
+        journal = UploadJournal(self.journal_path)
+        journal.record(blob_name, filepath)
+        journal.close()
+
+        with open(filepath, 'w') as f:
+            f.write('modified content')
+        self.assertFalse(UploadJournal(self.journal_path).is_done(blob_name, filepath))
+
+        # an incomplete line written when crashed is ignored
+        with open(self.journal_path, 'a') as f:
+            f.write('to/blob1.txt\t8')
+        self.assertEqual(len(UploadJournal(self.journal_path).entries), 1)
@@ -0,0 +1,336 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+import os
+import shutil
+import time
+import tempfile
+import threading
+import unittest
+import mock
+from moose.utils.six.moves import BaseHTTPServer, socketserver, http_client
+from moose.utils.six.moves.urllib.request import pathname2url
+from moose.actions.stats import StatsCollector
+from moose.connection.http import \
+    HTTPClient, HTTPError, IncompleteDownload, DownloadCancelled, DNSCache, \
+    AdaptiveConcurrency, HedgingPolicy, get_part_path, get_validator_path, \
+    record_latency
+
+
+CONTENT = bytes(bytearray(range(256))) * 1000
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keeps connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        self.server.ranges.append(self.headers.get('Range'))
+        self.server.proxy_authorization.append(self.headers.get('Proxy-Authorization'))
+        if self.path == '/missing':
+            self.send_error(404)
+            return
+        if not self.path.startswith('/content'):
+            body = self.path.encode('ascii')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # serves a range of the content, and is interrupted at the half
+        # of it if requested '/content/broken', or stalled for the first
+        # request of '/content/slow'
+        if self.path == '/content/slow' and not self.server.stalled:
+            self.server.stalled = True
+            time.sleep(1)
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == self.server.etag:
+            start = int(self.headers['Range'][len('bytes='):-1])
+        body = CONTENT[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+        if self.path == '/content/broken':
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(('127.0.0.1', 0), Handler)
+        cls.server.clients = set()
+        cls.url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.clients.clear()
+        self.server.ranges = []
+        self.server.proxy_authorization = []
+        self.server.stalled = False
+        self.server.etag = '"v1"'
+        self.stats = StatsCollector(mock.Mock(stats_dump=False))
+        self.client = HTTPClient(pool_size=2, timeout=5, dns_ttl=60, stats=self.stats)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_keep_alive(self):
+        for i in range(5):
+            self.assertEqual(self.client.get(self.url + '/file{}.jpg'.format(i)),
+                             '/file{}.jpg'.format(i).encode('ascii'))
+        # all requests were sent on the same connection
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual(self.stats.get_value('download/latency_ms/count'), 5)
+
+    def test_pool_size(self):
+        responses = [self.client.request(self.url + '/{}'.format(i)) for i in range(3)]
+        for response in responses:
+            response.read()
+        self.assertEqual(len(self.server.clients), 3)
+        # only `pool_size` connections are kept
+        pool, = self.client.pools.values()
+        self.assertEqual(len(pool.idle), 2)
+
+    def test_stale_connection(self):
+        self.client.get(self.url + '/a')
+        pool, = self.client.pools.values()
+        # closed while idle as if by the server
+        pool.idle[0].sock.close()
+        self.assertEqual(self.client.get(self.url + '/b'), b'/b')
+
+    def test_http_error(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.client.get(self.url + '/missing')
+        self.assertEqual(cm.exception.status, 404)
+        self.assertEqual(self.client.get(self.url + '/a'), b'/a')
+
+    def test_file_url(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'file.txt')
+            with open(filepath, 'wb') as f:
+                f.write(b'content')
+            self.assertEqual(self.client.get('file:' + pathname2url(filepath)), b'content')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_proxy(self):
+        environ = {'http_proxy': 'http://user:secret@' + self.url[len('http://'):],
+                   'no_proxy': 'excluded.invalid'}
+        with mock.patch.dict(os.environ, environ):
+            client = HTTPClient(pool_size=2, timeout=5, dns_ttl=60)
+            try:
+                # the proxy is requested with the absolute url
+                self.assertEqual(client.get('http://example.invalid/a.jpg'),
+                                 b'http://example.invalid/a.jpg')
+                self.assertEqual(self.server.proxy_authorization[-1],
+                                 'Basic dXNlcjpzZWNyZXQ=')
+                with self.assertRaises(IOError):
+                    client.get('http://excluded.invalid/a.jpg')
+            finally:
+                client.close()
+
+    def test_download(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'content.bin')
+            self.client.chunk_size = 1000
+            self.assertEqual(self.client.download(self.url + '/content', filepath), len(CONTENT))
+            with open(filepath, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertFalse(os.path.exists(get_part_path(filepath)))
+            self.assertEqual(self.stats.get_value('download/bytes'), len(CONTENT))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_download_resumed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'content.bin')
+            with self.assertRaises((IncompleteDownload, http_client.IncompleteRead)):
+                self.client.download(self.url + '/content/broken', filepath)
+            self.assertFalse(os.path.exists(filepath))
+            size = os.path.getsize(get_part_path(filepath))
+            self.assertEqual(size, len(CONTENT) // 2)
+
+            # only the rest is requested
+            self.assertEqual(self.client.download(self.url + '/content', filepath),
+                             len(CONTENT) - size)
+            self.assertEqual(self.server.ranges[-1], 'bytes={}-'.format(size))
+            with open(filepath, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertEqual(self.stats.get_value('download/resumed'), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_download_changed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'content.bin')
+            with self.assertRaises((IncompleteDownload, http_client.IncompleteRead)):
+                self.client.download(self.url + '/content/broken', filepath)
+            self.assertTrue(os.path.exists(get_validator_path(get_part_path(filepath))))
+
+            # the whole file is sent again once it was changed
+            self.server.etag = '"v2"'
+            self.assertEqual(self.client.download(self.url + '/content', filepath), len(CONTENT))
+            self.assertEqual(self.server.ranges[-1], 'bytes={}-'.format(len(CONTENT) // 2))
+            with open(filepath, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertIsNone(self.stats.get_value('download/resumed'))
+            self.assertEqual(os.listdir(tmpdir), ['content.bin'])
+
+            # a part without the validator is never resumed
+            with open(get_part_path(filepath), 'wb') as f:
+                f.write(b'stale')
+            self.client.download(self.url + '/content', filepath)
+            self.assertIsNone(self.server.ranges[-1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_download_cancelled(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'content.bin')
+            with self.assertRaises(DownloadCancelled):
+                self.client.download(self.url + '/content', filepath, cancelled=lambda: True)
+            self.assertFalse(os.path.exists(filepath))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_hedged_download(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'content.bin')
+            self.assertEqual(self.client.hedged_download(self.url + '/content/slow', filepath, 0.1),
+                             len(CONTENT))
+            with open(filepath, 'rb') as f:
+                self.assertEqual(f.read(), CONTENT)
+            self.assertEqual(self.stats.get_value('download/hedged'), 1)
+            self.assertEqual(self.stats.get_value('download/hedge_won'), 1)
+            # the stalled one is cancelled and its part is removed
+            for _ in range(50):
+                if os.listdir(tmpdir) == ['content.bin']:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(os.listdir(tmpdir), ['content.bin'])
+
+            # not hedged if completed in time
+            self.assertEqual(self.client.hedged_download(self.url + '/content', filepath, 5),
+                             len(CONTENT))
+            self.assertEqual(self.stats.get_value('download/hedged'), 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_get_cancelled(self):
+        self.client.chunk_size = 1000
+        self.assertEqual(self.client.get(self.url + '/content', cancelled=lambda: False), CONTENT)
+        with self.assertRaises(DownloadCancelled):
+            self.client.get(self.url + '/content', cancelled=lambda: True)
+        with self.assertRaises((IncompleteDownload, http_client.IncompleteRead)):
+            self.client.get(self.url + '/content/broken', cancelled=lambda: False)
+
+    def test_hedged_get(self):
+        self.assertEqual(self.client.hedged_get(self.url + '/content/slow', 0.1), CONTENT)
+        self.assertEqual(self.stats.get_value('download/hedged'), 1)
+        self.assertEqual(self.stats.get_value('download/hedge_won'), 1)
+
+    def test_hedging_policy(self):
+        policy = HedgingPolicy(90, min_samples=10)
+        for i in range(9):
+            policy.record(i + 1)
+        self.assertIsNone(policy.get_delay())
+        policy.record(10)
+        self.assertEqual(policy.get_delay(), 9)
+
+    def test_dns_cache(self):
+        dns = DNSCache(ttl=60)
+        with mock.patch('moose.connection.http.socket.getaddrinfo') as mock_getaddrinfo:
+            mock_getaddrinfo.return_value = [(2, 1, 6, '', ('10.0.0.1', 80))]
+            self.assertEqual(dns.resolve('example.com', 80), '10.0.0.1')
+            self.assertEqual(dns.resolve('example.com', 80), '10.0.0.1')
+            self.assertEqual(mock_getaddrinfo.call_count, 1)
+            dns.ttl = 0
+            dns.resolve('example.com', 80)
+            self.assertEqual(mock_getaddrinfo.call_count, 2)
+
+    def test_record_latency(self):
+        record_latency(self.stats, 'download/latency_ms', 0.02)
+        record_latency(self.stats, 'download/latency_ms', 0.3)
+        record_latency(self.stats, 'download/latency_ms', 20)
+        self.assertEqual(self.stats.get_value('download/latency_ms/le_25'), 1)
+        self.assertEqual(self.stats.get_value('download/latency_ms/le_500'), 1)
+        self.assertEqual(self.stats.get_value('download/latency_ms/le_inf'), 1)
+        self.assertEqual(self.stats.get_value('download/latency_ms/count'), 3)
+        self.assertEqual(self.stats.get_value('download/latency_ms/max'), 20000)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = StatsCollector(mock.Mock(stats_dump=False))
+        self.limiter = AdaptiveConcurrency(2, 8, initial=4, stats=self.stats)
+        # ignores the throughput, which depends on the speed of tests
+        self.limiter.throughput_tolerance = 0
+
+    def complete(self, n, latency=0.1, succeed=True):
+        for _ in range(n):
+            self.limiter.acquire()
+            self.limiter.release(latency, succeed)
+
+    def test_additive_increase(self):
+        self.complete(4)
+        self.assertEqual(self.limiter.limit, 5)
+        self.complete(5 + 6 + 7 + 8 + 8)
+        self.assertEqual(self.limiter.limit, 8)
+        self.assertEqual(self.stats.get_value('download/concurrency'), 8)
+        self.assertEqual([limit for _, limit in self.stats.get_value('download/concurrency_history')],
+                         [4, 5, 6, 7, 8])
+
+    def test_multiplicative_decrease(self):
+        self.complete(3)
+        self.complete(1, succeed=False)
+        self.assertEqual(self.limiter.limit, 2)
+        self.complete(2, succeed=False)
+        self.assertEqual(self.limiter.limit, 2)
+        self.assertEqual(self.stats.get_value('download/concurrency_min'), 2)
+
+    def test_latency(self):
+        self.complete(4, latency=0.1)
+        self.assertEqual(self.limiter.limit, 5)
+        self.complete(5, latency=0.5)
+        self.assertEqual(self.limiter.limit, 2)
+
+    def test_acquire(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        acquired = threading.Event()
+        def acquire():
+            self.limiter.acquire()
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        self.limiter.release(0.1)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
@@ -0,0 +1,127 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+import os
+from os.path import join
+import shutil
+import tempfile
+import unittest
+import mock
+from azure.common import AzureHttpError, AzureConflictHttpError, AzureMissingResourceHttpError
+from azure.storage.blob.models import BlobBlock
+from moose.utils import six
+from moose.connection.cloud import AzureBlobService
+from moose.connection.storage import LocalBlobStorage
+
+
+class LocalBlobStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings_dict = {
+            'ACCOUNT': 'local',
+            'KEY': '',
+            'ENDPOINT': 'localhost',
+            'TIMEOUT': 300,
+            'BACKEND': 'moose.connection.storage.LocalBlobStorage',
+            'ROOT': join(self.tmpdir, 'blobs'),
+        }
+        self.storage = LocalBlobStorage(self.settings_dict)
+        self.filepath = join(self.tmpdir, 'file.txt')
+        with open(self.filepath, 'wb') as f:
+            f.write(b'content')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_container(self):
+        self.assertFalse(self.storage.exists('test'))
+        self.assertTrue(self.storage.create_container('test'))
+        self.assertTrue(self.storage.exists('test'))
+        self.assertFalse(self.storage.create_container('test'))
+        with self.assertRaises(AzureConflictHttpError):
+            self.storage.create_container('test', fail_on_exist=True)
+        self.assertEqual([c.name for c in self.storage.list_containers()], ['test'])
+        with self.assertRaises(AzureMissingResourceHttpError):
+            self.storage.list_blobs('missing')
+
+    def test_blob(self):
+        self.storage.create_container('test')
+        self.storage.create_blob_from_path('test', 'to/blob.txt', self.filepath)
+        self.assertTrue(self.storage.exists('test', 'to/blob.txt'))
+
+        blob, = self.storage.list_blobs('test')
+        self.assertEqual(blob.name, 'to/blob.txt')
+        self.assertEqual(blob.properties.content_length, 7)
+        # Content-MD5 is computed when put
+        self.assertEqual(blob.properties.content_settings.content_md5, 'mgNkuembtIDdJeHwKEyFVQ==')
+
+        dest = join(self.tmpdir, 'dest', 'blob.txt')
+        self.storage.get_blob_to_path('test', 'to/blob.txt', dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'content')
+
+        self.storage.create_container('copied')
+        copy = self.storage.copy_blob(
+            'copied', 'blob.txt', 'http://local.blob.localhost/test/to/blob.txt')
+        self.assertEqual(copy.status, 'success')
+        self.assertEqual(
+            self.storage.get_blob_properties('copied', 'blob.txt').properties.content_length, 7)
+
+        self.storage.delete_blob('test', 'to/blob.txt')
+        self.assertEqual(self.storage.list_blobs('test'), [])
+        with self.assertRaises(AzureMissingResourceHttpError):
+            self.storage.delete_blob('test', 'to/blob.txt')
+
+    def test_blocks(self):
+        self.storage.create_container('test')
+        self.storage.put_block('test', 'blob.bin', b'1234', 'MDAwMDAwMDE=')
+        self.storage.put_block('test', 'blob.bin', b'abcd', 'MDAwMDAwMDA=')
+        self.assertFalse(self.storage.exists('test', 'blob.bin'))
+
+        block_list = [BlobBlock('MDAwMDAwMDA='), BlobBlock('MDAwMDAwMDE=')]
+        self.storage.put_block_list('test', 'blob.bin', block_list)
+        dest = join(self.tmpdir, 'blob.bin')
+        self.storage.get_blob_to_path('test', 'blob.bin', dest)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'abcd1234')
+        # blocks were removed once committed
+        with self.assertRaises(AzureHttpError):
+            self.storage.put_block_list('test', 'blob.bin', block_list)
+
+    @mock.patch('moose.connection.storage.time.sleep')
+    def test_delay(self, mock_sleep):
+        self.storage.latency = 0.5
+        self.storage.bandwidth = 7
+        self.storage.create_container('test')
+        mock_sleep.assert_called_with(0.5)
+        mock_sleep.reset_mock()
+        self.storage.create_blob_from_path('test', 'blob.txt', self.filepath)
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(0.5), mock.call(1.0)])
+
+        # the latency is charged once however many chunks were transferred
+        mock_sleep.reset_mock()
+        self.storage.chunk_size = 2
+        self.storage.create_blob_from_path('test', 'blob.txt', self.filepath)
+        self.assertEqual(
+            mock_sleep.call_args_list,
+            [mock.call(0.5)] + [mock.call(2 / 7.0)] * 3 + [mock.call(1 / 7.0)])
+
+    def test_azure_blob_service(self):
+        azure = AzureBlobService(self.settings_dict)
+        self.assertIsInstance(azure.block_blob_service, LocalBlobStorage)
+
+        azure.block_threshold = 4
+        azure.block_size = 2
+        blob_pairs = [('to/blob.txt', self.filepath)]
+        self.assertEqual(azure.upload('test', blob_pairs), ['to/blob.txt'])
+        # Content-MD5 of blobs put in blocks is unknown until set by sync
+        self.assertEqual(azure.sync('test', blob_pairs), ['to/blob.txt'])
+        self.assertEqual(azure.sync('test', blob_pairs), [])
+        self.assertEqual(azure.list_blobs('test'), ['to/blob.txt'])
+        self.assertEqual(
+            azure.download('test', join(self.tmpdir, 'dest')), ['to/blob.txt'])
+        azure.copy_container('test', 'copied', pattern='*.txt')
+        self.assertEqual(azure.get_index('copied').get_content_md5('to/blob.txt'),
+                         azure.get_index('test').get_content_md5('to/blob.txt'))
+        azure.delete_blobs('test', ['to/blob.txt'])
+        self.assertEqual(azure.list_blobs('test'), [])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from moose.core.cache import DataCache
+
+
+class DataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.stats = mock.Mock()
+        self.cache = DataCache(self.dirname, lifetime=1, max_size=1024**2, stats=self.stats)
+        self.cache.chunk_size = 3
+        self.records = [{'_guid': str(i), 'data': 'x' * i} for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def stats_calls(self, key):
+        return [c for c in self.stats.inc_value.call_args_list if c[0][0] == key]
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(len(self.stats_calls('cache/miss')), 1)
+
+    def test_set_and_get(self):
+        # records are passed through while writing
+        self.assertEqual(list(self.cache.iter_set('key', iter(self.records))), self.records)
+        self.assertEqual(list(self.cache.get('key')), self.records)
+        self.assertEqual(len(self.stats_calls('cache/hit')), 1)
+        self.assertEqual(
+            sum(c[0][1] for c in self.stats_calls('cache/bytes_written')),
+            sum(c[0][1] for c in self.stats_calls('cache/bytes_read')))
+        self.assertEqual(os.listdir(self.dirname), [self.cache.get_cache_id('key')])
+
+    def test_uncompleted(self):
+        records = self.cache.iter_set('key', iter(self.records))
+        for i, record in enumerate(records):
+            if i == 5:
+                break
+        records.close()
+        # nothing was committed
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(os.listdir(self.dirname), [])
+
+    def test_expired(self):
+        self.cache.set('key', self.records)
+        with mock.patch('moose.core.cache.time.time', return_value=time.time()+3601):
+            self.assertIsNone(self.cache.get('key'))
+
+    def test_version(self):
+        self.cache.set('key', self.records)
+        self.cache.version += 1
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_evict(self):
+        self.cache.set('key1', self.records)
+        self.cache.set('key2', self.records)
+        size = os.path.getsize(self.cache.get_path('key1'))
+        # key1 was used recently
+        past = time.time() - 100
+        os.utime(self.cache.get_path('key2'), (past, past))
+        self.cache.max_size = size * 2
+        self.cache.set('key3', self.records)
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertIsNotNone(self.cache.get('key1'))
+        self.assertIsNotNone(self.cache.get('key3'))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from moose.core.manifest import ExportManifest
+
+
+class ExportManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, '.manifests', '1.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def touch(self, relpath):
+        path = os.path.join(self.root, relpath)
+        with open(path, 'w') as f:
+            f.write(relpath)
+        return path
+
+    def test_first_export(self):
+        manifest = ExportManifest.load(self.path, self.root)
+        self.assertIsNone(manifest.watermark)
+        self.assertIsNone(manifest.since())
+
+    def test_save_and_load(self):
+        manifest = ExportManifest.load(self.path, self.root)
+        manifest.add('r1', self.touch('a.json'))
+        manifest.add('r1', self.touch('a.png'))
+        manifest.add('r2', self.touch('b.json'))
+        manifest.save()
+
+        manifest = ExportManifest.load(self.path, self.root)
+        self.assertEqual(manifest.outputs, {'r1': ['a.json', 'a.png'], 'r2': ['b.json']})
+        self.assertAlmostEqual(manifest.watermark, time.time(), delta=5)
+        self.assertEqual(
+            manifest.since(60),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest.watermark - 60)))
+
+    def test_stale_outputs(self):
+        manifest = ExportManifest.load(self.path, self.root)
+        manifest.add('r1', self.touch('a.json'))
+        manifest.add('r1', self.touch('a.png'))
+        manifest.add('r2', self.touch('b.json'))
+        manifest.save()
+
+        manifest = ExportManifest.load(self.path, self.root)
+        # r1 was renamed and r2 became ineffective
+        manifest.add('r1', self.touch('c.json'))
+        manifest.discard('r2')
+        manifest.save()
+        self.assertEqual(manifest.outputs, {'r1': ['c.json']})
+        self.assertEqual(sorted(os.listdir(self.root)), ['.manifests', 'c.json'])
+
+    def test_broken(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{')
+        manifest = ExportManifest.load(self.path, self.root)
+        self.assertIsNone(manifest.watermark)
@@ -4,6 +4,7 @@ import mock
 
 from moose.core.exceptions import \
     ConnectionTimeout, SuspiciousOperation, ImproperlyConfigured
+from moose.connection import pool
 from moose.conf import settings
 
 
@@ -28,6 +29,8 @@ class SQLHandlerBaseTest(object):
     def tearDown(self):
         self.time_patcher.stop()
         self.connect_patcher.stop()
+        # connections are not shared between tests
+        pool.close_all()
 
     def init_sqlhandler(self, settings_dict=None):
         raise NotImplementedError
@@ -46,7 +49,16 @@ class SQLHandlerBaseTest(object):
     def test_connect(self):
         sql_handler = self.init_sqlhandler()
         self.assertEqual(self.mock_connect.call_count, 1)
-        self.assertIs(sql_handler._conn, self.mock_conn)
+        # the connection is returned to the pool
+        self.assertIs(sql_handler._conn, None)
+        self.assertIs(sql_handler._pool.acquire(), self.mock_conn)
+
+    def test_pooled(self):
+        sql_handler = self.init_sqlhandler()
+        another_handler = self.init_sqlhandler()
+        self.assertIs(sql_handler._pool, another_handler._pool)
+        another_handler.execute("operation", mock.Mock())
+        self.assertEqual(self.mock_connect.call_count, 1)
 
     def test_execute(self):
         sql_handler = self.init_sqlhandler()
@@ -72,6 +84,23 @@ class SQLHandlerBaseTest(object):
         sql_handler.exec_query("$table_source")
         self.mock_cursor.execute.assert_called_once_with("[10.0.0.201].CrowdDB.dbo.DataSource")
 
+    def test_iter_query(self):
+        sql_handler = self.init_sqlhandler()
+
+        with self.assertRaises(SuspiciousOperation):
+            list(sql_handler.iter_query(None))
+
+        self.mock_cursor.fetchmany.side_effect = [[1, 2], [3], []]
+        rows = sql_handler.iter_query("$table_source", 2)
+        self.assertEqual(next(rows), 1)
+        # the connection is borrowed by the generator only
+        self.assertIs(sql_handler._conn, None)
+        self.assertEqual(sql_handler._pool.nidle, 0)
+        self.assertEqual(list(rows), [2, 3])
+        self.mock_cursor.execute.assert_called_once_with("[10.0.0.201].CrowdDB.dbo.DataSource")
+        self.mock_cursor.fetchmany.assert_called_with(2)
+        self.assertEqual(sql_handler._pool.nidle, 1)
+
     def test_commit(self):
         sql_handler = self.init_sqlhandler()
 
@@ -94,12 +123,19 @@ class SQLHandlerBaseTest(object):
 
     def test_close(self):
         sql_handler = self.init_sqlhandler()
+        another_handler = self.init_sqlhandler()
+
+        with sql_handler._borrow():
+            sql_handler.close()
+            self.assertEqual(sql_handler._conn, None)
+            self.assertEqual(sql_handler._cursor, None)
+        # the connection is returned to the pool shared, but not closed
+        self.mock_conn.close.assert_not_called()
+        self.assertFalse(another_handler._pool.closed)
+        self.assertEqual(another_handler._pool.nidle, 1)
+        self.assertIsNotNone(another_handler.execute("operation", mock.Mock()))
 
         sql_handler.close()
-        self.mock_conn.close.assert_called_once_with()
-        self.assertEqual(sql_handler._conn, None)
-        self.assertEqual(sql_handler._cursor, None)
-
-        sql_handler.close()
-        # No additional methods called
+        self.mock_conn.close.assert_not_called()
+        pool.close_all()
         self.mock_conn.close.assert_called_once_with()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import mock
+import _mssql
+
+from moose.connection import database, pool, query
+
+from .config import sql_settings
+
+
+class PrimitiveMssqlHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_conn = mock.Mock()
+        self.connect_patcher = mock.patch.object(
+            database.PrimitiveMssqlHandler, 'get_connection', return_value=self.mock_conn)
+        self.connect_patcher.start()
+        self.handler = database.PrimitiveMssqlHandler(sql_settings)
+        self.handler.bulk_max_rows = 3
+        self.statement = query.AcqsToMarkByDataguids.statement_template.format(
+            table_source='DataSource', project_id=1, create_time='2018-10-01')
+        self.rows = [('title%d' % i, 'guid%d' % i, 1, 'user', 10, 'a.wav') for i in range(7)]
+
+    def tearDown(self):
+        self.connect_patcher.stop()
+        pool.close_all()
+
+    def executed(self):
+        return [c[0][0] for c in self.mock_conn.execute_non_query.call_args_list]
+
+    def test_iter_batches(self):
+        batches = list(self.handler.iter_batches(self.statement, self.rows))
+        self.assertEqual([n for _, n in batches], [3, 3, 1])
+        statement, _ = batches[-1]
+        self.assertEqual(
+            statement,
+            "insert into DataSource (ProjectID,Title,DataGuid,DataVersion,UserGuid,"
+            "Duration,FileName,CreateTime) values (1,'title6','guid6',1,'user',10,"
+            "'a.wav','2018-10-01')")
+
+        # limits the size of statements
+        self.handler.bulk_max_rows = 1000
+        self.handler.bulk_max_size = len(statement) + 10
+        self.assertEqual([n for _, n in self.handler.iter_batches(self.statement, self.rows)], [1] * 7)
+        self.assertEqual(list(self.handler.iter_batches(self.statement, [])), [])
+
+    def test_exec_many(self):
+        self.assertEqual(self.handler.exec_many(self.statement, iter(self.rows)), 7)
+        executed = self.executed()
+        self.assertEqual(executed[0], "BEGIN TRANSACTION")
+        self.assertEqual(executed[-1], "COMMIT TRANSACTION")
+        self.assertEqual(len(executed), 5)
+
+    def test_rollback(self):
+        error = _mssql.MssqlDatabaseException("test")
+        self.mock_conn.execute_non_query.side_effect = [None, None, error, None]
+        with self.assertRaises(_mssql.MssqlDatabaseException):
+            self.handler.exec_many(self.statement, self.rows)
+        self.assertEqual(self.executed()[-1], "IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+
+    def test_connection_retried(self):
+        database.PrimitiveMssqlHandler.get_connection.side_effect = \
+            [database.ConnectionTimeout()] * database.RETRY_TIME + [self.mock_conn]
+        places = []
+        def sleep(interval):
+            places.append(self.handler.pool.size)
+
+        with mock.patch('moose.connection.database.time.sleep', side_effect=sleep):
+            with self.handler.connection() as conn:
+                self.assertIs(conn, self.mock_conn)
+        # waits once without holding a place in the pool
+        self.assertEqual(places, [0])
+        self.assertEqual(self.handler.pool.size, 1)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import mock
+import unittest
+
+from moose.connection import fetch, query
+
+from .config import sql_settings, mongo_settings
+
+
+def fake_collection(docs):
+    """
+    Returns a function to fetch documents matching the `$in` filter on `_guid`.
+    """
+    def _fetch(filter=None, projection=None):
+        if not filter:
+            return list(docs)
+        guids = filter['_guid']['$in']
+        return [doc for doc in docs if doc['_guid'] in guids]
+    return mock.Mock(side_effect=_fetch)
+
+
+class FetcherTestCase(unittest.TestCase):
+
+    fetcher_class = fetch.BaseFetcher
+
+    def setUp(self):
+        self.context = {
+            'sql_handler': 'moose.connection.database.SQLServerHandler',
+            'sql_context': sql_settings,
+            'mongo_handler': 'moose.connection.database.MongoDBHandler',
+            'mongo_context': mongo_settings,
+        }
+        self.pairs = [('s%d' % i, 'r%d' % i) for i in range(10)]
+        self.sources = [{'_guid': 's%d' % i} for i in range(10)]
+        self.results = [{'_guid': 'r%d' % i} for i in range(10) if i != 3]
+
+        with mock.patch.object(self.fetcher_class, '_BaseFetcher__load_or_import'):
+            self.fetcher = self.fetcher_class(query.AllGuidQuery, self.context)
+        self.fetcher.chunk_size = 4
+        self.fetcher.querier.query = mock.Mock(return_value=self.pairs)
+        self.fetcher.mongodb.fetch_source = fake_collection(self.sources)
+        self.fetcher.mongodb.fetch_result = fake_collection(self.results)
+        # the queryset selects a small part of the collection
+        self.fetcher.mongodb.count.return_value = 1000
+
+    def test_iter_fetch(self):
+        records = self.fetcher.iter_fetch(project_id=1)
+        # nothing was fetched before iterating
+        self.fetcher.querier.query.assert_not_called()
+
+        records = list(records)
+        self.fetcher.mongodb.set_database.assert_called_with('1')
+        self.fetcher.querier.query.assert_called_with(project_id=1)
+        # the record without result was skipped
+        self.assertEqual(
+            [r['result']['_guid'] for r in records],
+            ['r%d' % i for i in range(10) if i != 3])
+        self.assertEqual(
+            [r['source']['_guid'] for r in records],
+            ['s%d' % i for i in range(10) if i != 3])
+
+        # looks up documents chunk by chunk
+        self.assertEqual(self.fetcher.mongodb.fetch_result.call_count, 3)
+        self.fetcher.mongodb.fetch_source.assert_called_with(
+            {'_guid': {'$in': ['s8', 's9']}}, None)
+
+    def test_projection(self):
+        projection = {'source': ['_guid', 'url'], 'result': ['_guid', 'markResult']}
+        list(self.fetcher.iter_fetch(projection, project_id=1))
+        for call in self.fetcher.mongodb.fetch_source.call_args_list:
+            self.assertEqual(call[0][1], ['_guid', 'url'])
+        for call in self.fetcher.mongodb.fetch_result.call_args_list:
+            self.assertEqual(call[0][1], ['_guid', 'markResult'])
+
+    def test_fetch(self):
+        self.assertEqual(
+            self.fetcher.fetch(project_id=1),
+            list(self.fetcher.iter_fetch(project_id=1)))
+
+    def test_full_scan(self):
+        selected = list(self.fetcher.iter_fetch(project_id=1))
+        self.fetcher.mongodb.fetch_source.reset_mock()
+        self.fetcher.mongodb.fetch_result.reset_mock()
+
+        # the queryset covers most documents in the collection
+        self.fetcher.mongodb.count.return_value = 12
+        self.assertEqual(list(self.fetcher.iter_fetch(project_id=1)), selected)
+        self.fetcher.mongodb.fetch_result.assert_called_once_with({}, None)
+        # sources are looked up for results scanned chunk by chunk
+        self.assertEqual(self.fetcher.mongodb.fetch_source.call_count, 3)
+        self.fetcher.mongodb.fetch_source.assert_called_with({'_guid': {'$in': ['s9']}}, None)
+
+    def test_scan_streamed(self):
+        name, docs = ('fetch_result', self.results) if self.fetcher.get_scan()[1] \
+            else ('fetch_source', self.sources)
+        scanned = []
+        def scan(filter, projection):
+            for doc in docs:
+                scanned.append(doc)
+                yield doc
+        setattr(self.fetcher.mongodb, name, mock.Mock(side_effect=scan))
+        self.fetcher.mongodb.count.return_value = 12
+        records = self.fetcher.iter_fetch(project_id=1)
+        # records are joined before the scan completes
+        self.assertEqual(next(records)[name[len('fetch_'):]], docs[0])
+        self.assertEqual(len(scanned), 4)
+        self.assertEqual(len(list(records)), len(docs) - 1)
+
+
+class SourceFetcherTestCase(FetcherTestCase):
+
+    fetcher_class = fetch.SourceFetcher
+
+    def test_iter_fetch(self):
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(
+            [r['source']['_guid'] for r in records],
+            ['s%d' % i for i in range(10)])
+        self.assertEqual([r['result'] for r in records], [{}] * 10)
+        self.fetcher.mongodb.fetch_result.assert_not_called()
+        self.fetcher.mongodb.count.assert_called_with(self.fetcher.mongodb.coll_source)
+
+    def test_full_scan(self):
+        self.fetcher.mongodb.count.return_value = 12
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(len(records), 10)
+        self.fetcher.mongodb.fetch_source.assert_called_once_with({}, None)
+
+
+class ResultFetcherTestCase(FetcherTestCase):
+
+    fetcher_class = fetch.ResultFetcher
+
+    def test_iter_fetch(self):
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(
+            [r['result']['_guid'] for r in records],
+            ['r%d' % i for i in range(10) if i != 3])
+        self.fetcher.mongodb.fetch_source.assert_not_called()
+
+    def test_full_scan(self):
+        self.fetcher.mongodb.count.return_value = 12
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(len(records), 9)
+        self.fetcher.mongodb.fetch_result.assert_called_once_with({}, None)
+
+
+class AcquisitionFetcherTestCase(FetcherTestCase):
+
+    fetcher_class = fetch.AcquisitionFetcher
+
+    def test_iter_fetch(self):
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(records, [{'source': {}, 'result': r} for r in self.results])
+        self.fetcher.querier.query.assert_not_called()
+
+    def test_full_scan(self):
+        # always scans the collection for no sql queryset
+        self.fetcher.mongodb.count.return_value = 12
+        records = list(self.fetcher.iter_fetch(project_id=1))
+        self.assertEqual(len(records), 9)
+        self.fetcher.mongodb.fetch_result.assert_called_once_with({}, None)
+        self.fetcher.mongodb.fetch_source.assert_not_called()
+        self.fetcher.mongodb.count.assert_not_called()
+
+    def test_scan_streamed(self):
+        scanned = []
+        def scan(filter, projection):
+            for doc in self.results:
+                scanned.append(doc)
+                yield doc
+        self.fetcher.mongodb.fetch_result = mock.Mock(side_effect=scan)
+        records = self.fetcher.iter_fetch({'result': ['_guid']}, project_id=1)
+        # records are generated as documents are scanned
+        self.assertEqual(next(records), {'source': {}, 'result': self.results[0]})
+        self.assertEqual(len(scanned), 1)
+        self.assertEqual(len(list(records)), len(self.results) - 1)
+        self.fetcher.mongodb.fetch_result.assert_called_once_with({}, ['_guid'])
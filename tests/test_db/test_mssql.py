@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import unittest
 
+import mock
+
 import pymssql
 import _mssql
 
@@ -65,7 +67,7 @@ class PrimitiveMssqlHandlerTestCase(SQLHandlerBaseTest, unittest.TestCase):
     def test_connect(self):
         sql_handler = self.init_sqlhandler()
         self.assertEqual(self.mock_connect.call_count, 1)
-        self.assertIs(sql_handler._conn, self.mock_conn)
+        self.assertIs(sql_handler._pool.acquire(), self.mock_conn)
         self.assertEqual(self.mock_conn.query_timeout, settings.DB_CONN_TIMEOUT)
 
     def test_cursor(self):
@@ -80,6 +82,22 @@ class PrimitiveMssqlHandlerTestCase(SQLHandlerBaseTest, unittest.TestCase):
         self.assertEqual(sql_handler.exec_query("operation"), "1")
         self.mock_conn.execute_query.assert_called_once_with("operation")
 
+    def test_iter_query(self):
+        sql_handler = self.init_sqlhandler()
+
+        self.mock_conn.__iter__ = mock.Mock(return_value=iter([1, 2, 3]))
+        self.assertEqual(list(sql_handler.iter_query("operation")), [1, 2, 3])
+        self.mock_conn.execute_query.assert_called_once_with("operation")
+        self.mock_conn.cancel.assert_not_called()
+
+        # rows pending are discarded if not consumed
+        self.mock_conn.__iter__ = mock.Mock(return_value=iter([1, 2, 3]))
+        rows = sql_handler.iter_query("operation")
+        next(rows)
+        rows.close()
+        self.mock_conn.cancel.assert_called_once_with()
+        self.assertEqual(sql_handler._pool.nidle, 1)
+
     def test_commit(self):
         sql_handler = self.init_sqlhandler()
 
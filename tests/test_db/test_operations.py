@@ -73,6 +73,14 @@ class BaseQueryTestCase(unittest.TestCase):
         with self.assertRaises(ImproperlyConfigured):
             self.querier.query()
 
+    def test_iter(self):
+        self.querier.handler.iter_query.return_value = iter([(1, ), (2, )])
+        self.querier.operation_template = "select * from $table_result where task_id={task_id}"
+        self.querier.batch_size = 100
+        self.assertEqual(list(self.querier.iter(task_id=1000)), [(1, ), (2, )])
+        self.querier.handler.iter_query.assert_called_with(
+            "select * from $table_result where task_id=1000", 100)
+
 class BaseQueryTest(object):
 
     query_cls_str = None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+
+import mock
+
+from moose.connection import pool
+from moose.core.exceptions import ConnectionTimeout
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connect = mock.Mock(side_effect=lambda: mock.Mock())
+        self.ping = mock.Mock(return_value=True)
+        self.pool = pool.ConnectionPool(
+            self.connect, ping=self.ping, max_size=2, idle_timeout=60,
+            ping_interval=0, timeout=0.1)
+
+    def test_reuse(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertIs(self.pool.acquire(), conn)
+        self.assertEqual(self.connect.call_count, 1)
+        self.ping.assert_called_once_with(conn)
+
+    def test_max_size(self):
+        conns = [self.pool.acquire(), self.pool.acquire()]
+        with self.assertRaises(ConnectionTimeout):
+            self.pool.acquire()
+
+        # blocks until a connection was returned
+        timer = threading.Timer(0.05, self.pool.release, [conns[0]])
+        timer.start()
+        self.pool.timeout = 5
+        self.assertIs(self.pool.acquire(), conns[0])
+        timer.join()
+        self.assertEqual(self.pool.size, 2)
+
+    def test_broken(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.ping.return_value = False
+        self.assertIsNot(self.pool.acquire(), conn)
+        conn.close.assert_called_once_with()
+        self.assertEqual(self.pool.size, 1)
+
+    def test_ping_interval(self):
+        self.pool.ping_interval = 60
+        self.pool.release(self.pool.acquire())
+        self.pool.acquire()
+        self.ping.assert_not_called()
+
+    def test_idle_timeout(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        with mock.patch('moose.connection.pool.time.time', return_value=time.time()+61):
+            self.assertIsNot(self.pool.acquire(), conn)
+        conn.close.assert_called_once_with()
+        self.assertEqual(self.pool.size, 1)
+
+    def test_connect_failed(self):
+        self.connect.side_effect = ConnectionTimeout
+        with self.assertRaises(ConnectionTimeout):
+            self.pool.acquire()
+        self.assertEqual(self.pool.size, 0)
+
+    def test_reset(self):
+        reset = self.pool._reset = mock.Mock(side_effect=ValueError)
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        reset.assert_called_once_with(conn)
+        conn.close.assert_called_once_with()
+        self.assertEqual(self.pool.size, 0)
+
+    def test_close(self):
+        idle, in_use = self.pool.acquire(), self.pool.acquire()
+        self.pool.release(idle)
+        self.pool.close()
+        idle.close.assert_called_once_with()
+        in_use.close.assert_not_called()
+        self.pool.release(in_use)
+        in_use.close.assert_called_once_with()
+        self.assertEqual(self.pool.size, 0)
+
+    def test_threads(self):
+        self.pool.timeout = 5
+        in_use = []
+        peak = []
+
+        def borrow():
+            for _ in range(20):
+                with self.pool.connection() as conn:
+                    in_use.append(conn)
+                    peak.append(len(in_use))
+                    in_use.remove(conn)
+
+        threads = [threading.Thread(target=borrow) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(max(peak), 2)
+        self.assertLessEqual(self.connect.call_count, 2)
+
+
+class GetPoolTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        pool.close_all()
+
+    def test_shared(self):
+        settings_dict = {'HOST': 'host', 'TABLE_ALIAS': {'a': 'A', 'b': 'B'}}
+        p = pool.get_pool(object, settings_dict, connect=mock.Mock())
+        self.assertIs(pool.get_pool(object, dict(settings_dict), connect=mock.Mock()), p)
+        self.assertIsNot(pool.get_pool(dict, settings_dict, connect=mock.Mock()), p)
+        self.assertIsNot(pool.get_pool(object, {'HOST': 'another'}, connect=mock.Mock()), p)
+
+        # a new pool is created if closed
+        p.close()
+        self.assertIsNot(pool.get_pool(object, settings_dict, connect=mock.Mock()), p)
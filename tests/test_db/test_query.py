@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from moose.connection import query
+
+
+class EditedQueryTestCase(unittest.TestCase):
+
+    def test_all(self):
+        querier = query.edited_query(query.AllGuidQuery)(None, {})
+        self.assertEqual(
+            querier.statement_template.format(
+                table_result='DataResult', project_id=1,
+                edited_less_or_more='>', edited_datetime='2018-01-01 00:00:00'),
+            "select dr.SourceGuid, dr.DataGuid from DataResult dr where "
+            "dr.ProjectId = 1 and dr.LastEditTime > '2018-01-01 00:00:00' ")
+
+    def test_conditions(self):
+        querier = query.edited_query(query.StatusGuidQuery)(None, {})
+        self.assertTrue(issubclass(querier.__class__, query.StatusGuidQuery))
+        self.assertEqual(
+            querier.statement_template.format(
+                table_result='DataResult', project_id=1, status=1,
+                edited_less_or_more='>', edited_datetime='2018-01-01 00:00:00'),
+            "select dr.SourceGuid, dr.DataGuid from DataResult dr where "
+            "dr.ProjectId = 1 and dr.status = 1 and "
+            "dr.LastEditTime > '2018-01-01 00:00:00' ")
+
+    def test_created_time(self):
+        # arguments of the query are kept
+        querier = query.edited_query(query.CreatedTimeGuidQuery)(None, {})
+        self.assertEqual(
+            querier.statement_template.format(
+                table_result='DataResult', project_id=1,
+                less_or_more='<', datetime='2017-01-01 00:00:00',
+                edited_less_or_more='>', edited_datetime='2018-01-01 00:00:00'),
+            "select dr.SourceGuid, dr.DataGuid from DataResult dr where "
+            "dr.ProjectId = 1 and dr.Date < '2017-01-01 00:00:00' and "
+            "dr.LastEditTime > '2018-01-01 00:00:00' ")
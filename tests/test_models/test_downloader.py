@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import multiprocessing
+import mock
+
+from moose.actions.stats import StatsCollector
+from moose.apps import apps
+from moose.connection.http import HTTPError, DownloadCancelled
+from moose.core.manifest import ExportManifest
+from moose.models import BaseModel, fields
+from moose.models.downloader import \
+    ModelDownloader, DownloadWorker, ProcessPoolCallbackExecutor
+from moose.utils import six
+
+
+class StubModel(object):
+
+    def __init__(self, filelink, dest_filepath):
+        self.filelink = filelink
+        self.dest_filepath = dest_filepath
+
+
+def touch_handled(data_model):
+    # a callback to be pickled, which marks the model handled by a file
+    with open(data_model.dest_filepath + '.handled', 'w'):
+        pass
+
+
+class LegacyWorker(DownloadWorker):
+    """
+    Subclassed with the signature before clients and limiters were added.
+    """
+
+    def __init__(self, queue, callback, stats, timeout, overwrite=False):
+        super(LegacyWorker, self).__init__(queue, callback, stats, timeout, overwrite)
+
+
+class StubApp(object):
+    """
+    Not picklable like `AppConfig`, which holds the module of the app.
+    """
+    label = 'downloadertest'
+
+    def __init__(self, data_dirname):
+        self.data_dirname = data_dirname
+        self.lock = threading.Lock()
+
+
+class ImageModel(BaseModel):
+    url = fields.SourceMappingField('url')
+
+    @property
+    def filepath(self):
+        return self.url.rsplit('/', 1)[-1]
+
+    @property
+    def filelink(self):
+        return self.url
+
+
+class StubClient(object):
+    """
+    Writes the url as the content of the file instead of requesting it.
+
+    `failures`
+        A dict maps urls to how many times downloads of them are to fail
+        before succeed.
+
+    `gate`
+        An event downloads are blocked on until set, `started` is set once
+        any of them were blocked.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = dict(failures or {})
+        self.gate     = threading.Event()
+        self.started  = threading.Event()
+        self.gate.set()
+        # urls in the order of requests, retries included
+        self.requests = []
+        self.hedged   = []
+        self.lock     = threading.Lock()
+
+    def _request(self, url, cancelled=None):
+        with self.lock:
+            self.requests.append(url)
+        self.started.set()
+        while not self.gate.wait(0.01):
+            if cancelled is not None and cancelled():
+                raise DownloadCancelled(url)
+        with self.lock:
+            if self.failures.get(url, 0) > 0:
+                self.failures[url] -= 1
+                raise HTTPError(url, 500, 'Injected failure')
+
+    def get(self, url, headers=None, stats=None, cancelled=None):
+        self._request(url, cancelled)
+        return url.encode('ascii')
+
+    def hedged_get(self, url, delay, headers=None, stats=None, cancelled=None):
+        self.hedged.append(url)
+        return self.get(url, headers, stats, cancelled)
+
+    def download(self, url, filepath, stats=None, part_path=None, cancelled=None):
+        self._request(url, cancelled)
+        with open(filepath, 'wb') as f:
+            f.write(url.encode('ascii'))
+        return len(url)
+
+    def hedged_download(self, url, filepath, delay, stats=None, cancelled=None):
+        self.hedged.append(url)
+        return self.download(url, filepath, stats, cancelled=cancelled)
+
+
+class ModelDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir  = tempfile.mkdtemp()
+        self.stats   = StatsCollector(mock.Mock(stats_dump=False))
+        self.client  = StubClient()
+        self.handled = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def callback(self, data_model):
+        self.handled.append(data_model.filelink)
+
+    def create_downloader(self, **kwargs):
+        kwargs.setdefault('nworkers', 1)
+        kwargs.setdefault('executor_cls', 'moose.models.downloader.InlineCallbackExecutor')
+        return ModelDownloader(
+            self.callback, self.stats, timeout=1, client=self.client, adaptive=False,
+            hedge_percentile=0, **kwargs)
+
+    def create_model(self, i):
+        return StubModel('http://host/{}.jpg'.format(i), os.path.join(self.tmpdir, '{}.jpg'.format(i)))
+
+    def test_download(self):
+        downloader = self.create_downloader(nworkers=3)
+        downloader.start()
+        models = [self.create_model(i) for i in range(10)]
+        for model in models:
+            downloader.add_task(model)
+        downloader.join()
+
+        self.assertEqual(sorted(self.handled), sorted(model.filelink for model in models))
+        self.assertEqual(self.stats.get_value('download/ok'), 10)
+        with open(models[3].dest_filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'http://host/3.jpg')
+
+        # not downloaded again if the file existed
+        downloader = self.create_downloader()
+        downloader.start()
+        downloader.add_task(models[0])
+        downloader.join()
+        self.assertEqual(self.stats.get_value('download/conflict'), 1)
+        self.assertEqual(len(self.client.requests), 10)
+
+    def test_add_task_blocked(self):
+        downloader = self.create_downloader(maxsize=1)
+        downloader.start()
+        self.client.gate.clear()
+        downloader.add_task(self.create_model(0))
+        # the worker is downloading the first one, the second one is queued
+        self.assertTrue(self.client.started.wait(5))
+        downloader.add_task(self.create_model(1))
+        self.assertIsNone(self.stats.get_value('download/queue_blocked'))
+
+        adding = threading.Thread(target=downloader.add_task, args=(self.create_model(2), ))
+        adding.start()
+        adding.join(0.2)
+        self.assertTrue(adding.is_alive())
+        self.client.gate.set()
+        adding.join(5)
+        self.assertFalse(adding.is_alive())
+        downloader.join()
+
+        self.assertEqual(len(self.handled), 3)
+        self.assertEqual(self.stats.get_value('download/queue_blocked'), 1)
+        self.assertGreaterEqual(self.stats.get_value('download/queue_blocked_ms'), 100)
+        self.assertEqual(self.stats.get_value('download/queue_max_depth'), 1)
+
+    def test_retry_in_place(self):
+        models = [self.create_model(i) for i in range(2)]
+        self.client.failures = {models[0].filelink: 1}
+        downloader = self.create_downloader(maxsize=1)
+        downloader.start()
+        self.client.gate.clear()
+        downloader.add_task(models[0])
+        self.assertTrue(self.client.started.wait(5))
+        # the queue is full when the first one is to be retried
+        downloader.add_task(models[1])
+        self.client.gate.set()
+        downloader.join()
+
+        self.assertEqual(
+            self.client.requests, [models[0].filelink, models[0].filelink, models[1].filelink])
+        self.assertEqual(self.handled, [models[0].filelink, models[1].filelink])
+        self.assertEqual(self.stats.get_value('download/retry'), 1)
+        self.assertEqual(self.stats.get_value('download/ok'), 2)
+
+    def test_deadline(self):
+        models = [self.create_model(i) for i in range(5)]
+        downloader = self.create_downloader(deadline=0.3)
+        downloader.start()
+        # the first one is in flight until cancelled at the deadline, and
+        # the others are given up without downloading
+        self.client.gate.clear()
+        for model in models:
+            downloader.add_task(model)
+        downloader.join()
+
+        self.assertEqual(self.client.requests, [models[0].filelink])
+        self.assertEqual(self.handled, [])
+        self.assertEqual(self.stats.get_value('download/deadline_exceeded'), 5)
+        self.assertIsNone(self.stats.get_value('download/retry'))
+        self.assertIsNone(self.stats.get_value('download/ok'))
+
+    def test_keep_data(self):
+        models = [self.create_model(i) for i in range(3)]
+        received = []
+        self.callback = lambda data_model, data: received.append(data)
+        downloader = self.create_downloader(keep_data=True)
+        # slow downloads kept in memory are hedged as well
+        downloader.hedging = mock.Mock(**{'get_delay.return_value': 5})
+        downloader.start()
+        for model in models:
+            downloader.add_task(model)
+        downloader.join()
+
+        self.assertEqual(sorted(received), [b'http://host/%d.jpg' % i for i in range(3)])
+        self.assertEqual(len(self.client.hedged), 3)
+        self.assertFalse(os.path.exists(models[0].dest_filepath))
+
+        # downloads in memory are cancelled at the deadline too
+        self.client.gate.clear()
+        downloader = self.create_downloader(keep_data=True, deadline=0.3)
+        downloader.start()
+        downloader.add_task(self.create_model(3))
+        downloader.join()
+        self.assertEqual(self.stats.get_value('download/deadline_exceeded'), 1)
+        self.assertEqual(len(received), 3)
+
+    def test_legacy_worker(self):
+        downloader = self.create_downloader(
+            nworkers=2, worker_cls='tests.test_models.test_downloader.LegacyWorker')
+        downloader.start()
+        for i in range(3):
+            downloader.add_task(self.create_model(i))
+        downloader.join()
+        # downloaded by the client given
+        self.assertEqual(self.stats.get_value('download/ok'), 3)
+        self.assertEqual(len(self.client.requests), 3)
+
+    def test_callback_error(self):
+        def callback(data_model):
+            raise ValueError(data_model.filelink)
+        self.callback = callback
+        downloader = self.create_downloader()
+        downloader.start()
+        for i in range(3):
+            downloader.add_task(self.create_model(i))
+        # the worker keeps running and every task is done
+        joined = threading.Thread(target=downloader.join)
+        joined.daemon = True
+        joined.start()
+        joined.join(10)
+        self.assertFalse(joined.is_alive())
+        self.assertEqual(self.stats.get_value('download/callback_error'), 3)
+
+
+class CallbackExecutorTest(object):
+    """
+    Downloads models and handles them by `executor_cls`.
+    """
+    executor_cls = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app    = StubApp(self.tmpdir)
+        self.stats  = StatsCollector(mock.Mock(stats_dump=False))
+        self.client = StubClient()
+        self.apps_patcher = mock.patch.dict(apps.app_configs, {self.app.label: self.app})
+        self.apps_patcher.start()
+
+    def tearDown(self):
+        self.apps_patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def callback(self, data_model):
+        # changes made in processes are lost except stats
+        data_model.stats.inc_value('test/handled')
+        data_model.stats.inc_value('test/{}/{}'.format(data_model.title, data_model.name))
+        if data_model.name == 'broken':
+            raise ValueError(data_model.name)
+        data_model.context['manifest'].add(data_model.name, data_model.dest_filepath)
+
+    def create_model(self, name, **context):
+        annotation = {'source': {'url': 'http://host/{}.jpg'.format(name)}, 'result': {}}
+        return ImageModel(annotation, self.app, self.stats, title='title', task_id=1, **context)
+
+    def run_downloader(self, models):
+        downloader = ModelDownloader(
+            self.callback, self.stats, timeout=1, client=self.client, nworkers=2,
+            adaptive=False, hedge_percentile=0, executor_cls=self.executor_cls)
+        # only 2 models are waiting to be handled at most
+        downloader.executor.nworkers = 1
+        downloader.executor.slots = threading.BoundedSemaphore(2)
+        downloader.start()
+
+        def run():
+            for data_model in models:
+                downloader.add_task(data_model)
+            downloader.join()
+        # `join()` would hang if slots were not released for models failed
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(20)
+        self.assertFalse(thread.is_alive())
+
+    def test_handle_models(self):
+        # the manifest of incremental exports is not picklable, and the
+        # context not picklable is left out
+        manifest = ExportManifest(os.path.join(self.tmpdir, 'manifest.json'), self.tmpdir)
+        models = [self.create_model(str(i), manifest=manifest, lock=threading.Lock())
+                  for i in range(6)]
+        models.append(self.create_model('broken', manifest=manifest))
+        self.run_downloader(models)
+
+        # files recorded by callbacks are in the manifest
+        self.assertEqual(sorted(manifest.updated), [str(i) for i in range(6)])
+        self.assertEqual(manifest.updated['3'], set(['title/3.jpg']))
+
+        self.assertEqual(self.stats.get_value('download/ok'), 7)
+        self.assertEqual(self.stats.get_value('test/handled'), 7)
+        self.assertEqual(self.stats.get_value('test/title/3'), 1)
+        self.assertEqual(self.stats.get_value('download/callback_error'), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'title', '3.jpg')))
+
+
+class ThreadPoolCallbackExecutorTestCase(CallbackExecutorTest, unittest.TestCase):
+    executor_cls = 'moose.models.downloader.ThreadPoolCallbackExecutor'
+
+
+class ProcessPoolCallbackExecutorTestCase(CallbackExecutorTest, unittest.TestCase):
+    executor_cls = 'moose.models.downloader.ProcessPoolCallbackExecutor'
+
+    def test_models_failed(self):
+        # the app is not installed in the processes
+        models = [self.create_model(str(i)) for i in range(3)]
+        for data_model in models:
+            data_model.app = mock.Mock(label='uninstalled', data_dirname=self.tmpdir)
+        # models not picklable are never sent
+        for i in range(3):
+            data_model = StubModel('http://host/stub{}.jpg'.format(i),
+                                   os.path.join(self.tmpdir, 'stub{}.jpg'.format(i)))
+            data_model.lock = threading.Lock()
+            models.append(data_model)
+        self.run_downloader(models)
+
+        self.assertEqual(self.stats.get_value('download/ok'), 6)
+        self.assertEqual(self.stats.get_value('download/callback_error'), 6)
+        self.assertIsNone(self.stats.get_value('test/handled'))
+
+    @unittest.skipIf(six.PY2, 'start methods are not supported by Python 2')
+    def test_spawn(self):
+        # the executor is passed to processes started without forking
+        executor = ProcessPoolCallbackExecutor(touch_handled, self.stats, nworkers=2)
+        executor.pool_class = multiprocessing.get_context('spawn').Pool
+        executor.start()
+        for i in range(3):
+            executor.submit(StubModel('http://host/{}.jpg'.format(i),
+                                      os.path.join(self.tmpdir, '{}.jpg'.format(i))))
+        executor.join()
+
+        self.assertIsNone(self.stats.get_value('download/callback_error'))
+        for i in range(3):
+            self.assertTrue(os.path.exists(os.path.join(self.tmpdir, '{}.jpg.handled'.format(i))))
+
+    def test_is_picklable(self):
+        executor = ProcessPoolCallbackExecutor(touch_handled, self.stats)
+        self.assertTrue(executor.is_picklable('value', 1))
+        # values are checked again even if ids were reused
+        self.assertFalse(executor.is_picklable('value', threading.Lock()))
+        self.assertTrue(executor.is_picklable('value', 2))
+        self.assertFalse(executor.is_picklable('value', threading.Lock()))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from moose.toolbox.image import draw
+
+
+DATALIST = (
+    ('car', [[10, 10], [60, 10], [60, 40], [10, 40]]),
+    ('person', [[30, 20], [90, 30], [50, 70]]),
+)
+PALLET = {
+    'car': (255, 0, 0),
+    'person': (0, 255, 0),
+}
+
+
+class DrawTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = np.random.RandomState(0).randint(0, 256, (80, 100, 3)).astype(np.uint8)
+        self.image_path = os.path.join(self.tmpdir, 'image.png')
+        cv2.imwrite(self.image_path, self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_decode_image(self):
+        with open(self.image_path, 'rb') as f:
+            data = f.read()
+        self.assertTrue((draw.decode_image(data) == self.image).all())
+        self.assertIsNone(draw.decode_image(b'not an image'))
+        self.assertIs(draw.read_image(self.image), self.image)
+        self.assertTrue((draw.read_image(self.image_path) == self.image).all())
+
+    def test_image_decoded(self):
+        # draws the same from the path and the image decoded
+        draw.draw_polygons(self.image_path, self.path('mask1.png'), DATALIST, PALLET)
+        draw.draw_polygons(self.image, self.path('mask2.png'), DATALIST, PALLET)
+        draw.blend(self.image_path, self.path('blend1.png'), DATALIST, PALLET)
+        draw.blend(self.image, self.path('blend2.png'), DATALIST, PALLET)
+        for name in ('mask', 'blend'):
+            self.assertTrue((cv2.imread(self.path(name + '1.png')) ==
+                             cv2.imread(self.path(name + '2.png'))).all())
+
+    def test_render(self):
+        # the same as drawing the mask and blending separately
+        draw.draw_polygons(self.image_path, self.path('mask1.png'), DATALIST, PALLET)
+        draw.blend(self.image_path, self.path('blend1.png'), DATALIST, PALLET)
+        draw.render(self.image_path, DATALIST, PALLET,
+                    mask_name=self.path('mask2.png'), blend_name=self.path('blend2.png'))
+        for name in ('mask', 'blend'):
+            self.assertTrue((cv2.imread(self.path(name + '1.png')) ==
+                             cv2.imread(self.path(name + '2.png'))).all())
+
+        draw.render(self.image, DATALIST, PALLET, blend_name=self.path('blend3.png'))
+        self.assertTrue(os.path.exists(self.path('blend3.png')))
+        self.assertFalse(os.path.exists(self.path('mask3.png')))
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
 import json
+import shutil
+import tempfile
 import unittest
 import mock
+import cv2
 import numpy as np
 
 from moose.toolbox.image import drawer
@@ -180,6 +184,11 @@ class PointsRectangleTestCase(RectangleTestCase):
     shape_class       = drawer.Rectangle.from_points
 
 
+class BatchPainter(drawer.GeneralPainter):
+    # not to share the pallet with other tests
+    persistent_pallet = {}
+
+
 class GeneralPainterTestCase(unittest.TestCase):
     def setUp(self):
         self.image_path = u"tests/sample_data/toolbox/OuNYQbIuF4_00048951.png"
@@ -255,3 +264,142 @@ class GeneralPainterTestCase(unittest.TestCase):
         self.assert_pixel_value(canvas, 6, 6, (0, 255, 0))
         self.assert_pixel_value(canvas, 19, 20, (0, 255, 0))
         self.assert_pixel_value(canvas, 4, 10, (255, 0, 0))
+
+    def test_outputs(self):
+        painter = drawer.GeneralPainter(self.image_path, persistent=False, pallet={
+            "label1": (255, 0, 0),
+            "label2": (0, 255, 0),
+            "black": (0, 0, 0),
+            })
+        painter.add_shape(drawer.Polygon([[5, 5], [200, 20], [50, 200], [5, 5]], 'label2'))
+        painter.add_shape(drawer.Polygon([[100, 5], [300, 100], [100, 150], [100, 5]], 'black'))
+        painter.add_shape(drawer.Rectangle([[0, 0], [120, 120]], 'label1'))
+        painter.add_shape(drawer.LineString([[0, 300], [400, 250], [20, 20]], 'label1'))
+        painter.add_shape(drawer.Point([150, 150], 'label2'))
+
+        # the same as rendering shapes on each of outputs
+        mask = painter.render(np.zeros(painter.im.shape, np.uint8))
+        drawn = painter.render(painter.im.copy())
+        blended = cv2.addWeighted(painter.im, 0.7, mask, 0.3, 0.0)
+        self.assertTrue((painter.get_mask() == mask).all())
+        self.assertTrue((painter.get_drawn() == drawn).all())
+        self.assertTrue((painter.get_blended() == blended).all())
+
+        # shapes are rasterized once until changed
+        layer = painter.get_layer()
+        self.assertIs(painter.get_layer(), layer)
+        painter.add_shape(drawer.Point([400, 400], 'label1'))
+        self.assertIsNot(painter.get_layer(), layer)
+        self.assert_pixel_value(painter.get_mask(), 400, 400, (255, 0, 0))
+
+    def test_group_shapes(self):
+        painter = drawer.GeneralPainter(self.image_path, persistent=False, pallet={
+            "label1": (255, 0, 0),
+            "label2": (0, 255, 0),
+            })
+        # filled polygons of the same color apart are grouped
+        painter.add_shape(drawer.Polygon([[5, 5], [50, 5], [50, 50], [5, 5]], 'label1'))
+        painter.add_shape(drawer.Polygon([[100, 5], [150, 5], [150, 50], [100, 5]], 'label1'))
+        # but not overlapped ones, since areas overlapped are filled by parity
+        painter.add_shape(drawer.Polygon([[20, 5], [80, 5], [80, 50], [20, 5]], 'label1'))
+        # lines of the same color are grouped even if overlapped
+        painter.add_shape(drawer.LineString([[0, 300], [400, 250]], 'label2'))
+        painter.add_shape(drawer.Rectangle([[300, 200], [500, 400]], 'label2'))
+        painter.add_shape(drawer.LineString([[0, 250], [280, 285]], 'label2'))
+        # shapes are never drawn before shapes overlapped, and join the
+        # latest group otherwise
+        painter.add_shape(drawer.Point([400, 275], 'label1'))
+        painter.add_shape(drawer.LineString([[350, 200], [450, 350]], 'label2'))
+        painter.add_shape(drawer.Polygon([[200, 5], [250, 5], [250, 50], [200, 5]], 'label1'))
+        for shape in painter._shapes:
+            shape.set_color(painter.get_color(shape._label))
+
+        groups = painter.group_shapes()
+        self.assertEqual([(key, len(contours)) for key, _, contours in groups if key], [
+            (('fill', ), 2),
+            (('fill', ), 2),
+            (('polylines', False, 3), 2),
+            (('polylines', True, 3), 1),
+            (('polylines', False, 3), 1),
+            ])
+        self.assertEqual(groups[4], (None, None, painter._shapes[6]))
+
+        # the same as drawing shapes one by one
+        canvas = np.zeros(painter.im.shape, np.uint8)
+        for shape in painter._shapes:
+            shape.draw_on(canvas)
+        self.assertTrue((painter.render(np.zeros(painter.im.shape, np.uint8)) == canvas).all())
+        self.assertIs(painter._shapes[0].to_nparray(), painter._shapes[0].to_nparray())
+
+    def test_batch_render(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shapes = [
+                drawer.Polygon([[5, 5], [200, 20], [50, 200], [5, 5]], 'label1'),
+                drawer.LineString([[0, 300], [400, 250]], 'label2'),
+                ]
+            image_paths = [os.path.join(tmpdir, name) for name in ('a.png', 'b.png')]
+            for image_path in image_paths:
+                shutil.copy(self.image_path, image_path)
+            jobs = [(image_paths[0], shapes, None), (image_paths[1], shapes[1:], {'label3': 3})]
+            # an image existed but not able to be decoded
+            broken_path = os.path.join(tmpdir, 'broken.png')
+            with open(broken_path, 'wb') as f:
+                f.write(b'not an image')
+            for i, options in enumerate(({'workers': 1}, {'workers': 2}, {'workers': 2, 'threads': True})):
+                BatchPainter.persistent_pallet.clear()
+                dst_dir = os.path.join(tmpdir, str(i))
+                results = BatchPainter.batch_render(
+                    jobs + [("path/not/existed.jpg", shapes, None), (broken_path, shapes, None)],
+                    outputs=('mask', 'draw'),
+                    dst_dir=dst_dir, autofill=True, **options)
+
+                # colors added automatically are the same in all jobs
+                color = BatchPainter.persistent_pallet['label2']
+                self.assertEqual(set(BatchPainter.persistent_pallet), {'label1', 'label2', 'label3'})
+                mask1, mask2 = [cv2.imread(result['mask']) for result in results[:2]]
+                self.assert_pixel_value(mask1, 200, 275, color)
+                self.assertTrue((mask1 == mask2)[250:, :].all())
+                self.assertIsNone(results[2])
+                self.assertIsNone(results[3])
+
+                # the same as rendering with a painter
+                painter = BatchPainter(image_paths[0], pallet=BatchPainter.persistent_pallet)
+                painter.from_shapes(shapes)
+                self.assertEqual(results[0]['draw'], os.path.join(dst_dir, 'a_draw.png'))
+                self.assertTrue((cv2.imread(results[0]['draw']) == painter.get_drawn()).all())
+
+            with self.assertRaises(ImproperlyConfigured):
+                BatchPainter.batch_render(jobs, outputs=('unknown', ), workers=1)
+            with self.assertRaises(ImproperlyConfigured):
+                BatchPainter.batch_render(jobs, workers=1, persistent=False)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_batch_render_shared_shapes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            shapes = []
+            for i in range(1000):
+                x, y = i * 7 % 400, i * 13 % 300
+                shapes.append(drawer.Polygon([[x, y], [x + 50, y], [x + 50, y + 40], [x, y]], 'label1'))
+                shapes.append(drawer.LineString([[x, y + 50], [x + 80, y + 60]], 'label2'))
+                shapes.append(drawer.Point([x + 10, y + 10], 'label1'))
+            # jobs sharing shapes are rendered by threads at the same time
+            pallet = {'label1': (255, 0, 0), 'label2': (0, 255, 0)}
+            jobs = []
+            for i in range(16):
+                image_path = os.path.join(tmpdir, '{}.png'.format(i))
+                cv2.imwrite(image_path, np.zeros((400, 500, 3), np.uint8))
+                jobs.append((image_path, shapes, pallet))
+            with mock.patch.object(BatchPainter, 'batch_chunksize', 1):
+                results = BatchPainter.batch_render(
+                    jobs, outputs=('mask', ), workers=8, threads=True, persistent=False)
+
+            painter = BatchPainter(jobs[0][0], pallet=pallet, persistent=False)
+            painter.from_shapes(shapes)
+            mask = painter.get_mask()
+            for result in results:
+                self.assertTrue((cv2.imread(result['mask']) == mask).all())
+        finally:
+            shutil.rmtree(tmpdir)